@@ -2,8 +2,12 @@ import os
 from flask import Flask
 
 from config import Config
-from extensions import db, migrate, login_manager, client
+from extensions import db, migrate, login_manager
 import token_manager
+import db_timing
+import rate_limit
+from chat_api import busy_response
+from resilience import CircuitOpenError
 
 def create_app(config_class=Config):
     """Application Factory Function"""
@@ -20,11 +24,19 @@ def create_app(config_class=Config):
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
-    # Client is already initialized in extensions.py with env var
-    # client.api_key = app.config['OPENAI_API_KEY'] # Update API key if needed
+    # The OpenAI client is built on first use (extensions.get_client)
 
     # Initialize token manager
     token_manager.init_app(app)
+
+    # Per-user request budgets for chat and tool POSTs
+    rate_limit.init_app(app)
+
+    # Anything that hits an open breaker or a full LLM queue without handling it gets a 503
+    app.register_error_handler(CircuitOpenError, busy_response)
+
+    # Per-request SQL timing headers for load tests (off unless DB_TIMING_ENABLED)
+    db_timing.init_app(app)
     
     # Import and register blueprints
     from blueprints.auth import auth_bp
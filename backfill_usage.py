@@ -0,0 +1,15 @@
+"""
+Rebuild the usage ledger and rollups from the saved assistant messages,
+e.g. once after deploying the ledger on an existing database:
+`python backfill_usage.py`.
+"""
+from app import create_app
+import usage_ledger
+
+app = create_app()
+
+# 在應用上下文中執行
+with app.app_context():
+    # 從已保存的 AI 回覆重建用量記錄與統計
+    entries = usage_ledger.backfill()
+    print(f"已重建 {entries} 筆用量記錄")
@@ -0,0 +1,240 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+from flask import current_app
+
+from config import Config
+from extensions import db, get_client
+from llm import create_chat_completion
+from models import AnalysisBatch, Chat, Message, User, UserAnalysis
+from utils import calculate_cost
+
+ANALYSIS_SYSTEM_PROMPT = "你是一位經驗豐富的GMAT老師，請詳細分析這位同學詢問的問題集，指出他在GMAT各個考點上的具體弱項概念，並提供針對性的學習建議。"
+
+# Batch API statuses after which a batch will not change any more
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled', 'ingested')
+
+def get_user_questions(user_id, since=None):
+    """Get all of a user's questions across their chats, oldest first."""
+    query = Message.query.join(Chat).filter(
+        Chat.user_id == user_id,
+        Message.role == 'user'
+    )
+    if since:
+        query = query.filter(Message.timestamp >= since)
+    return query.order_by(Message.timestamp).all()
+
+def format_user_questions(user, questions):
+    """Format a user's questions as the analysis prompt."""
+    questions_text = f"學生: {user.username}\n\n"
+    for i, msg in enumerate(questions, 1):
+        chat_category = msg.chat.category # Get category from related chat
+        timestamp_str = msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        questions_text += f"問題 {i} ({chat_category} - {timestamp_str}):\n{msg.content}\n\n"
+    return questions_text
+
+def build_analysis_messages(questions_text):
+    return [
+        {"role": "system", "content": ANALYSIS_SYSTEM_PROMPT},
+        {"role": "user", "content": questions_text}
+    ]
+
+def build_batch_requests(user_ids=None, since=None):
+    """
+    Build one Batch API request line per student with questions.
+    Args:
+        user_ids (list, optional): Restrict to these users; all users by default.
+        since (datetime, optional): Only include questions asked after this time.
+    Returns:
+        list: Request dicts in Batch API JSONL format (custom_id "user-<id>-q<question count>",
+              parsed back by ingest_results).
+    """
+    query = User.query.order_by(User.id)
+    if user_ids:
+        query = query.filter(User.id.in_(user_ids))
+
+    requests = []
+    for user in query.all():
+        questions = get_user_questions(user.id, since)
+        if not questions:
+            continue
+        requests.append({
+            "custom_id": f"user-{user.id}-q{len(questions)}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": Config.ANALYSIS_MODEL,
+                "messages": build_analysis_messages(format_user_questions(user, questions))
+            }
+        })
+    return requests
+
+def write_jsonl(requests, path):
+    """Write request dicts to a JSONL file, one request per line."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for request_line in requests:
+            f.write(json.dumps(request_line, ensure_ascii=False) + "\n")
+
+class LocalBatchClient:
+    """
+    Local stand-in for the OpenAI Files and Batches APIs, for development and
+    tests. Each request is executed synchronously with a chat completion
+    callable when the batch is created; files live in a local directory.
+    """
+    def __init__(self, directory, complete=None):
+        self.directory = directory
+        self._complete = complete or (lambda body: create_chat_completion(body, 'analysis'))
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _path(self, file_id):
+        return os.path.join(self.directory, f"{file_id}.jsonl")
+
+    def _create_file(self, file, purpose="batch"):
+        file_id = f"local-file-{uuid.uuid4().hex[:12]}"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(file_id), 'wb') as f:
+            f.write(file.read())
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        with open(self._path(file_id), encoding='utf-8') as f:
+            return SimpleNamespace(text=f.read())
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        output_lines = []
+        for line in self._file_content(input_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            request_line = json.loads(line)
+            response = self._complete(request_line["body"])
+            body = response.model_dump() if hasattr(response, 'model_dump') else response
+            output_lines.append({
+                "id": f"local-req-{uuid.uuid4().hex[:12]}",
+                "custom_id": request_line["custom_id"],
+                "response": {"status_code": 200, "body": body},
+                "error": None
+            })
+
+        batch_id = f"local-batch-{uuid.uuid4().hex[:12]}"
+        output_path = os.path.join(self.directory, f"{batch_id}-output")
+        write_jsonl(output_lines, output_path + ".jsonl")
+        status = SimpleNamespace(id=batch_id, status="completed", output_file_id=f"{batch_id}-output",
+                                 error_file_id=None, errors=None)
+        with open(os.path.join(self.directory, f"{batch_id}.json"), 'w', encoding='utf-8') as f:
+            json.dump(vars(status), f)
+        return status
+
+    def _retrieve_batch(self, batch_id):
+        with open(os.path.join(self.directory, f"{batch_id}.json"), encoding='utf-8') as f:
+            return SimpleNamespace(**json.load(f))
+
+def get_batch_client(backend=None):
+    """Return the OpenAI client or the local stand-in, per ANALYSIS_BATCH_BACKEND."""
+    backend = backend or Config.ANALYSIS_BATCH_BACKEND
+    if backend == 'local':
+        return LocalBatchClient(Config.ANALYSIS_BATCH_DIR)
+    return get_client()
+
+def submit_batch(user_ids=None, since=None, backend=None):
+    """
+    Build the JSONL input, upload it and create a Batch API job.
+    Returns:
+        AnalysisBatch or None: The tracked batch, or None if nobody has questions.
+    """
+    backend = backend or Config.ANALYSIS_BATCH_BACKEND
+    requests = build_batch_requests(user_ids, since)
+    if not requests:
+        return None
+
+    path = os.path.join(Config.ANALYSIS_BATCH_DIR, f"analysis-{datetime.utcnow():%Y%m%d-%H%M%S}.jsonl")
+    write_jsonl(requests, path)
+
+    batch_client = get_batch_client(backend)
+    with open(path, 'rb') as f:
+        input_file = batch_client.files.create(file=f, purpose="batch")
+    batch = batch_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"purpose": "gmat-question-analysis"}
+    )
+
+    analysis_batch = AnalysisBatch(
+        batch_id=batch.id,
+        backend=backend,
+        status=batch.status,
+        input_file_id=input_file.id,
+        output_file_id=getattr(batch, 'output_file_id', None),
+        request_count=len(requests)
+    )
+    db.session.add(analysis_batch)
+    db.session.commit()
+    return analysis_batch
+
+def poll_batch(analysis_batch):
+    """
+    Refresh a batch's status and ingest its results once completed.
+    Returns:
+        AnalysisBatch: The updated batch.
+    """
+    if analysis_batch.status in FINAL_STATUSES and analysis_batch.status != 'completed':
+        return analysis_batch
+
+    batch_client = get_batch_client(analysis_batch.backend)
+    batch = batch_client.batches.retrieve(analysis_batch.batch_id)
+    analysis_batch.status = batch.status
+    analysis_batch.output_file_id = getattr(batch, 'output_file_id', None)
+    errors = getattr(batch, 'errors', None)
+    if errors:
+        analysis_batch.error = str(errors)
+
+    if batch.status == 'completed' and analysis_batch.output_file_id:
+        output = batch_client.files.content(analysis_batch.output_file_id).text
+        ingest_results(analysis_batch, output)
+        analysis_batch.status = 'ingested'
+        analysis_batch.completed_at = datetime.utcnow()
+    db.session.commit()
+    return analysis_batch
+
+def ingest_results(analysis_batch, output_jsonl):
+    """
+    Store each successful result line as a UserAnalysis (added, not committed).
+    Returns:
+        int: Number of analyses ingested.
+    """
+    ingested = 0
+    for line in output_jsonl.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            current_app.logger.warning(f"Batch {analysis_batch.batch_id} request {result.get('custom_id')} failed: "
+                                       f"{result.get('error') or response.get('status_code')}")
+            continue
+
+        # custom_id is "user-<id>-q<questions>"
+        _, user_id, questions = result["custom_id"].split("-")
+        body = response["body"]
+        usage = body.get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        _, _, cost = calculate_cost(prompt_tokens, completion_tokens, model=body.get("model"))
+
+        db.session.add(UserAnalysis(
+            user_id=int(user_id),
+            batch_id=analysis_batch.id,
+            content=body["choices"][0]["message"]["content"],
+            questions_count=int(questions[1:]),
+            model=body.get("model"),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost=cost * Config.BATCH_PRICE_RATIO
+        ))
+        ingested += 1
+    return ingested
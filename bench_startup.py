@@ -0,0 +1,120 @@
+"""
+Startup-time benchmark: how long a fresh process takes to import the app and
+build it with create_app(), as a gunicorn worker or an admin script would.
+
+    python bench_startup.py                  # 10 fresh interpreters, median per stage
+    python bench_startup.py --runs 20 --importtime 25
+    python bench_startup.py --client --json  # also time the first get_client()
+
+Each run starts a new interpreter so nothing is already imported. create_app()
+runs against a temporary SQLite database. --importtime lists the modules with
+the largest cumulative import time (from python -X importtime), which shows
+what to defer next.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+# Runs in the child interpreter; the last stdout line is the JSON result
+_CHILD = r'''
+import json, sys, time
+started = time.perf_counter()
+marks = {}
+import config
+marks["import config"] = time.perf_counter()
+import extensions
+marks["import extensions"] = time.perf_counter()
+import app
+marks["import app"] = time.perf_counter()
+
+class BenchConfig(config.Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite:///" + sys.argv[1]
+
+app.create_app(BenchConfig)
+marks["create_app()"] = time.perf_counter()
+if sys.argv[2] == "1":
+    extensions.get_client()
+    marks["get_client()"] = time.perf_counter()
+loaded = sorted(name for name in ("openai", "httpx", "tools_api", "chat_api") if name in sys.modules)
+previous, stages = started, {}
+for stage, mark in marks.items():
+    stages[stage] = mark - previous
+    previous = mark
+print(json.dumps({"stages": stages, "total": previous - started, "loaded": loaded}))
+'''
+
+def _run_child(database, with_client, importtime=False):
+    """Run one fresh interpreter. Returns (result dict, stderr text)."""
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", _CHILD, database, "1" if with_client else "0"]
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Startup failed:\n{completed.stderr[-2000:]}")
+    return json.loads(completed.stdout.strip().splitlines()[-1]), completed.stderr
+
+def parse_importtime(stderr, top):
+    """
+    Parse `python -X importtime` output.
+    Returns:
+        list: (cumulative seconds, module) for the slowest imports first; the indent of
+              module shows how deeply it was imported.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cumulative) / 1e6, name.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure app import and create_app() time in fresh interpreters.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--client', action='store_true', help="Also build the OpenAI client (first LLM call cost)")
+    parser.add_argument('--importtime', type=int, default=0, metavar="N", help="Show the N slowest imports")
+    parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+    args = parser.parse_args()
+
+    env_note = "" if os.getenv("OPENAI_API_KEY") or os.getenv("OPENAI_FAKE") else " (set OPENAI_FAKE=true to time get_client() without a key)"
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, "bench.db")
+        _run_child(database, False) # Warm the filesystem cache and create the tables once
+        for _ in range(args.runs):
+            results.append(_run_child(database, args.client)[0])
+        slowest = parse_importtime(_run_child(database, args.client, importtime=True)[1], args.importtime) if args.importtime else []
+
+    stages = {stage: [r["stages"][stage] for r in results] for stage in results[0]["stages"]}
+    report = {
+        "runs": args.runs,
+        "stages": {stage: {"median": statistics.median(v), "min": min(v), "max": max(v)} for stage, v in stages.items()},
+        "total": {"median": statistics.median(r["total"] for r in results), "min": min(r["total"] for r in results)},
+        "loaded_after_startup": results[0]["loaded"],
+        "slowest_imports": [{"module": name, "seconds": seconds} for seconds, name in slowest]
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"\nStartup over {args.runs} fresh interpreters{env_note if args.client else ''}\n")
+    print(f"{'stage':<22}{'median':>10}{'min':>10}{'max':>10}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<22}{row['median']:>10.3f}{row['min']:>10.3f}{row['max']:>10.3f}")
+    print(f"{'total':<22}{report['total']['median']:>10.3f}{report['total']['min']:>10.3f}")
+    print(f"\nLoaded after startup: {', '.join(report['loaded_after_startup']) or '-'}")
+    if slowest:
+        print("\nSlowest imports (cumulative seconds):")
+        for seconds, name in slowest:
+            print(f"{seconds:>8.3f}  {name}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app
 from flask_login import login_required, current_user
+from datetime import datetime, timedelta
 
-from models import User, Chat, Message
-from extensions import db, client
+from models import User, Chat, Message, AnalysisBatch, UserAnalysis
+from extensions import db
+from config import Config
+from utils import calculate_cost
+import batch_analysis
+import metrics
+import concurrency
+import llm
+import model_router
+from batch_analysis import get_user_questions, format_user_questions, build_analysis_messages
+from tools_api import tool_response_cache
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin', template_folder='../templates')
 
@@ -86,34 +96,35 @@ def analyze_user_questions(user_id):
     user = User.query.get_or_404(user_id)
     
     # Get all user messages across all their chats
-    all_user_messages = Message.query.join(Chat).filter(
-        Chat.user_id == user_id, 
-        Message.role == 'user'
-    ).order_by(Message.timestamp).all()
+    all_user_messages = get_user_questions(user_id)
     
     if not all_user_messages:
         flash("該用戶沒有提問記錄", "warning")
         return redirect(url_for('.admin_chats', user_id=user_id))
     
-    # Format questions for the API
-    questions_text = f"學生: {user.username}\n\n"
-    for i, msg in enumerate(all_user_messages, 1):
-        chat_category = msg.chat.category # Get category from related chat
-        timestamp_str = msg.timestamp.strftime("%Y-%m-%d %H:%M:%S")
-        questions_text += f"問題 {i} ({chat_category} - {timestamp_str}):\n{msg.content}\n\n"
-    
     try:
         # Call OpenAI API for analysis
-        response = client.chat.completions.create(
-            model="o3-mini", # Consider making this configurable
-            messages=[
-                {"role": "system", "content": "你是一位經驗豐富的GMAT老師，請詳細分析這位同學詢問的問題集，指出他在GMAT各個考點上的具體弱項概念，並提供針對性的學習建議。"},
-                {"role": "user", "content": questions_text}
-            ],
-            stream=False
-        )
+        response = llm.create_chat_completion({
+            "model": Config.ANALYSIS_MODEL,
+            "messages": build_analysis_messages(format_user_questions(user, all_user_messages)),
+            "stream": False
+        }, 'analysis')
         
         analysis_result = response.choices[0].message.content
+
+        # Persist the analysis alongside batch results
+        prompt_tokens = response.usage.prompt_tokens if response.usage else 0
+        completion_tokens = response.usage.completion_tokens if response.usage else 0
+        db.session.add(UserAnalysis(
+            user_id=user_id,
+            content=analysis_result,
+            questions_count=len(all_user_messages),
+            model=Config.ANALYSIS_MODEL,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cost=calculate_cost(prompt_tokens, completion_tokens, model=Config.ANALYSIS_MODEL)[2]
+        ))
+        db.session.commit()
         
         # Store results in session for display on another page
         session['analysis_result'] = analysis_result
@@ -124,6 +135,7 @@ def analyze_user_questions(user_id):
         return redirect(url_for('.show_analysis_result'))
         
     except Exception as e:
+        db.session.rollback()
         flash(f"使用 AI 分析時出現錯誤: {str(e)}", "danger")
         current_app.logger.error(f"Error analyzing user questions for {user_id}: {str(e)}")
         return redirect(url_for('.admin_chats', user_id=user_id))
@@ -151,4 +163,115 @@ def show_analysis_result():
                           analysis_result=analysis_result, 
                           user_id=user_id,
                           user_name=user_name,
-                          questions_count=questions_count) 
\ No newline at end of file
+                          questions_count=questions_count) 
+
+@admin_bp.route("/cache_stats")
+@admin_required
+def cache_stats():
+    """Return hit/miss counters of the tool response cache (this process only)."""
+    return jsonify({
+        'status': 'success',
+        'tool_response_cache': tool_response_cache.stats()
+    })
+
+@admin_bp.route("/prompt_cache_report")
+@admin_required
+def prompt_cache_report():
+    """Aggregate OpenAI prompt-cache hits per chat instruction / tool type."""
+    days = request.args.get('days', type=int)
+    query = db.session.query(
+        Message.instruction,
+        db.func.count(Message.id),
+        db.func.coalesce(db.func.sum(Message.prompt_tokens), 0),
+        db.func.coalesce(db.func.sum(Message.cached_tokens), 0)
+    ).filter(Message.role == 'assistant')
+    if days:
+        query = query.filter(Message.timestamp >= datetime.utcnow() - timedelta(days=days))
+    rows = query.group_by(Message.instruction).all()
+
+    report = []
+    for instruction, replies, prompt_tokens, cached_tokens in rows:
+        report.append({
+            'instruction': instruction or 'unknown',
+            'replies': replies,
+            'prompt_tokens': prompt_tokens,
+            'cached_tokens': cached_tokens,
+            'cached_share': round(cached_tokens / prompt_tokens, 4) if prompt_tokens else 0.0
+        })
+    report.sort(key=lambda row: row['prompt_tokens'], reverse=True)
+    return jsonify({'status': 'success', 'days': days, 'instructions': report})
+
+@admin_bp.route("/analysis_batches", methods=["POST"])
+@admin_required
+def submit_analysis_batch():
+    """Submit every student's questions for analysis through the Batch API."""
+    days = request.form.get('days', type=int)
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    try:
+        analysis_batch = batch_analysis.submit_batch(since=since)
+    except Exception as e:
+        db.session.rollback()
+        flash(f"提交批次分析時出現錯誤: {str(e)}", "danger")
+        current_app.logger.error(f"Error submitting analysis batch: {str(e)}")
+        return redirect(url_for('.admin_chats'))
+
+    if not analysis_batch:
+        flash("沒有可分析的提問記錄", "warning")
+    else:
+        flash(f"已提交批次分析 {analysis_batch.batch_id}（{analysis_batch.request_count} 位學生）", "success")
+    return redirect(url_for('.admin_chats'))
+
+@admin_bp.route("/analysis_batches")
+@admin_required
+def list_analysis_batches():
+    """List analysis batches, polling unfinished ones for results."""
+    batches = AnalysisBatch.query.order_by(AnalysisBatch.created_at.desc()).limit(20).all()
+    for analysis_batch in batches:
+        if analysis_batch.status not in batch_analysis.FINAL_STATUSES or analysis_batch.status == 'completed':
+            try:
+                batch_analysis.poll_batch(analysis_batch)
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"Error polling batch {analysis_batch.batch_id}: {str(e)}")
+    return jsonify({
+        'status': 'success',
+        'batches': [{
+            'id': b.id,
+            'batch_id': b.batch_id,
+            'backend': b.backend,
+            'status': b.status,
+            'request_count': b.request_count,
+            'ingested': len(b.analyses),
+            'error': b.error,
+            'created_at': b.created_at.isoformat() if b.created_at else None,
+            'completed_at': b.completed_at.isoformat() if b.completed_at else None
+        } for b in batches]
+    })
+
+@admin_bp.route("/analysis/<int:user_id>/latest")
+@admin_required
+def latest_user_analysis(user_id):
+    """Display the most recent stored analysis (batch or synchronous) for a user."""
+    user = User.query.get_or_404(user_id)
+    analysis = UserAnalysis.query.filter_by(user_id=user_id).order_by(UserAnalysis.created_at.desc()).first()
+    if not analysis:
+        flash("該用戶尚無分析結果", "warning")
+        return redirect(url_for('.admin_chats', user_id=user_id))
+
+    return render_template("analysis_result.html",
+                          analysis_result=analysis.content,
+                          user_id=user_id,
+                          user_name=user.username,
+                          questions_count=analysis.questions_count)
+
+@admin_bp.route("/metrics")
+@admin_required
+def llm_metrics():
+    """Return OpenAI transport metrics (pool wait, upstream latency, retries, concurrency, ...) for this process."""
+    return jsonify({
+        'status': 'success',
+        'metrics': metrics.snapshot(),
+        'breakers': llm.breaker_states(),
+        'concurrency': concurrency.limiter_states(),
+        'model_latency': model_router.latency_snapshot()
+    })
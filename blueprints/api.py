@@ -1,9 +1,10 @@
 from flask import Blueprint, jsonify
 from flask_login import login_required, current_user
-from datetime import datetime
 
-from models import Message, Chat # Import models
+from models import LLMJob # Import models
 import token_manager # Import token manager functions
+import job_queue
+import usage_ledger
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
@@ -12,23 +13,21 @@ api_bp = Blueprint('api', __name__, url_prefix='/api')
 def get_user_stats():
     """Get current user's API usage statistics."""
     try:
-        # Get balance and reset time from token_manager
-        balance = token_manager.get_balance(current_user.id)
-        next_reset = token_manager.get_next_reset_time()
-        days_until_reset = (next_reset - datetime.utcnow()).days
+        # Get balance and reset time from the request's balance context (token_manager)
+        balance_context = token_manager.get_balance_context()
+        balance = balance_context.balance
+        days_until_reset = balance_context.days_until_reset
         
-        # Calculate total tokens and cost from Message model
-        # This approach queries the DB each time. Consider UserQuota for optimization if needed.
-        messages = Message.query.join(Chat).filter(Chat.user_id == current_user.id).all()
-        total_prompt_tokens = sum(msg.prompt_tokens for msg in messages)
-        total_completion_tokens = sum(msg.completion_tokens for msg in messages)
-        total_tokens = total_prompt_tokens + total_completion_tokens
-        total_cost = sum(msg.cost for msg in messages)
+        # Totals come from the rollups maintained with the usage ledger: one row lookup each
+        total_tokens, total_cost = usage_ledger.get_totals(current_user.id)
+        today = usage_ledger.get_daily(current_user.id)
         
         return jsonify({
             'status': 'success',
             'total_tokens': total_tokens,
             'total_cost': round(total_cost, 6), # Round cost for display
+            'today_tokens': today['prompt_tokens'] + today['completion_tokens'],
+            'today_cost': round(today['cost'], 6),
             'balance': round(balance, 6), # Round balance for display
             'days_until_reset': days_until_reset
         })
@@ -39,4 +38,19 @@ def get_user_stats():
         return jsonify({
             'status': 'error',
             'message': '獲取用戶統計數據時發生內部錯誤。'
-        }), 500 
\ No newline at end of file
+        }), 500 
+
+@api_bp.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def get_job_status(job_id):
+    """Poll the status of a background LLM job owned by the current user."""
+    job = LLMJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({
+            'status': 'error',
+            'message': '找不到該任務。'
+        }), 404
+    return jsonify({
+        'status': 'success',
+        'job': job_queue.job_status(job)
+    })
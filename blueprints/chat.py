@@ -1,11 +1,16 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, current_app
 from flask_login import login_required, current_user
-from datetime import datetime
 
 from models import Chat, Message
-from extensions import db, client
-from utils import calculate_cost, init_conversation
+from extensions import db
+from chat_api import (complete_chat, complete_fanout, stream_chat, estimate_turn_cost, estimate_fanout_cost,
+                      sse_event, busy_response, chat_route_key)
+from utils import insufficient_balance_message
 import token_manager # Import token manager functions
+import job_queue
+import model_router
+from llm import CircuitOpenError
+from rate_limit import rate_limited
 
 chat_bp = Blueprint('chat', __name__, template_folder='../templates')
 
@@ -14,8 +19,10 @@ def index():
     """Main index page."""
     return render_template("index.html")
 
-def handle_chat(category, template_name):
-    """Generic chat handling function."""
+VALID_CHAT_CATEGORIES = ['quant', 'verbal', 'graph']
+
+def _get_active_chat_id(category):
+    """Return the active chat ID from session, creating a new chat if none exists."""
     active_chat_id = session.get('active_chat_id')
     
     if not active_chat_id:
@@ -26,9 +33,97 @@ def handle_chat(category, template_name):
         session['active_chat_id'] = new_chat.id
         active_chat_id = new_chat.id # Update active_chat_id for the current request
         session['current_instruction'] = 'simple_explain' # Set default instruction for new chat
+    return active_chat_id
+
+def _switch_instruction(active_chat_id, submitted_instruction):
+    """
+    Update the session instruction and stage a mode-switch notice if it changed.
+    Returns:
+        Message or None: The staged system notification (committed with the user message).
+    """
+    if submitted_instruction == session.get('current_instruction', 'simple_explain'):
+        return None
+
+    # Instruction has changed, update session and prepare notification
+    session['current_instruction'] = submitted_instruction
+    notification_message = Message(
+        chat_id=active_chat_id,
+        role="system",
+        content=f'<i class="fas fa-info-circle me-2"></i>已切換到 {submitted_instruction} 模式' 
+    )
+    # Add to session, commit later with user message
+    db.session.add(notification_message)
+    return notification_message
+
+def _save_user_message(active_chat_id, user_input):
+    """Save the user message (and any staged notification) in one commit."""
+    user_message = Message(
+        chat_id=active_chat_id,
+        role="user",
+        content=user_input
+    )
+    db.session.add(user_message)
+    db.session.commit()
+    return user_message
+
+def _fanout_instructions():
+    """Instructions ticked for a multi-mode turn (first one primary), or [] for a normal turn."""
+    if not current_app.config['CHAT_FANOUT_ENABLED']:
+        return []
+    instructions = list(dict.fromkeys(i for i in request.form.getlist('fanout_instructions') if i))
+    instructions = instructions[:current_app.config['CHAT_FANOUT_MAX_INSTRUCTIONS']]
+    return instructions if len(instructions) >= 2 else []
+
+def _run_chat_turn(active_chat_id, instruction_to_use, request_params=None, fanout_requests=None, hold_id=None):
+    """
+    Call the API for the latest user message and save the reply, flashing any error.
+    Args:
+        request_params (dict, optional): The request routed and priced by the pre-flight estimate.
+        fanout_requests (dict, optional): Instruction -> routed request for a multi-mode turn.
+        hold_id (int, optional): The turn's balance hold, settled when the reply is charged.
+    Returns:
+        float or None: The new balance, or None if nothing was deducted.
+    """
+    try:
+        if fanout_requests:
+            ai_messages, new_balance, errors = complete_fanout(active_chat_id, current_user.id,
+                                                               list(fanout_requests), fanout_requests, hold_id)
+            for instruction, error in errors.items():
+                flash(f"{instruction} 模式產生失敗: {str(error)}", "warning")
+            ai_message = ai_messages[0]
+        else:
+            ai_message, new_balance = complete_chat(active_chat_id, current_user.id, instruction_to_use, request_params,
+                                                    hold_id)
+
+        current_app.logger.debug(f"AI message committed successfully. ID: {ai_message.id}")
+
+        if new_balance is not None and new_balance <= 0:
+            flash("您的API餘額已用完。", "warning")
+        return new_balance
+
+    except CircuitOpenError as e:
+        # Upstream is failing; fail fast without charging
+        flash(str(e), "warning")
+        db.session.rollback()
+        return None
+    except Exception as e:
+        flash(f"與 AI 服務溝通或處理回應時發生錯誤: {str(e)}", "danger")
+        current_app.logger.error(f"Error in API/Commit block: {str(e)}")
+        db.session.rollback() # Rollback potential AI message commit
+        return None
+
+def _chat_stream_url(category):
+    """Streaming endpoint for the chat form, or None when replies come from the job queue."""
+    if current_app.config['LLM_JOB_QUEUE_ENABLED']:
+        return None
+    return url_for('chat.chat_stream', category=category)
+
+def handle_chat(category, template_name):
+    """Generic chat handling function."""
+    active_chat_id = _get_active_chat_id(category)
+    pending_job_id = None # Set when the reply is produced by a background worker
     
-    # Get current balance for display
-    current_balance = token_manager.get_balance(current_user.id)
+    # The balance shown on the page comes from the request's balance_context (token_manager)
     # Get instruction from session, default to simple_explain
     current_session_instruction = session.get('current_instruction', 'simple_explain')
     
@@ -36,164 +131,146 @@ def handle_chat(category, template_name):
         user_input = request.form.get('user_input', '').strip()
         # Get the instruction submitted with this request
         submitted_instruction = request.form.get('instruction', 'simple_explain')
-        
-        # Remove the block handling empty POST requests for mode switch
-        # if not user_input and instruction != current_instruction: ... (REMOVED)
+                
+        # Several ticked instructions answer the question in all of them at once
+        fanout_instructions = _fanout_instructions()
+        fanout_requests = None
                 
         # Handle user input
         if user_input:
-            # Set instruction_to_use based on the current submission first.
-            instruction_to_use = submitted_instruction 
-            notification_message = None # Initialize notification message
-
-            # Check if instruction changed compared to the session
-            if submitted_instruction != current_session_instruction:
-                # Instruction has changed, update session and prepare notification
-                session['current_instruction'] = submitted_instruction
-                current_session_instruction = submitted_instruction # Update local var for this request
-                # instruction_to_use is already set correctly above
-                
-                # Prepare system message notification for mode change
-                notification_message = Message(
-                    chat_id=active_chat_id,
-                    role="system",
-                    content=f'<i class="fas fa-info-circle me-2"></i>已切換到 {instruction_to_use} 模式' 
-                )
-                # Add to session, commit later with user message
-                db.session.add(notification_message) 
-
-            # Check balance before proceeding
-            has_balance, balance = token_manager.check_balance(current_user.id)
-            if not has_balance:
-                flash(f"您的API餘額不足 ({balance:.4f} 元)，請等待下週日重置。", "warning")
+            instruction_to_use = fanout_instructions[0] if fanout_instructions else submitted_instruction
+            current_session_instruction = instruction_to_use
+
+            # Pre-flight: estimate the turn's worst-case cost locally and hold it against the balance,
+            # so parallel requests can't together spend more than the user has
+            if fanout_instructions:
+                estimated_cost, fanout_requests = estimate_fanout_cost(active_chat_id, fanout_instructions, user_input)
+                request_params = None
             else:
-                # Save user message (and notification if it exists)
-                user_message = Message(
-                    chat_id=active_chat_id,
-                    role="user",
-                    content=user_input
-                )
-                db.session.add(user_message)
-                
+                estimated_cost, request_params = estimate_turn_cost(active_chat_id, instruction_to_use, user_input)
+            hold_id, balance = token_manager.reserve(current_user.id, estimated_cost)
+            if hold_id is None:
+                flash(insufficient_balance_message(balance, estimated_cost), "warning")
+            else:
+                if fanout_instructions:
+                    # No mode-switch notice: the replies are labelled by their tabs
+                    session['current_instruction'] = instruction_to_use
+                else:
+                    _switch_instruction(active_chat_id, submitted_instruction)
                 try:
-                    db.session.commit() # Commit user message and potential notification together
+                    _save_user_message(active_chat_id, user_input) # Commit user message and potential notification together
                 except Exception as e:
                     db.session.rollback()
+                    token_manager.settle(current_user.id, hold_id)
                     flash(f"保存消息時出錯: {str(e)}", "danger")
                     # Re-fetch messages and render template with error
                     messages = Message.query.filter_by(chat_id=active_chat_id).order_by(Message.timestamp).all()
-                    next_reset = token_manager.get_next_reset_time()
-                    days_until_reset = (next_reset - datetime.utcnow()).days
-                    return render_template(template_name, messages=messages, api_balance=balance, days_until_reset=days_until_reset, default_instruction=current_session_instruction)
+                    return render_template(template_name, messages=messages, default_instruction=current_session_instruction,
+                                          stream_url=_chat_stream_url(category))
                 
                 # --- API Call Section --- 
-                try:
-                    # Prepare messages for OpenAI API using instruction_to_use
-                    current_system_prompt = init_conversation(instruction_to_use)[0] 
-                    messages_for_api = [current_system_prompt]
-                    
-                    # Fetch history (excluding system messages)
-                    history = Message.query.filter(
-                        Message.chat_id == active_chat_id, 
-                        Message.role != 'system'
-                    ).order_by(Message.timestamp).all()
-                    
-                    # Make sure user_message (committed above) is included in history for API
-                    messages_for_api.extend([{"role": msg.role, "content": msg.content} for msg in history])
-
-                    # Get previous response ID
-                    previous_response_id = None
-                    # Fetch the latest assistant message BEFORE the current user message was added
-                    # Note: This logic might need adjustment if commits happen differently
-                    last_ai_message = Message.query.filter(
-                        Message.chat_id == active_chat_id, 
-                        Message.role == 'assistant'
-                    ).order_by(Message.timestamp.desc()).first()
-                    if last_ai_message and last_ai_message.response_id:
-                        previous_response_id = last_ai_message.response_id
-
-                    # Call OpenAI API
-                    request_params = {
-                        "model": "o3-mini",
-                        "messages": messages_for_api,
-                        "stream": False
-                    }
-                    # Remove previous_response_id if it causes issues
-                    # if previous_response_id:
-                    #    request_params["response_id"] = previous_response_id
-                    
-                    response = client.chat.completions.create(**request_params)
-                    model_reply = response.choices[0].message.content
-                    response_id = getattr(response, 'id', None)
-
-                    # --- Start Debug Prints ---
-                    print(f"DEBUG: API call successful. Response ID: {response_id}")
-                    print(f"DEBUG: AI Reply content (first 100 chars): {model_reply[:100] if model_reply else 'None'}")
-                    # --- End Debug Prints ---
-                    
-                    # Calculate cost and deduct balance
-                    prompt_tokens = completion_tokens = 0
-                    turn_cost = 0.0
-                    if hasattr(response, 'usage'):
-                        prompt_tokens = response.usage.prompt_tokens
-                        completion_tokens = response.usage.completion_tokens
-                        cached_tokens = 0
-                        if hasattr(response.usage, 'prompt_tokens_details') and response.usage.prompt_tokens_details and hasattr(response.usage.prompt_tokens_details, 'cached_tokens'):
-                            cached_tokens = response.usage.prompt_tokens_details.cached_tokens
-                        _, _, turn_cost = calculate_cost(prompt_tokens, completion_tokens, cached_tokens)
-                        new_balance = token_manager.deduct_balance(current_user.id, turn_cost)
-                        current_balance = new_balance # Update balance for display
-                        if new_balance <= 0:
-                            flash("您的API餘額已用完。", "warning")
-                    
-                    # Save AI message
-                    ai_message = Message(
-                        chat_id=active_chat_id,
-                        role="assistant",
-                        content=model_reply,
-                        prompt_tokens=prompt_tokens,
-                        completion_tokens=completion_tokens,
-                        cost=turn_cost,
-                        response_id=response_id
-                    )
-                    db.session.add(ai_message)
-                    # --- Start Debug Prints ---
-                    print(f"DEBUG: AI Message object created and added to session.")
-                    # --- End Debug Prints ---
-                    db.session.commit() # Commit the AI message
-                    # --- Start Debug Prints ---
-                    print(f"DEBUG: AI Message committed successfully. ID: {ai_message.id}") 
-                    # --- End Debug Prints ---
-                
-                except Exception as e:
-                    flash(f"與 AI 服務溝通或處理回應時發生錯誤: {str(e)}", "danger")
-                    # --- Start Debug Prints ---
-                    print(f"ERROR in API/Commit block: {str(e)}") 
-                    # --- End Debug Prints ---
-                    db.session.rollback() # Rollback potential AI message commit
+                if current_app.config['LLM_JOB_QUEUE_ENABLED']:
+                    # Hand the API call to a worker; the page polls for the result
+                    # The worker sends the estimated requests and settles the hold when the job finishes
+                    if fanout_instructions:
+                        pending_job_id = job_queue.enqueue('chat_fanout', current_user.id, active_chat_id,
+                                                           instructions=fanout_instructions,
+                                                           requests_by_instruction=fanout_requests, hold_id=hold_id).id
+                    else:
+                        pending_job_id = job_queue.enqueue('chat', current_user.id, active_chat_id,
+                                                           instruction=instruction_to_use,
+                                                           request_params=request_params, hold_id=hold_id).id
+                else:
+                    try:
+                        _run_chat_turn(active_chat_id, instruction_to_use, request_params, fanout_requests, hold_id)
+                    finally:
+                        # Charging the reply settled the hold; this releases it if the call failed
+                        token_manager.settle(current_user.id, hold_id)
 
     # Fetch messages for rendering
     messages = []
     if active_chat_id:
         messages = Message.query.filter_by(chat_id=active_chat_id).order_by(Message.timestamp).all()
     
-    # Get reset time for display
-    next_reset = token_manager.get_next_reset_time()
-    days_until_reset = (next_reset - datetime.utcnow()).days
-    
     return render_template(template_name, 
                           messages=messages, 
-                          api_balance=current_balance,
-                          days_until_reset=days_until_reset,
                           # Pass current instruction from session for default selection
-                          default_instruction=current_session_instruction)
+                          default_instruction=current_session_instruction,
+                          # Form submissions are streamed through this endpoint when JS is available
+                          stream_url=_chat_stream_url(category),
+                          # Multi-mode turns (several instructions at once) are posted to this view
+                          fanout_enabled=current_app.config['CHAT_FANOUT_ENABLED'],
+                          pending_job_id=pending_job_id)
+
+@chat_bp.route("/<category>/stream", methods=["POST"])
+@login_required
+@rate_limited('chat', json_response=True)
+def chat_stream(category):
+    """Stream the assistant reply for a chat turn as Server-Sent Events."""
+    if category not in VALID_CHAT_CATEGORIES:
+        return jsonify({'status': 'error', 'message': '無效的聊天類型'}), 404
+
+    user_input = request.form.get('user_input', '').strip()
+    if not user_input:
+        return jsonify({'status': 'error', 'message': '請輸入內容'}), 400
+
+    active_chat_id = _get_active_chat_id(category)
+    instruction_to_use = request.form.get('instruction', 'simple_explain')
+
+    # Admission control: reject before saving anything when the model's queue is full
+    try:
+        model_router.check_admission(chat_route_key(instruction_to_use))
+    except CircuitOpenError as e:
+        return busy_response(e)
+
+    # Pre-flight: estimate the turn's worst-case cost locally and hold it against the balance
+    estimated_cost, request_params = estimate_turn_cost(active_chat_id, instruction_to_use, user_input, stream=True)
+    hold_id, balance = token_manager.reserve(current_user.id, estimated_cost)
+    if hold_id is None:
+        return jsonify({
+            'status': 'error',
+            'message': insufficient_balance_message(balance, estimated_cost)
+        }), 402
+
+    notification_message = _switch_instruction(active_chat_id, instruction_to_use)
+    try:
+        _save_user_message(active_chat_id, user_input)
+    except Exception as e:
+        db.session.rollback()
+        token_manager.settle(current_user.id, hold_id)
+        return jsonify({'status': 'error', 'message': f"保存消息時出錯: {str(e)}"}), 500
+
+    user_id = current_user.id
+    notification_html = notification_message.content if notification_message else None
+
+    def generate():
+        yield sse_event("start", {"notification": notification_html, "estimated_cost": estimated_cost})
+        try:
+            for event, data in stream_chat(active_chat_id, user_id, instruction_to_use, request_params, hold_id):
+                if event == "delta":
+                    yield sse_event("delta", {"content": data})
+                else:
+                    yield sse_event("done", data)
+        except CircuitOpenError as e:
+            db.session.rollback()
+            yield sse_event("error", {"message": str(e), "retry_after": e.retry_after})
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error in streaming API/Commit block: {str(e)}")
+            yield sse_event("error", {"message": f"與 AI 服務溝通或處理回應時發生錯誤: {str(e)}"})
+        finally:
+            # Also runs if the client disconnects mid-stream; an unstarted stream's hold is reaped
+            token_manager.settle(user_id, hold_id)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @chat_bp.route("/new_chat/<category>")
 @login_required
 def new_chat(category):
     """Start a new chat session."""
-    valid_categories = ['quant', 'verbal', 'graph'] # Define valid categories
-    if category not in valid_categories:
+    if category not in VALID_CHAT_CATEGORIES:
         flash("無效的聊天類型", "danger")
         return redirect(url_for('chat.index'))
         
@@ -249,15 +326,18 @@ def load_chat(chat_id):
 # Specific chat routes calling handle_chat
 @chat_bp.route("/quant", methods=["GET", "POST"])
 @login_required
+@rate_limited('chat')
 def quant_chat():
     return handle_chat("quant", "quant_chat.html")
 
 @chat_bp.route("/verbal", methods=["GET", "POST"])
 @login_required
+@rate_limited('chat')
 def verbal_chat():
     return handle_chat("verbal", "verbal_chat.html")
 
 @chat_bp.route("/graph", methods=["GET", "POST"])
 @login_required
+@rate_limited('chat')
 def graph_chat():
     return handle_chat("graph", "graph_chat.html") 
\ No newline at end of file
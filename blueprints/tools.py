@@ -1,11 +1,18 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context, current_app
 from flask_login import login_required, current_user
 from datetime import datetime
 
 from models import Chat, Message
 from extensions import db
 import token_manager # Import token manager functions
-from tools_api import process_tool_request # Import the unified tool processor
+from tools_api import process_tool_request, process_tool_request_stream, save_tool_message, estimate_tool_cost # Import the unified tool processors
+from chat_api import sse_event, busy_response
+from utils import insufficient_balance_message
+import job_queue
+import tool_registry # Tool cards per category come from tool_registry.json
+import model_router
+from llm import CircuitOpenError
+from rate_limit import rate_limited
 
 tools_bp = Blueprint('tools', __name__, url_prefix='/tools', template_folder='../templates')
 
@@ -29,20 +36,12 @@ def handle_tool_request(tool_category, template_name, supported_tools=None):
             flash("請選擇一個工具或指令", "warning")
             return redirect(url_for('.' + tool_category + '_tool', chat_id=chat_id))
 
-        # Check balance
-        has_balance, balance = token_manager.check_balance(current_user.id)
-        if not has_balance:
-            flash(f"您的API餘額不足 ({balance:.4f} 元)，請等待下週日重置。", "warning")
+        # Pre-flight: hold the request's locally estimated worst-case cost against the balance
+        estimated_cost = estimate_tool_cost(tool_type, user_input)
+        hold_id, balance = token_manager.reserve(current_user.id, estimated_cost)
+        if hold_id is None:
+            flash(insufficient_balance_message(balance, estimated_cost), "warning")
         else:
-            # Get previous response ID
-            previous_response_id = None
-            last_ai_message = Message.query.filter_by(
-                chat_id=chat_id, 
-                role='assistant'
-            ).order_by(Message.timestamp.desc()).first()
-            if last_ai_message and last_ai_message.response_id:
-                previous_response_id = last_ai_message.response_id
-            
             # Save user message first
             user_message = Message(
                 role='user',
@@ -53,42 +52,27 @@ def handle_tool_request(tool_category, template_name, supported_tools=None):
             db.session.add(user_message)
             db.session.commit() # Commit user message before API call
 
+            if current_app.config['LLM_JOB_QUEUE_ENABLED']:
+                # Hand the API call to a worker; the GET page polls for the result and the worker settles the hold
+                job = job_queue.enqueue('tool', current_user.id, chat_id, tool_type=tool_type,
+                                        user_input=user_input, hold_id=hold_id)
+                return redirect(url_for('.' + tool_category + '_tool', chat_id=chat_id, tool_type=tool_type, job_id=job.id))
+
             # Process tool request via tools_api
             # Pass user_id for balance deduction in tools_api
-            result = process_tool_request(tool_type, user_input, current_user.id, previous_response_id)
+            try:
+                result = process_tool_request(tool_type, user_input, current_user.id, hold_id)
+            finally:
+                # Charging the reply settled the hold; this releases it if the call failed
+                token_manager.settle(current_user.id, hold_id)
             
-            ai_content = ""
-            response_id = None
-            prompt_tokens = 0
-            completion_tokens = 0
-            cost = 0.0
-
+            ai_message = save_tool_message(chat_id, result, tool_type, current_user.id)
             if result['status'] == 'success':
-                ai_content = result['content']
-                response_id = result.get('response_id')
-                prompt_tokens = result.get('tokens', {}).get('input', 0)
-                completion_tokens = result.get('tokens', {}).get('output', 0)
-                cost = result.get('cost', 0.0)
                 # Balance is already deducted in process_tool_request
                 if token_manager.get_balance(current_user.id) <= 0:
                      flash("您的API餘額已用完。", "warning")
             else:
-                ai_content = f"處理請求時發生錯誤: {result['message']}"
-                flash(ai_content, "danger")
-            
-            # Save AI message (even if error occurred, to show feedback)
-            ai_message = Message(
-                role='assistant',
-                content=ai_content,
-                timestamp=datetime.utcnow(),
-                chat_id=chat_id,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                cost=cost,
-                response_id=response_id
-            )
-            db.session.add(ai_message)
-            db.session.commit()
+                flash(ai_message.content, "danger")
         
         # Redirect to GET to show results and prevent resubmission
         # Pass the selected tool type back to the template via args
@@ -120,44 +104,102 @@ def handle_tool_request(tool_category, template_name, supported_tools=None):
         session['tool_chat_id'] = new_chat.id
         messages = [] # Start with empty messages for new chat
 
-    # Get balance and reset time
-    current_balance = token_manager.get_balance(current_user.id)
-    next_reset = token_manager.get_next_reset_time()
-    days_until_reset = (next_reset - datetime.utcnow()).days
-    
+    # Balance and reset time reach the template as balance_context (token_manager)
     # Pass supported_tools and selected_tool (tool_type) to template
     return render_template(template_name, 
                           messages=messages, 
-                          api_balance=current_balance,
-                          days_until_reset=days_until_reset,
                           supported_tools=supported_tools,
-                          selected_tool=tool_type)
+                          selected_tool=tool_type,
+                          # Preselect the first tool of the page when none was chosen yet
+                          default_instruction=supported_tools[0]['id'] if supported_tools else None,
+                          # Form submissions are streamed through this endpoint unless replies come from the job queue
+                          stream_url=None if current_app.config['LLM_JOB_QUEUE_ENABLED'] else url_for('.tool_stream', tool_category=tool_category),
+                          pending_job_id=request.args.get('job_id', type=int))
+
+@tools_bp.route('/<tool_category>_tool/stream', methods=['POST'])
+@login_required
+@rate_limited('tools', json_response=True)
+def tool_stream(tool_category):
+    """Stream the AI reply of a tool request as Server-Sent Events."""
+    user_input = request.form.get('user_input')
+    tool_type = request.form.get('instruction') or request.form.get('tool_type')
+    chat_id = session.get('tool_chat_id')
+
+    if not chat_id:
+        return jsonify({'status': 'error', 'message': "沒有活動的工具聊天會話"}), 400
+    if not user_input:
+        return jsonify({'status': 'error', 'message': "請輸入內容"}), 400
+    if not tool_type:
+        return jsonify({'status': 'error', 'message': "請選擇一個工具或指令"}), 400
+
+    # Admission control: reject before saving anything when the model's queue is full
+    try:
+        model_router.check_admission(tool_type)
+    except CircuitOpenError as e:
+        return busy_response(e)
+
+    # Pre-flight: hold the request's locally estimated worst-case cost against the balance
+    estimated_cost = estimate_tool_cost(tool_type, user_input)
+    hold_id, balance = token_manager.reserve(current_user.id, estimated_cost)
+    if hold_id is None:
+        return jsonify({
+            'status': 'error',
+            'message': insufficient_balance_message(balance, estimated_cost)
+        }), 402
+
+    # Save user message first
+    user_message = Message(
+        role='user',
+        content=user_input,
+        timestamp=datetime.utcnow(),
+        chat_id=chat_id
+    )
+    db.session.add(user_message)
+    db.session.commit() # Commit user message before API call
+
+    user_id = current_user.id
+
+    def generate():
+        yield sse_event("start", {"notification": None, "estimated_cost": estimated_cost})
+        try:
+            for event, data in process_tool_request_stream(tool_type, user_input, user_id, hold_id):
+                if event == "delta":
+                    yield sse_event("delta", {"content": data})
+                    continue
+                ai_message = save_tool_message(chat_id, data, tool_type, user_id)
+                if data['status'] == 'success':
+                    yield sse_event("done", {
+                        "message_id": ai_message.id,
+                        "content": ai_message.content,
+                        "tokens": data.get('tokens', {}),
+                        "cost": ai_message.cost,
+                        "balance": token_manager.get_balance(user_id)
+                    })
+                else:
+                    yield sse_event("error", {"message": ai_message.content, "retry_after": data.get('retry_after')})
+        finally:
+            # Also runs if the client disconnects mid-stream; an unstarted stream's hold is reaped
+            token_manager.settle(user_id, hold_id)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @tools_bp.route('/quant_tool', methods=['GET', 'POST'])
 @login_required
+@rate_limited('tools')
 def quant_tool():
-    supported_quant_tools = [
-        {"id": "math_classification", "name": "核心概念分類"},
-        {"id": "word_problem_converter", "name": "轉換為應用題"}
-    ]
-    return handle_tool_request('quant', 'quant_tool.html', supported_tools=supported_quant_tools)
+    return handle_tool_request('quant', 'quant_tool.html', supported_tools=tool_registry.tools_for_category('quant'))
 
 @tools_bp.route('/verbal_tool', methods=['GET', 'POST'])
 @login_required
+@rate_limited('tools')
 def verbal_tool():
-    supported_verbal_tools = [
-        {"id": "cr_classification", "name": "CR題型分類"},
-        {"id": "distractor_mocker", "name": "干擾項生成"}
-        # Add other verbal tools here if needed
-    ]
-    # Get default tool type for GET request
-    default_tool = 'cr_classification' if request.method == 'GET' else None
-    return handle_tool_request('verbal', 'verbal_tool.html', supported_tools=supported_verbal_tools)
+    return handle_tool_request('verbal', 'verbal_tool.html', supported_tools=tool_registry.tools_for_category('verbal'))
 
 @tools_bp.route('/core_tool', methods=['GET', 'POST'])
 @login_required
+@rate_limited('tools')
 def core_tool():
-    # Define supported core tools if any, or pass None
-    supported_core_tools = None 
-    return handle_tool_request('core', 'core_tool.html', supported_tools=supported_core_tools) 
\ No newline at end of file
+    return handle_tool_request('core', 'core_tool.html', supported_tools=tool_registry.tools_for_category('core'))
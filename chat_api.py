@@ -0,0 +1,298 @@
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, jsonify
+
+# Import client from extensions and helpers shared with the chat blueprint
+from extensions import db
+from models import Chat, Message
+from chat_history import build_history_messages
+from utils import calculate_cost, call_in_app_context, init_conversation, BASE_SYSTEM_PROMPT
+from token_counter import count_text_tokens
+import model_router
+import token_manager # Use token_manager for balance deductions
+import usage_ledger
+
+def build_messages_for_api(chat_id, instruction, pending_user_input=None):
+    """
+    Build the message list sent to OpenAI for a chat turn.
+    The stable base prompt and the chat history come first and the
+    instruction-specific prompt comes last, so switching instructions does not
+    change the prefix and earlier turns stay eligible for prompt caching.
+    Older turns are replaced by the chat's rolling summary (see chat_history.py).
+    Args:
+        chat_id (int): The chat whose history should be sent.
+        instruction (str): The instruction key used to pick the system prompt.
+        pending_user_input (str, optional): A user message not yet saved, appended
+            after the history (used for pre-flight estimates).
+    Returns:
+        list: Messages in chat completions format.
+    """
+    messages_for_api = [{"role": "system", "content": BASE_SYSTEM_PROMPT}]
+
+    # Rolling summary plus the newest turns that fit the category's token budget, less
+    # the pending message; always includes the latest user message
+    chat = db.session.get(Chat, chat_id)
+    reserved_tokens = count_text_tokens(pending_user_input) if pending_user_input else 0
+    messages_for_api.extend(build_history_messages(chat, reserved_tokens))
+    if pending_user_input:
+        messages_for_api.append({"role": "user", "content": pending_user_input})
+
+    messages_for_api.append(init_conversation(instruction)[0])
+    return messages_for_api
+
+def build_fanout_messages(chat_id, instructions, pending_user_input=None):
+    """
+    Build the message lists of a multi-mode turn. They differ only in the final
+    instruction prompt, so the history is loaded once and the shared prefix is
+    cached by OpenAI across the parallel calls.
+    Returns:
+        dict: Instruction -> messages in chat completions format, in the given order.
+    """
+    shared = build_messages_for_api(chat_id, instructions[0], pending_user_input)[:-1]
+    return {instruction: shared + [init_conversation(instruction)[0]] for instruction in instructions}
+
+def prompt_cache_key(chat_id):
+    """Key that routes all turns of a chat to the same OpenAI prompt cache."""
+    return f"gmat-chat-{chat_id}"
+
+def chat_route_key(instruction):
+    """Routing key of a chat instruction in Config.MODEL_POLICIES."""
+    return f"chat:{instruction}"
+
+def build_chat_request(chat_id, messages_for_api, stream=False, instruction=None):
+    """
+    Build the chat completions request parameters for a chat turn.
+    The model and reply token bound (which lets the turn's cost be
+    pre-authorised) come from the instruction's routing policy.
+    """
+    request_params = {
+        "messages": messages_for_api,
+        "stream": stream,
+        # Sent via extra_body so older SDK versions without the named parameter still work
+        "extra_body": {"prompt_cache_key": prompt_cache_key(chat_id)}
+    }
+    if stream:
+        # Ask for a final chunk carrying token usage so the turn can be charged
+        request_params["stream_options"] = {"include_usage": True}
+    return model_router.route(request_params, chat_route_key(instruction))
+
+def estimate_turn_cost(chat_id, instruction, user_input, stream=False):
+    """
+    Pre-flight estimate of a chat turn's worst-case cost, computed locally
+    before the user message is saved or the API is called. Priced at the higher
+    of the routed and fallback models (model_router.estimate_worst_case_cost).
+    Returns:
+        tuple: (float estimated cost, dict routed request_params to reuse for the call,
+                so the turn is sent to the model its hold was priced on)
+    """
+    messages_for_api = build_messages_for_api(chat_id, instruction, pending_user_input=user_input)
+    request_params = build_chat_request(chat_id, messages_for_api, stream=stream, instruction=instruction)
+    return model_router.estimate_worst_case_cost(request_params, chat_route_key(instruction)), request_params
+
+def estimate_fanout_cost(chat_id, instructions, user_input):
+    """
+    Pre-flight estimate of a multi-mode turn: the sum of each instruction's worst-case cost.
+    Returns:
+        tuple: (float estimated cost, dict instruction -> routed request_params to reuse for the calls)
+    """
+    messages_by_instruction = build_fanout_messages(chat_id, instructions, pending_user_input=user_input)
+    estimated_cost = 0.0
+    requests_by_instruction = {}
+    for instruction, messages_for_api in messages_by_instruction.items():
+        request_params = build_chat_request(chat_id, messages_for_api, instruction=instruction)
+        estimated_cost += model_router.estimate_worst_case_cost(request_params, chat_route_key(instruction))
+        requests_by_instruction[instruction] = request_params
+    return estimated_cost, requests_by_instruction
+
+def extract_usage(usage):
+    """
+    Safely read token counts from an OpenAI usage object.
+    Returns:
+        tuple: (prompt_tokens, completion_tokens, cached_tokens)
+    """
+    if not usage:
+        return 0, 0, 0
+    cached_tokens = 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if details and getattr(details, 'cached_tokens', None):
+        cached_tokens = details.cached_tokens
+    return usage.prompt_tokens, usage.completion_tokens, cached_tokens
+
+def save_assistant_message(chat_id, user_id, content, usage=None, response_id=None, instruction=None, model=None,
+                           fanout_group=None, hold_id=None):
+    """
+    Charge the user for a completed turn and persist the assistant message.
+    Args:
+        chat_id (int): Chat to attach the message to.
+        user_id (int): User to charge.
+        content (str): The assistant reply.
+        usage: OpenAI usage object (may be None if the API did not report it).
+        response_id (str, optional): OpenAI response ID.
+        instruction (str, optional): Instruction the reply was generated with.
+        model (str, optional): Model that generated the reply, for pricing.
+        fanout_group (str, optional): Group ID shared by the replies of a multi-mode turn.
+        hold_id (int, optional): The turn's balance hold, settled by the same UPDATE as the charge.
+    Returns:
+        tuple: (Message, float or None: new balance, None if nothing was deducted)
+    """
+    prompt_tokens, completion_tokens, cached_tokens = extract_usage(usage)
+    turn_cost = 0.0
+    new_balance = None
+    if usage:
+        _, _, turn_cost = calculate_cost(prompt_tokens, completion_tokens, cached_tokens, model)
+        new_balance = token_manager.charge(user_id, turn_cost, hold_id)
+
+    ai_message = Message(
+        chat_id=chat_id,
+        role="assistant",
+        content=content,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=turn_cost,
+        response_id=response_id,
+        cached_tokens=cached_tokens,
+        instruction=instruction,
+        fanout_group=fanout_group
+    )
+    db.session.add(ai_message)
+    usage_ledger.record(user_id, ai_message, 'chat') # Saved with the message
+    db.session.commit()
+    return ai_message, new_balance
+
+def complete_chat(chat_id, user_id, instruction, request_params=None, hold_id=None):
+    """
+    Run a blocking chat completion for the latest turn and persist the reply.
+    Args:
+        request_params (dict, optional): Request already routed for a pre-flight estimate.
+        hold_id (int, optional): The turn's balance hold (token_manager.reserve).
+    Returns:
+        tuple: (Message, float or None: new balance)
+    """
+    if request_params is None:
+        request_params = build_chat_request(chat_id, build_messages_for_api(chat_id, instruction), instruction=instruction)
+    response = model_router.complete(request_params, chat_route_key(instruction), 'chat')
+    model_reply = response.choices[0].message.content
+    response_id = getattr(response, 'id', None)
+    return save_assistant_message(chat_id, user_id, model_reply,
+                                  usage=getattr(response, 'usage', None),
+                                  response_id=response_id,
+                                  instruction=instruction,
+                                  model=getattr(response, 'model', None) or request_params["model"],
+                                  hold_id=hold_id)
+
+def complete_fanout(chat_id, user_id, instructions, requests_by_instruction=None, hold_id=None):
+    """
+    Answer the latest user message under several instructions at once. The
+    calls run in parallel; each reply is charged and saved as its own assistant
+    message, in the given order, sharing a fanout_group so the page shows them as tabs.
+    Args:
+        instructions (list): Instruction keys; the first one is the primary reply.
+        requests_by_instruction (dict, optional): Requests already routed for a pre-flight estimate.
+        hold_id (int, optional): The turn's balance hold, settled with the first reply's charge.
+    Returns:
+        tuple: (list of saved Messages, float or None: new balance, dict instruction -> error for failed calls)
+    Raises:
+        Exception: The first error if every call failed.
+    """
+    requests = requests_by_instruction
+    if requests is None:
+        messages_by_instruction = build_fanout_messages(chat_id, instructions)
+        requests = {instruction: build_chat_request(chat_id, messages_by_instruction[instruction], instruction=instruction)
+                    for instruction in instructions}
+    # Only the API calls run in the pool; messages are saved here, on the request's DB session
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=len(instructions), thread_name_prefix="chat-fanout") as pool:
+        futures = {instruction: pool.submit(call_in_app_context, app, model_router.complete, request_params,
+                                            chat_route_key(instruction), 'chat')
+                   for instruction, request_params in requests.items()}
+
+    fanout_group = uuid.uuid4().hex
+    ai_messages = []
+    errors = {}
+    new_balance = None
+    for instruction in instructions:
+        try:
+            response = futures[instruction].result()
+        except Exception as e:
+            current_app.logger.warning(f"Multi-mode call for {instruction} failed: {str(e)}")
+            errors[instruction] = e
+            continue
+        ai_message, balance = save_assistant_message(chat_id, user_id, response.choices[0].message.content,
+                                                     usage=getattr(response, 'usage', None),
+                                                     response_id=getattr(response, 'id', None),
+                                                     instruction=instruction,
+                                                     model=getattr(response, 'model', None) or requests[instruction]["model"],
+                                                     fanout_group=fanout_group,
+                                                     hold_id=hold_id)
+        ai_messages.append(ai_message)
+        if balance is not None:
+            new_balance = balance
+    if not ai_messages:
+        raise errors[instructions[0]]
+    return ai_messages, new_balance, errors
+
+def stream_chat(chat_id, user_id, instruction, request_params=None, hold_id=None):
+    """
+    Stream a chat completion for the latest turn.
+    Args:
+        request_params (dict, optional): Streaming request already routed for a pre-flight
+            estimate (estimate_turn_cost with stream=True).
+        hold_id (int, optional): The turn's balance hold (token_manager.reserve).
+    Yields:
+        tuple: ("delta", str) for each content fragment, then
+               ("done", dict) once the reply has been saved and charged.
+    """
+    if request_params is None:
+        request_params = build_chat_request(chat_id, build_messages_for_api(chat_id, instruction), stream=True,
+                                            instruction=instruction)
+    stream = model_router.complete(request_params, chat_route_key(instruction), 'chat')
+
+    parts = []
+    usage = None
+    response_id = None
+    model = request_params["model"]
+    try:
+        for chunk in stream:
+            response_id = response_id or getattr(chunk, 'id', None)
+            model = getattr(chunk, 'model', None) or model
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield "delta", delta
+    finally:
+        # Release the upstream connection if the client disconnected mid-stream
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+
+    ai_message, new_balance = save_assistant_message(chat_id, user_id, "".join(parts),
+                                                     usage=usage, response_id=response_id,
+                                                     instruction=instruction, model=model, hold_id=hold_id)
+    yield "done", {
+        "message_id": ai_message.id,
+        "content": ai_message.content,
+        "tokens": {
+            "input": ai_message.prompt_tokens,
+            "cached": ai_message.cached_tokens,
+            "output": ai_message.completion_tokens
+        },
+        "cost": ai_message.cost,
+        "balance": new_balance
+    }
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def busy_response(error):
+    """503 JSON response with Retry-After for a CircuitOpenError (breaker open or concurrency limit)."""
+    response = jsonify({'status': 'error', 'message': str(error), 'retry_after': error.retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
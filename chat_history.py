@@ -0,0 +1,181 @@
+import threading
+from flask import current_app
+
+from config import Config
+from extensions import db
+from models import Chat, Message
+from token_counter import count_text_tokens
+from llm import create_chat_completion
+
+SUMMARY_PROMPT = (
+    "你負責整理GMAT解題對話的摘要。請用繁體中文，將既有摘要與新的對話內容合併成一份精簡的摘要，"
+    "保留學生問過的題目重點、已給出的關鍵解法與結論、學生的弱點與偏好。不要加入對話中沒有的內容。"
+)
+
+# Chats whose summary is currently being refreshed (per process)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def _history_budget(chat):
+    return Config.HISTORY_TOKEN_BUDGET.get(chat.category, Config.DEFAULT_HISTORY_TOKEN_BUDGET)
+
+def select_history_window(chat, history, reserved_tokens=0):
+    """
+    Pick which history messages are sent verbatim for a chat turn.
+    The newest HISTORY_KEEP_MESSAGES are always kept; older messages are
+    added newest-first while they fit the category's token budget.
+    Args:
+        chat: The Chat being answered.
+        history (list): Non-system messages newer than the chat summary, oldest first.
+        reserved_tokens (int): Part of the budget already taken by messages sent
+            after the history (a user message not yet saved).
+    Returns:
+        tuple: (list of messages to send, list of older messages left out)
+    """
+    budget = _history_budget(chat) - reserved_tokens
+    keep = Config.HISTORY_KEEP_MESSAGES
+
+    used = 0
+    start = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        tokens = count_text_tokens(history[index].content)
+        if len(history) - index > keep and used + tokens > budget:
+            break
+        used += tokens
+        start = index
+    return history[start:], history[:start]
+
+def _unsummarized_turns(chat):
+    """Non-system messages newer than the chat summary, oldest first, one per multi-mode turn."""
+    query = Message.query.filter(
+        Message.chat_id == chat.id,
+        Message.role != 'system'
+    )
+    if chat.summary_upto_id:
+        query = query.filter(Message.id > chat.summary_upto_id)
+    history = query.order_by(Message.timestamp).all()
+    # A multi-mode turn is represented by its first reply; the others are alternatives
+    # shown as tabs, and resending all of them would multiply the prompt
+    seen_groups = set()
+    turns = []
+    for msg in history:
+        if msg.fanout_group:
+            if msg.fanout_group in seen_groups:
+                continue
+            seen_groups.add(msg.fanout_group)
+        turns.append(msg)
+    return turns
+
+def _refresh_summary_now(chat, upto_id):
+    """
+    Refresh the summary on the request's thread, unless a background refresh
+    of the chat is already running.
+    Returns:
+        bool: True if the summary now covers upto_id.
+    """
+    with _refreshing_lock:
+        if chat.id in _refreshing:
+            return False
+        _refreshing.add(chat.id)
+    try:
+        refresh_summary(chat.id, upto_id)
+    except Exception as e:
+        current_app.logger.error(f"Error refreshing summary for chat {chat.id}: {str(e)}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(chat.id)
+    return (chat.summary_upto_id or 0) >= upto_id
+
+def build_history_messages(chat, reserved_tokens=0):
+    """
+    Build the history part of a chat request: the rolling summary (if any)
+    followed by the verbatim window.
+    Turns that fall out of the window but are not yet in the summary are still
+    sent verbatim while a background refresh folds them in. If they alone
+    exceed the token budget (the summary has fallen far behind), the summary
+    is refreshed before the request is built.
+    Args:
+        chat: The Chat being answered.
+        reserved_tokens (int): Tokens of a user message sent after the history.
+    Returns:
+        list: Messages in chat completions format.
+    """
+    history = _unsummarized_turns(chat)
+    window, overflow = select_history_window(chat, history, reserved_tokens)
+    if overflow:
+        overflow_tokens = sum(count_text_tokens(msg.content) for msg in overflow)
+        if overflow_tokens > _history_budget(chat) and _refresh_summary_now(chat, overflow[-1].id):
+            history = _unsummarized_turns(chat)
+            window, overflow = select_history_window(chat, history, reserved_tokens)
+        else:
+            schedule_summary_refresh(chat.id, overflow[-1].id)
+        window = overflow + window # Not covered by the summary yet
+
+    messages = []
+    if chat.summary:
+        messages.append({"role": "system", "content": f"先前對話摘要：\n{chat.summary}"})
+    messages.extend([{"role": msg.role, "content": msg.content} for msg in window])
+    return messages
+
+def schedule_summary_refresh(chat_id, upto_id):
+    """Fold messages up to upto_id into the chat summary on a background thread."""
+    with _refreshing_lock:
+        if chat_id in _refreshing:
+            return # A refresh for this chat is already running
+        _refreshing.add(chat_id)
+
+    app = current_app._get_current_object()
+    thread = threading.Thread(target=_refresh_summary_thread, args=(app, chat_id, upto_id), daemon=True)
+    thread.start()
+
+def _refresh_summary_thread(app, chat_id, upto_id):
+    try:
+        with app.app_context():
+            refresh_summary(chat_id, upto_id)
+    except Exception as e:
+        app.logger.error(f"Error refreshing summary for chat {chat_id}: {str(e)}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(chat_id)
+
+def refresh_summary(chat_id, upto_id):
+    """
+    Merge the chat's messages up to upto_id into its rolling summary.
+    Args:
+        chat_id (int): The chat to summarise.
+        upto_id (int): ID of the newest message to fold into the summary.
+    """
+    chat = db.session.get(Chat, chat_id)
+    if not chat or (chat.summary_upto_id or 0) >= upto_id:
+        return
+
+    query = Message.query.filter(
+        Message.chat_id == chat_id,
+        Message.role != 'system',
+        Message.id <= upto_id
+    )
+    if chat.summary_upto_id:
+        query = query.filter(Message.id > chat.summary_upto_id)
+    new_messages = query.order_by(Message.timestamp).all()
+    if not new_messages:
+        return
+
+    roles = {'user': '學生', 'assistant': 'AI助手'}
+    transcript = "\n\n".join(f"{roles.get(msg.role, msg.role)}：{msg.content}" for msg in new_messages)
+    response = create_chat_completion({
+        "model": Config.SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"既有摘要：\n{chat.summary or '（無）'}\n\n新的對話內容：\n{transcript}"}
+        ],
+        "temperature": 0.2,
+        "max_tokens": Config.SUMMARY_MAX_TOKENS
+    }, 'summary')
+    summary = response.choices[0].message.content
+    if not summary:
+        return
+
+    chat.summary = summary.strip()
+    chat.summary_upto_id = new_messages[-1].id
+    db.session.commit()
+    current_app.logger.info(f"Chat {chat_id} summary refreshed up to message {chat.summary_upto_id}")
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+
+import metrics
+from config import Config
+from resilience import CircuitOpenError
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows; the 'file' backend falls back to per-process limits
+    fcntl = None
+
+# Smoothing of the slot hold time used for Retry-After
+_HOLD_ALPHA = 0.2
+_FILE_POLL_SECONDS = 0.05
+
+class ConcurrencyLimitError(CircuitOpenError):
+    """
+    Raised when a model's concurrency limit is reached and its wait queue is full
+    or the wait timed out. Subclasses CircuitOpenError so callers treat it the
+    same way: fail fast (503), fall back to another model, don't charge.
+    """
+
+class Slot:
+    """One acquired unit of concurrency; release() is idempotent."""
+    def __init__(self, limiter, file_lock=None):
+        self._limiter = limiter
+        self._file_lock = file_lock
+        self._acquired_at = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        if self._file_lock is not None:
+            self._file_lock.release()
+        self._limiter._release(time.monotonic() - self._acquired_at)
+
+class _FileSemaphore:
+    """
+    Host-wide counting semaphore: one lock file per slot, held with flock.
+    The OS drops a crashed process's locks, so slots are never leaked.
+    """
+    def __init__(self, directory, name, limit):
+        os.makedirs(directory, exist_ok=True)
+        safe_name = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in name)
+        self._paths = [os.path.join(directory, f"{safe_name}.{index}.lock") for index in range(limit)]
+
+    def acquire(self, deadline):
+        """Return a held lock, or None if no slot freed up before deadline."""
+        while True:
+            for path in self._paths:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    continue
+                return _FileLock(fd)
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(_FILE_POLL_SECONDS)
+
+class _FileLock:
+    def __init__(self, fd):
+        self._fd = fd
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+class ConcurrencyLimiter:
+    """
+    Counting semaphore with a bounded wait queue.
+    At most limit calls hold a slot; up to max_waiting more wait for one for
+    at most wait_seconds. Anything beyond that is rejected immediately.
+    With shared_dir set, slots are also taken from a host-wide file semaphore
+    so the limit holds across processes.
+    """
+    def __init__(self, name, limit, max_waiting=32, wait_seconds=10.0, shared_dir=None):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.wait_seconds = wait_seconds
+        self._active = 0
+        self._waiting = 0
+        self._hold_ewma = None
+        self._condition = threading.Condition()
+        self._shared = _FileSemaphore(shared_dir, name, limit) if shared_dir and fcntl else None
+
+    def acquire(self):
+        """
+        Take a slot, waiting in the queue if needed.
+        Returns:
+            Slot: Call release() when the upstream call (or stream) is finished.
+        Raises:
+            ConcurrencyLimitError: If the queue is full or no slot freed up in time.
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        with self._condition:
+            if self._active >= self.limit:
+                if self._waiting >= self.max_waiting:
+                    self._reject("queue_full")
+                self._waiting += 1
+                metrics.gauge(f"llm.concurrency.{self.name}.waiting").inc()
+                try:
+                    while self._active >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("wait_timeout")
+                        self._condition.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                    metrics.gauge(f"llm.concurrency.{self.name}.waiting").dec()
+            self._active += 1
+            metrics.gauge(f"llm.concurrency.{self.name}.active").inc()
+
+        file_lock = None
+        if self._shared is not None:
+            file_lock = self._shared.acquire(deadline)
+            if file_lock is None:
+                self._release(None)
+                with self._condition:
+                    self._reject("wait_timeout")
+        return Slot(self, file_lock)
+
+    def admits(self):
+        """False when a new call would be rejected right away (all slots taken and the queue full)."""
+        with self._condition:
+            return self._active < self.limit or self._waiting < self.max_waiting
+
+    def retry_after(self):
+        """Seconds a rejected caller should wait: the recent average time a slot is held."""
+        return max(1, self._hold_ewma or self.wait_seconds)
+
+    def snapshot(self):
+        with self._condition:
+            return {"limit": self.limit, "active": self._active, "waiting": self._waiting}
+
+    def _release(self, held_seconds):
+        with self._condition:
+            self._active -= 1
+            if held_seconds is not None:
+                previous = self._hold_ewma
+                self._hold_ewma = held_seconds if previous is None else previous + _HOLD_ALPHA * (held_seconds - previous)
+            self._condition.notify()
+        metrics.gauge(f"llm.concurrency.{self.name}.active").dec()
+
+    def _reject(self, reason):
+        # Called with the condition held
+        metrics.counter(f"llm.concurrency.{self.name}.rejected.{reason}").inc()
+        raise ConcurrencyLimitError(self.name, self.retry_after())
+
+class ReleasingStream:
+    """Wraps a streaming response so its slot is released when the stream ends or is closed."""
+    def __init__(self, stream, slot):
+        self._stream = stream
+        self._slot = slot
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self._slot.release()
+
+    def close(self):
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close:
+                close()
+        finally:
+            self._slot.release()
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(model):
+    """Get or create the limiter for a model, sized from Config.LLM_CONCURRENCY_LIMITS."""
+    with _limiters_lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            limits = Config.LLM_CONCURRENCY_LIMITS
+            shared_dir = Config.LLM_CONCURRENCY_LOCK_DIR if Config.LLM_CONCURRENCY_BACKEND == 'file' else None
+            limiter = _limiters[model] = ConcurrencyLimiter(
+                model,
+                limits.get(model, limits['default']),
+                max_waiting=Config.LLM_CONCURRENCY_MAX_WAITING,
+                wait_seconds=Config.LLM_CONCURRENCY_WAIT_SECONDS,
+                shared_dir=shared_dir
+            )
+        return limiter
+
+def limiter_states():
+    """Active/waiting calls per model, for the metrics endpoint."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {model: limiter.snapshot() for model, limiter in limiters.items()}
@@ -10,17 +10,174 @@ class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'users.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
+    # Point the OpenAI client at the local stand-in server (fake_openai_server.py)
+    # for offline benchmarking and tests; no API key is needed then
+    OPENAI_FAKE = os.getenv("OPENAI_FAKE", "false").lower() in ("1", "true", "yes")
+    OPENAI_FAKE_URL = os.getenv("OPENAI_FAKE_URL", "http://127.0.0.1:8765/v1")
+    OPENAI_BASE_URL = OPENAI_FAKE_URL if OPENAI_FAKE else os.getenv("OPENAI_BASE_URL") # None means api.openai.com
+
     # OpenAI API Key
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY is not configured properly. Check your .env file.")
+    # Checked when the client is first built (extensions.get_client), so scripts that
+    # never call OpenAI run without it
+    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") or ("fake-key" if OPENAI_FAKE else None)
+
+    # Shared OpenAI HTTP transport (http_transport.py). Size the pool to the number of
+    # threads per process that may call OpenAI at once (request threads + background threads).
+    OPENAI_POOL_MAX_CONNECTIONS = int(os.getenv("OPENAI_POOL_MAX_CONNECTIONS", "16"))
+    OPENAI_POOL_MAX_KEEPALIVE = int(os.getenv("OPENAI_POOL_MAX_KEEPALIVE", "8"))
+    OPENAI_KEEPALIVE_EXPIRY = 60.0 # Seconds an idle connection is kept open
+    OPENAI_POOL_TIMEOUT = 10.0 # Max seconds to wait for a free pooled connection
+    OPENAI_WRITE_TIMEOUT = 30.0
+    OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "true").lower() in ("1", "true", "yes") # Used only if the h2 package is installed
+    OPENAI_MAX_RETRIES = 0 # Retries are done by llm.py (backoff + circuit breaker), not the SDK
+
+    # Retry/backoff and circuit breaker around every LLM call (llm.py, resilience.py)
+    LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3")) # Including the first attempt
+    LLM_RETRY_BASE_DELAY = 0.5 # Seconds; doubled per retry, full jitter
+    LLM_RETRY_MAX_DELAY = 8.0
+    LLM_BREAKER_WINDOW_SECONDS = 60 # Rolling window for the error rate
+    LLM_BREAKER_MIN_REQUESTS = 10 # Don't trip on a handful of calls
+    LLM_BREAKER_ERROR_RATE = 0.5 # Open when at least half the calls in the window failed
+    LLM_BREAKER_OPEN_SECONDS = 30 # Fail fast this long before letting a trial call through
+
+    # Outbound LLM concurrency per model (concurrency.py), kept under the org rate limit.
+    # Calls over the limit queue for up to LLM_CONCURRENCY_WAIT_SECONDS; once
+    # LLM_CONCURRENCY_MAX_WAITING calls are queued, new ones get a 503 with Retry-After.
+    # A streamed reply holds its slot until the stream is closed.
+    LLM_CONCURRENCY_LIMITS = {
+        'default': int(os.getenv("LLM_CONCURRENCY_DEFAULT", "16")),
+        'o3-mini': int(os.getenv("LLM_CONCURRENCY_O3_MINI", "16")),
+        'gpt-4.1-nano': 32,
+        'gpt-4.1-mini': 32,
+        'gpt-4o-mini': 32,
+    }
+    LLM_CONCURRENCY_MAX_WAITING = int(os.getenv("LLM_CONCURRENCY_MAX_WAITING", "32")) # Per model and process
+    LLM_CONCURRENCY_WAIT_SECONDS = 10.0
+    # 'process' limits each process on its own; 'file' shares the limits between all
+    # processes on this host (gunicorn workers, worker.py) through lock files
+    LLM_CONCURRENCY_BACKEND = os.getenv("LLM_CONCURRENCY_BACKEND", "process")
+    LLM_CONCURRENCY_LOCK_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'llm_slots')
+
+    # (connect, read) timeouts in seconds per call site / tool type
+    OPENAI_TIMEOUTS = {
+        'default': (5.0, 120.0),
+        'chat': (5.0, 300.0), # Reasoning models can think for minutes on long RC passages
+        'summary': (5.0, 60.0),
+        'analysis': (5.0, 600.0),
+        'cr_classification': (5.0, 30.0),
+        'math_classification': (5.0, 180.0),
+        'math_classification_question': (5.0, 30.0),
+        'word_problem_converter': (5.0, 120.0),
+        'distractor_mocker': (5.0, 120.0),
+    }
+
+    # Balance every user gets back each week (Sunday 00:00 UTC). Resets are applied
+    # lazily (token_manager.effective_balance) and written by the next charge
+    WEEKLY_BALANCE = 5.0
+
+    # Pre-authorisation holds (token_manager.reserve): a request's estimated worst-case
+    # cost is held until it is settled; holds never settled are released after this
+    BALANCE_HOLD_TTL_SECONDS = 15 * 60
+
+    # Background LLM job queue - when enabled, chat/tool POSTs enqueue jobs for worker.py
+    LLM_JOB_QUEUE_ENABLED = os.getenv("LLM_JOB_QUEUE_ENABLED", "false").lower() in ("1", "true", "yes")
+    LLM_JOB_POLL_INTERVAL = float(os.getenv("LLM_JOB_POLL_INTERVAL", "1.0")) # Seconds between worker polls when idle
+    # A running job's worker refreshes its heartbeat every LLM_JOB_HEARTBEAT_SECONDS while the
+    # call is in flight, however long it takes; jobs whose heartbeat is older than
+    # LLM_JOB_STALE_SECONDS are assumed orphaned and requeued
+    LLM_JOB_HEARTBEAT_SECONDS = 30
+    LLM_JOB_STALE_SECONDS = 180
+    LLM_JOB_MAX_ATTEMPTS = 3
+
+    # Per-user token buckets on chat and tool POSTs (rate_limit.py): a burst of up to
+    # 'capacity' requests, then 'per_minute' requests per minute
+    RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+    RATE_LIMITS = {
+        'chat': {'capacity': 5, 'per_minute': 10},
+        'tools': {'capacity': 5, 'per_minute': 10},
+    }
+    # 'memory' limits each process on its own; 'sqlite' shares buckets between all processes on this host
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    RATE_LIMIT_SQLITE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'rate_limit.db')
+
+    # Report per-request SQL time in a Server-Timing header (db_timing.py, read by load_test.py)
+    DB_TIMING_ENABLED = os.getenv("DB_TIMING_ENABLED", "false").lower() in ("1", "true", "yes")
         
     # Pricing (per 1M tokens) - For utils.py
     INPUT_PRICE = 1.10
     CACHED_INPUT_PRICE = 0.55
     OUTPUT_PRICE = 4.40
 
-    # Pricing for tools_api.py (GPT-4o per token)
-    GPT4O_INPUT_PRICE_PER_TOKEN = 2.50 / 1_000_000
-    GPT4O_CACHED_INPUT_PRICE_PER_TOKEN = 1.25 / 1_000_000
-    GPT4O_OUTPUT_PRICE_PER_TOKEN = 10.00 / 1_000_000 
\ No newline at end of file
+    # Pricing per model in USD per 1M tokens: (input, cached input, output).
+    # Dated snapshots (e.g. gpt-4o-mini-2024-07-18) are priced as their base model.
+    MODEL_PRICING = {
+        'o3-mini': (INPUT_PRICE, CACHED_INPUT_PRICE, OUTPUT_PRICE),
+        'o4-mini': (1.10, 0.275, 4.40),
+        'gpt-4o': (2.50, 1.25, 10.00),
+        'gpt-4o-mini': (0.15, 0.075, 0.60),
+        'gpt-4.1': (2.00, 0.50, 8.00),
+        'gpt-4.1-mini': (0.40, 0.10, 1.60),
+        'gpt-4.1-nano': (0.10, 0.025, 0.40),
+    }
+    DEFAULT_PRICING_MODEL = 'o3-mini' # Used for unknown models and when no model is given
+    REASONING_MODEL_PREFIXES = ('o1', 'o3', 'o4')
+
+    # Tool definitions (tool_registry.py)
+    TOOL_REGISTRY_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'tool_registry.json')
+
+    # Exact-match response cache for deterministic tools (tools_api.py). Registry tools
+    # opt in with "cacheable" in tool_registry.json; this lists internal request types.
+    CACHEABLE_TOOLS = ('math_classification_question',)
+    TOOL_CACHE_TTL_SECONDS = 24 * 60 * 60
+    TOOL_CACHE_MAX_ENTRIES = 2000
+    TOOL_CACHE_HIT_COST_RATIO = 0.0 # Fraction of the original cost charged on a cache hit
+    # Identical in-flight requests for cacheable tools share one upstream call (singleflight.py).
+    # Billing for the shared call: 'full' (everyone pays full cost), 'split' (cost divided
+    # evenly) or 'leader' (only the request that made the call pays)
+    COALESCE_BILLING_POLICY = os.getenv("COALESCE_BILLING_POLICY", "split")
+
+    # Numbered multi-question math_classification input is classified one question per
+    # request, in parallel, and the counts table is built server-side (tools_api.py)
+    MATH_FANOUT_ENABLED = os.getenv("MATH_FANOUT_ENABLED", "true").lower() in ("1", "true", "yes")
+    MATH_FANOUT_MAX_WORKERS = int(os.getenv("MATH_FANOUT_MAX_WORKERS", "8"))
+
+    # Multi-mode chat turns: one question answered under several instructions at once,
+    # in parallel, saved as separate replies shown as tabs (chat_api.complete_fanout)
+    CHAT_FANOUT_ENABLED = os.getenv("CHAT_FANOUT_ENABLED", "true").lower() in ("1", "true", "yes")
+    CHAT_FANOUT_MAX_INSTRUCTIONS = 4
+
+    # Chat history window (chat_history.py): the newest HISTORY_KEEP_MESSAGES are always
+    # sent verbatim, older ones only while they fit the category budget (less the new
+    # message); the rest are folded into a rolling summary by SUMMARY_MODEL in the
+    # background and sent verbatim until the summary covers them
+    HISTORY_TOKEN_BUDGET = {'quant': 6000, 'verbal': 12000, 'graph': 6000}
+    DEFAULT_HISTORY_TOKEN_BUDGET = 8000
+    HISTORY_KEEP_MESSAGES = 6
+    SUMMARY_MODEL = "gpt-4o-mini"
+    SUMMARY_MAX_TOKENS = 600
+
+    # Upper bound on chat reply tokens (reasoning included); pre-flight checks
+    # reserve a turn's worst-case cost from this before calling the API
+    CHAT_MAX_COMPLETION_TOKENS = 16000
+
+    # Model routing per chat instruction ("chat:<instruction>", model_router.py); tools
+    # declare their policy in tool_registry.json, and an entry here overrides it.
+    # max_tokens bounds the reply (reasoning tokens included for reasoning models).
+    # The fallback is used while the primary's breaker is open or its recent latency
+    # exceeds latency_slo (seconds), and for one retry if the primary call fails.
+    # Classification-style tasks use small fast models; explanations keep reasoning models.
+    MODEL_POLICIES = {
+        'default': {'model': 'o3-mini', 'max_tokens': 4000, 'fallback': 'gpt-4.1-mini', 'latency_slo': 60},
+        'math_classification_question': {'model': 'gpt-4.1-mini', 'max_tokens': 20, 'fallback': 'gpt-4o-mini', 'latency_slo': 5},
+        'chat': {'model': 'o3-mini', 'max_tokens': CHAT_MAX_COMPLETION_TOKENS, 'fallback': 'gpt-4.1', 'latency_slo': 120},
+        'chat:mind_map': {'model': 'gpt-4.1-mini', 'max_tokens': 4000, 'fallback': 'gpt-4o-mini', 'latency_slo': 30},
+        'chat:logical_term_explanation': {'model': 'gpt-4.1-mini', 'max_tokens': 4000, 'fallback': 'gpt-4o-mini', 'latency_slo': 30},
+        'chat:pattern_recognition': {'model': 'gpt-4.1-mini', 'max_tokens': 4000, 'fallback': 'gpt-4o-mini', 'latency_slo': 30},
+    }
+    MODEL_ROUTER_PROBE_RATIO = 0.05 # Share of requests still sent to a primary that is over its SLO
+
+    # Cohort question analysis (batch_analysis.py)
+    ANALYSIS_MODEL = "o3-mini"
+    ANALYSIS_BATCH_BACKEND = os.getenv("ANALYSIS_BATCH_BACKEND", "openai") # openai, local (runs requests synchronously)
+    ANALYSIS_BATCH_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'instance', 'batches')
+    BATCH_PRICE_RATIO = 0.5 # Batch API requests are billed at half price
@@ -0,0 +1,39 @@
+import time
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    if has_request_context():
+        g.db_time = g.get('db_time', 0.0) + time.perf_counter() - started
+        g.db_queries = g.get('db_queries', 0) + 1
+
+def _handle_error(exception_context):
+    # after_cursor_execute is not called for failed statements
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+def _add_timing_headers(response):
+    # Streamed bodies keep querying after this runs; only the time before the first byte is counted
+    response.headers['Server-Timing'] = f"db;dur={g.get('db_time', 0.0) * 1000:.2f}"
+    response.headers['X-DB-Queries'] = str(g.get('db_queries', 0))
+    return response
+
+def init_app(app):
+    """
+    Time every SQL statement run while handling a request and report the total
+    in a Server-Timing header (used by load_test.py). Enabled by DB_TIMING_ENABLED.
+    """
+    if not app.config.get('DB_TIMING_ENABLED'):
+        return
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+    app.after_request(_add_timing_headers)
@@ -1,8 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-from openai import OpenAI
-import os
+import threading
+
+from config import Config
 
 # Database
 db = SQLAlchemy()
@@ -17,5 +18,30 @@ login_manager.login_message = '請登入以訪問此頁面。'
 login_manager.login_message_category = 'warning'
 
 # OpenAI Client
-# API Key will be loaded from config in create_app
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY")) 
\ No newline at end of file
+# Built on first use, so processes that never call OpenAI (flask db, create_admin.py,
+# workers before their first request) don't import openai/httpx or need an API key
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Return the process-wide OpenAI client, creating it on first call.
+    It shares one tuned, instrumented connection pool across all threads of the process.
+    Raises:
+        ValueError: If OPENAI_API_KEY is not configured.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if not Config.OPENAI_API_KEY:
+                    raise ValueError("OPENAI_API_KEY is not configured properly. Check your .env file.")
+                from openai import OpenAI
+                from http_transport import build_http_client
+                _client = OpenAI(
+                    api_key=Config.OPENAI_API_KEY,
+                    base_url=Config.OPENAI_BASE_URL, # The local fake server when OPENAI_FAKE is set
+                    http_client=build_http_client(),
+                    max_retries=Config.OPENAI_MAX_RETRIES
+                )
+    return _client
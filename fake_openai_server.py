@@ -0,0 +1,285 @@
+"""
+Local stand-in for the OpenAI chat completions API, for offline benchmarking and tests.
+
+    python fake_openai_server.py --port 8765 --ttft lognormal:0.8,0.5 --tokens-per-second 80
+    OPENAI_FAKE=true python app.py     # point extensions.get_client() at it
+
+Speaks the /v1/chat/completions wire format, streaming (SSE, with a final usage
+chunk when stream_options.include_usage is set) and non-streaming. Latency,
+completion length, prompt caching and error injection are configurable from
+the command line and at runtime:
+
+    curl -X POST localhost:8765/_fake/config -H 'Content-Type: application/json' \\
+         -d '{"error_rate": 0.5, "error_statuses": [503]}'
+
+Distributions are written as "fixed:S", "uniform:LO,HI", "normal:MEAN,STD",
+"lognormal:MEDIAN,SIGMA" or "exp:MEAN" (values in seconds or tokens).
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import Flask, Response, jsonify, request
+
+# OpenAI caches prompt prefixes of at least 1024 tokens, in 128-token increments
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+REASONING_MODEL_PREFIXES = ('o1', 'o3', 'o4')
+FILLER = "這是模擬回覆。This is a simulated reply. "
+
+def parse_distribution(spec):
+    """
+    Parse a distribution spec such as "uniform:0.2,1.5".
+    Returns:
+        callable: Zero-argument sampler returning a non-negative float.
+    """
+    kind, _, args = str(spec).partition(":")
+    if not args: # A bare number means a fixed value
+        kind, args = "fixed", kind
+    values = [float(v) for v in args.split(",")]
+    samplers = {
+        "fixed": lambda: values[0],
+        "uniform": lambda: random.uniform(values[0], values[1]),
+        "normal": lambda: random.gauss(values[0], values[1]),
+        "lognormal": lambda: random.lognormvariate(math.log(values[0]), values[1]),
+        "exp": lambda: random.expovariate(1 / values[0]),
+    }
+    if kind not in samplers:
+        raise ValueError(f"Unknown distribution '{kind}' in '{spec}'")
+    sampler = samplers[kind]
+    return lambda: max(0.0, sampler())
+
+def estimate_tokens(text):
+    """Same rough heuristic as utils.estimate_tokens: CJK ~1 token per char, else ~4 chars per token."""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uf900' <= ch <= '\ufaff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+class FakeSettings:
+    """Runtime-adjustable behaviour of the fake server."""
+    FIELDS = ("ttft", "tokens_per_second", "completion_tokens", "error_rate", "error_statuses",
+              "prompt_cache", "chunk_tokens")
+
+    def __init__(self, ttft="lognormal:0.6,0.4", tokens_per_second=80.0, completion_tokens="uniform:80,400",
+                 error_rate=0.0, error_statuses=(429, 500, 503), prompt_cache=True, chunk_tokens=4):
+        self._lock = threading.Lock()
+        self.update(ttft=ttft, tokens_per_second=tokens_per_second, completion_tokens=completion_tokens,
+                    error_rate=error_rate, error_statuses=error_statuses, prompt_cache=prompt_cache,
+                    chunk_tokens=chunk_tokens)
+
+    def update(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                if name not in self.FIELDS:
+                    raise ValueError(f"Unknown setting '{name}'")
+                if name in ("ttft", "completion_tokens"):
+                    setattr(self, f"_{name}_sample", parse_distribution(value))
+                elif name == "error_statuses":
+                    value = [int(status) for status in value]
+                setattr(self, name, value)
+
+    def as_dict(self):
+        with self._lock:
+            return {name: getattr(self, name) for name in self.FIELDS}
+
+    def sample_ttft(self):
+        return self._ttft_sample()
+
+    def sample_completion_tokens(self):
+        return max(1, int(self._completion_tokens_sample()))
+
+class PromptCache:
+    """Remembers message-list prefixes so repeated prefixes report cached_tokens like OpenAI."""
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached_tokens(self, model, messages):
+        """Return cached tokens for this request and remember its prefixes."""
+        digest = hashlib.sha256(model.encode("utf-8"))
+        cumulative = 0
+        cached = 0
+        prefixes = []
+        for message in messages:
+            digest.update(json.dumps(message, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+            cumulative += 4 + estimate_tokens(_content_text(message.get("content")))
+            prefixes.append((digest.hexdigest(), cumulative))
+        with self._lock:
+            for key, tokens in prefixes:
+                if key in self._seen:
+                    self._seen.move_to_end(key)
+                    cached = tokens
+                else:
+                    self._seen[key] = True
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        if cached < CACHE_MIN_TOKENS:
+            return 0
+        return cached // CACHE_INCREMENT * CACHE_INCREMENT
+
+def _content_text(content):
+    """Message content as text (content may be a list of parts)."""
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+def _error_response(status):
+    """OpenAI-style error body for an injected failure."""
+    error_types = {429: "rate_limit_exceeded", 500: "server_error", 502: "server_error",
+                   503: "server_error", 504: "server_error"}
+    body = {"error": {"message": f"Injected fake error ({status})", "type": error_types.get(status, "invalid_request_error"),
+                      "param": None, "code": error_types.get(status)}}
+    response = jsonify(body)
+    response.status_code = status
+    if status == 429:
+        response.headers["Retry-After"] = "1"
+    return response
+
+def _reply_text(completion_tokens):
+    """Filler text of roughly completion_tokens tokens."""
+    filler_tokens = estimate_tokens(FILLER)
+    return FILLER * max(1, completion_tokens // filler_tokens)
+
+def create_fake_app(settings=None):
+    """Build the fake OpenAI Flask app."""
+    app = Flask(__name__)
+    settings = settings or FakeSettings()
+    prompt_cache = PromptCache()
+    stats = {"requests": 0, "errors": 0}
+    stats_lock = threading.Lock()
+
+    @app.route("/v1/chat/completions", methods=["POST"])
+    def chat_completions():
+        body = request.get_json(force=True)
+        model = body.get("model", "o3-mini")
+        messages = body.get("messages", [])
+        with stats_lock:
+            stats["requests"] += 1
+
+        if settings.error_rate and random.random() < settings.error_rate:
+            with stats_lock:
+                stats["errors"] += 1
+            time.sleep(settings.sample_ttft() / 4) # Errors come back faster than answers
+            return _error_response(random.choice(settings.error_statuses))
+
+        prompt_tokens = sum(4 + estimate_tokens(_content_text(m.get("content"))) for m in messages) + 3
+        cached_tokens = prompt_cache.cached_tokens(model, messages) if settings.prompt_cache else 0
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        reasoning = model.startswith(REASONING_MODEL_PREFIXES)
+        output_tokens = settings.sample_completion_tokens()
+        reasoning_tokens = output_tokens // 2 if reasoning else 0
+        completion_tokens = output_tokens + reasoning_tokens
+        if max_tokens and completion_tokens > max_tokens:
+            completion_tokens = max_tokens
+            output_tokens = max(0, max_tokens - reasoning_tokens)
+        finish_reason = "length" if max_tokens and completion_tokens >= max_tokens else "stop"
+        text = _reply_text(output_tokens) if output_tokens else ""
+
+        completion_id = f"chatcmpl-fake-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "completion_tokens_details": {"reasoning_tokens": reasoning_tokens}
+        }
+        ttft = settings.sample_ttft()
+        seconds_per_token = 1 / settings.tokens_per_second if settings.tokens_per_second else 0.0
+
+        if not body.get("stream"):
+            time.sleep(ttft + completion_tokens * seconds_per_token)
+            return jsonify({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": finish_reason
+                }],
+                "usage": usage
+            })
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        def chunk(delta, finish=None, chunk_usage=None, choices=True):
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}] if choices else []}
+            if include_usage:
+                data["usage"] = chunk_usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        def generate():
+            # Reasoning happens before the first visible token
+            time.sleep(ttft + reasoning_tokens * seconds_per_token)
+            yield chunk({"role": "assistant", "content": ""})
+            step = max(1, settings.chunk_tokens)
+            filler_tokens = estimate_tokens(FILLER)
+            characters_per_token = max(1, len(FILLER) // filler_tokens)
+            for start in range(0, len(text), step * characters_per_token):
+                time.sleep(step * seconds_per_token)
+                yield chunk({"content": text[start:start + step * characters_per_token]})
+            yield chunk({}, finish=finish_reason)
+            if include_usage:
+                yield chunk(None, chunk_usage=usage, choices=False)
+            yield "data: [DONE]\n\n"
+
+        return Response(generate(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    @app.route("/v1/models", methods=["GET"])
+    def list_models():
+        return jsonify({"object": "list", "data": [
+            {"id": name, "object": "model", "owned_by": "fake"}
+            for name in ("o3-mini", "o4-mini", "gpt-4o", "gpt-4o-mini", "gpt-4.1", "gpt-4.1-mini", "gpt-4.1-nano")
+        ]})
+
+    @app.route("/_fake/config", methods=["GET", "POST"])
+    def fake_config():
+        if request.method == "POST":
+            try:
+                settings.update(**(request.get_json(force=True) or {}))
+            except (TypeError, ValueError) as e:
+                return jsonify({"status": "error", "message": str(e)}), 400
+        with stats_lock:
+            current_stats = dict(stats)
+        return jsonify({"status": "success", "settings": settings.as_dict(), "stats": current_stats})
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake OpenAI chat completions server.")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--ttft', default="lognormal:0.6,0.4", help="Time to first token distribution (seconds)")
+    parser.add_argument('--tokens-per-second', type=float, default=80.0, help="Generation speed; 0 for instant")
+    parser.add_argument('--completion-tokens', default="uniform:80,400", help="Visible completion length distribution")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests that fail")
+    parser.add_argument('--error-statuses', default="429,500,503", help="Comma-separated HTTP statuses to inject")
+    parser.add_argument('--no-prompt-cache', action='store_true', help="Always report cached_tokens=0")
+    parser.add_argument('--chunk-tokens', type=int, default=4, help="Tokens per streamed chunk")
+    args = parser.parse_args()
+
+    settings = FakeSettings(
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        error_rate=args.error_rate,
+        error_statuses=args.error_statuses.split(","),
+        prompt_cache=not args.no_prompt_cache,
+        chunk_tokens=args.chunk_tokens
+    )
+    print(f"Fake OpenAI server on http://{args.host}:{args.port}/v1 with {settings.as_dict()}")
+    create_fake_app(settings).run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import time
+
+import httpx
+
+import metrics
+from config import Config
+
+# Trace events that mark the moment a request got a connection from the pool:
+# either a new TCP connect starts or headers go out on a reused connection
+_CONNECTION_ACQUIRED_EVENTS = (
+    "connection.connect_tcp.started",
+    "http11.send_request_headers.started",
+    "http2.send_request_headers.started",
+)
+_SEND_HEADERS_EVENTS = _CONNECTION_ACQUIRED_EVENTS[1:]
+
+def _http2_available():
+    try:
+        import h2 # noqa: F401 - only checking that httpx's HTTP/2 extra is installed
+    except ImportError:
+        return False
+    return True
+
+class InstrumentedTransport(httpx.HTTPTransport):
+    """
+    HTTP transport that records, per request, how long it waited for a pooled
+    connection versus how long OpenAI took to send response headers.
+    """
+    def handle_request(self, request):
+        started = time.perf_counter()
+        marks = {}
+        upstream_trace = request.extensions.get("trace")
+
+        def trace(event_name, info):
+            if event_name in _CONNECTION_ACQUIRED_EVENTS:
+                marks.setdefault("acquired", time.perf_counter())
+            if event_name in _SEND_HEADERS_EVENTS:
+                marks.setdefault("sent", time.perf_counter())
+            if upstream_trace:
+                upstream_trace(event_name, info)
+
+        request.extensions = dict(request.extensions, trace=trace)
+        metrics.gauge("openai.http.in_flight").inc()
+        try:
+            response = super().handle_request(request)
+        except httpx.PoolTimeout:
+            metrics.counter("openai.http.pool_timeouts").inc()
+            raise
+        finally:
+            metrics.gauge("openai.http.in_flight").dec()
+            if "acquired" in marks:
+                metrics.histogram("openai.http.pool_wait_seconds").observe(marks["acquired"] - started)
+
+        # Response headers have arrived; the body may still be streaming
+        if "sent" in marks:
+            metrics.histogram("openai.http.upstream_headers_seconds").observe(time.perf_counter() - marks["sent"])
+        metrics.counter(f"openai.http.status.{response.status_code}").inc()
+        return response
+
+def build_timeout(connect, read, config):
+    """Build an httpx timeout from connect/read seconds plus the configured pool/write limits."""
+    return httpx.Timeout(read, connect=connect, write=config.OPENAI_WRITE_TIMEOUT, pool=config.OPENAI_POOL_TIMEOUT)
+
+def build_http_client(config=Config):
+    """
+    Build the pooled HTTP client shared by every OpenAI call in this process.
+    Args:
+        config: Config class with the OPENAI_* transport settings.
+    Returns:
+        httpx.Client
+    """
+    limits = httpx.Limits(
+        max_connections=config.OPENAI_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=config.OPENAI_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=config.OPENAI_KEEPALIVE_EXPIRY
+    )
+    transport = InstrumentedTransport(
+        limits=limits,
+        http2=config.OPENAI_HTTP2 and _http2_available(),
+        retries=0 # Retries are handled by llm.py
+    )
+    connect, read = config.OPENAI_TIMEOUTS['default']
+    return httpx.Client(transport=transport, timeout=build_timeout(connect, read, config))
+
+def request_timeout(key, config=Config):
+    """
+    Per-call timeout for a tool type or call site (e.g. 'chat', 'cr_classification').
+    Falls back to OPENAI_TIMEOUTS['default'].
+    """
+    connect, read = config.OPENAI_TIMEOUTS.get(key, config.OPENAI_TIMEOUTS['default'])
+    return build_timeout(connect, read, config)
@@ -0,0 +1,238 @@
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event, func, update
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import LLMJob
+import token_manager
+
+def enqueue(kind, user_id, chat_id, **payload):
+    """
+    Add an LLM job to the queue.
+    Args:
+        kind (str): 'chat', 'chat_fanout' or 'tool'.
+        user_id (int): The user who will be charged for the job.
+        chat_id (int): The chat the resulting assistant message belongs to.
+        **payload: Job arguments (instruction and request_params for chat; instructions
+                   and requests_by_instruction for chat_fanout; tool_type and user_input
+                   for tools; hold_id of the balance hold taken when the request was
+                   accepted). The requests are the ones the hold
+                   was priced on, so the worker does not route them again.
+    Returns:
+        LLMJob: The committed job.
+    """
+    job = LLMJob(kind=kind, user_id=user_id, chat_id=chat_id, payload=json.dumps(payload, ensure_ascii=False))
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def default_worker_id():
+    """Identify a worker process by host and PID."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_next(worker_id):
+    """
+    Atomically claim the oldest queued job.
+    The conditional UPDATE ensures only one worker wins a job, on SQLite and
+    Postgres alike, without relying on SELECT ... FOR UPDATE SKIP LOCKED.
+    Returns:
+        LLMJob or None: The claimed job, or None if the queue is empty.
+    """
+    for _ in range(5): # Retry when another worker claims the same job first
+        job_id = db.session.query(LLMJob.id).filter(
+            LLMJob.status == 'queued'
+        ).order_by(LLMJob.created_at, LLMJob.id).limit(1).scalar()
+        if job_id is None:
+            return None
+
+        claimed = LLMJob.query.filter(
+            LLMJob.id == job_id,
+            LLMJob.status == 'queued'
+        ).update({
+            LLMJob.status: 'running',
+            LLMJob.worker_id: worker_id,
+            LLMJob.started_at: datetime.utcnow(),
+            LLMJob.heartbeat_at: datetime.utcnow(),
+            LLMJob.attempts: LLMJob.attempts + 1
+        }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(LLMJob, job_id)
+    return None
+
+def requeue_stale_jobs():
+    """
+    Requeue jobs left 'running' by a worker that died mid-call, detected by a
+    heartbeat that stopped (a live worker keeps refreshing it however long the
+    call takes). Jobs that already used up their attempts are marked failed instead.
+    Returns:
+        int: Number of jobs requeued or failed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['LLM_JOB_STALE_SECONDS'])
+    stale = LLMJob.query.filter(LLMJob.status == 'running',
+                                func.coalesce(LLMJob.heartbeat_at, LLMJob.started_at) < cutoff)
+    failed = stale.filter(LLMJob.attempts >= current_app.config['LLM_JOB_MAX_ATTEMPTS']).update({
+        LLMJob.status: 'failed',
+        LLMJob.error: 'Worker timed out',
+        LLMJob.finished_at: datetime.utcnow()
+    }, synchronize_session=False)
+    requeued = stale.filter(LLMJob.attempts < current_app.config['LLM_JOB_MAX_ATTEMPTS']).update({
+        LLMJob.status: 'queued',
+        LLMJob.worker_id: None
+    }, synchronize_session=False)
+    db.session.commit()
+    return failed + requeued
+
+class JobOwnershipLost(Exception):
+    """Raised when a worker tries to commit results for a job that was requeued and claimed by another worker."""
+
+def _owned_by(job_id, worker_id):
+    """Filter for a job still running under worker_id."""
+    return (LLMJob.id == job_id, LLMJob.worker_id == worker_id, LLMJob.status == 'running')
+
+def _touch(session, job_id, worker_id):
+    """Refresh the job's heartbeat if worker_id still owns it. Returns False if it doesn't."""
+    result = session.execute(update(LLMJob).where(*_owned_by(job_id, worker_id))
+                             .values(heartbeat_at=datetime.utcnow())
+                             .execution_options(synchronize_session=False))
+    return result.rowcount > 0
+
+# The job (id, worker_id) whose results the current thread is writing, if any
+_running = threading.local()
+
+@event.listens_for(Session, 'before_commit')
+def _check_ownership(session):
+    """
+    Every commit made while a job runs (charges, assistant messages, holds) first
+    confirms, in the same transaction, that this worker still owns the job; if
+    it was requeued and claimed elsewhere, the commit fails and nothing is saved.
+    """
+    job = getattr(_running, 'job', None)
+    if job is not None and not _touch(session, *job):
+        raise JobOwnershipLost(f"LLM job {job[0]} is no longer owned by {job[1]}")
+
+class _Heartbeat:
+    """Refreshes a running job's heartbeat from a background thread until stopped."""
+    def __init__(self, app, job_id, worker_id):
+        self._app = app
+        self._job_id = job_id
+        self._worker_id = worker_id
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"job-heartbeat-{job_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        interval = self._app.config['LLM_JOB_HEARTBEAT_SECONDS']
+        while not self._stop.wait(interval):
+            with self._app.app_context():
+                try:
+                    owned = _touch(db.session, self._job_id, self._worker_id)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    self._app.logger.warning(f"LLM job {self._job_id}: heartbeat failed: {str(e)}")
+                    continue
+                finally:
+                    db.session.remove()
+            if not owned:
+                self._app.logger.warning(f"LLM job {self._job_id}: ownership lost, its result will be dropped")
+                return
+
+def run_job(job, worker_id):
+    """
+    Execute a claimed job and record its outcome. While it runs, the job's
+    heartbeat is kept fresh and every commit checks that worker_id still owns
+    it, so a job requeued from under a worker is never saved or charged twice.
+    Args:
+        job: The LLMJob returned by claim_next.
+        worker_id (str): The worker that claimed it.
+    """
+    job_id = job.id
+    app = current_app._get_current_object()
+    with _Heartbeat(app, job_id, worker_id):
+        _running.job = (job_id, worker_id)
+        try:
+            _execute_job(job, worker_id)
+        finally:
+            _running.job = None
+
+def _execute_job(job, worker_id):
+    # Imported here so the web tier can enqueue without loading the LLM modules
+    from chat_api import complete_chat, complete_fanout
+    from tools_api import process_tool_request, save_tool_message
+
+    payload = json.loads(job.payload)
+    try:
+        if job.kind == 'chat':
+            ai_message, _ = complete_chat(job.chat_id, job.user_id, payload['instruction'],
+                                          payload.get('request_params'), payload.get('hold_id'))
+            error = None
+        elif job.kind == 'chat_fanout':
+            ai_messages, _, errors = complete_fanout(job.chat_id, job.user_id, payload['instructions'],
+                                                     payload.get('requests_by_instruction'), payload.get('hold_id'))
+            ai_message = ai_messages[0]
+            for instruction, e in errors.items():
+                # The other replies were saved; the job still counts as done
+                current_app.logger.warning(f"LLM job {job.id}: {instruction} failed: {str(e)}")
+            error = None
+        elif job.kind == 'tool':
+            result = process_tool_request(payload['tool_type'], payload['user_input'], job.user_id,
+                                          payload.get('hold_id'))
+            # Tool errors are saved as an assistant message to show feedback, like the web path
+            ai_message = save_tool_message(job.chat_id, result, payload['tool_type'], job.user_id)
+            error = None if result['status'] == 'success' else result['message']
+        else:
+            raise ValueError(f"Unknown job kind: {job.kind}")
+    except JobOwnershipLost as e:
+        # Another worker owns the job now; it saves, charges and settles
+        db.session.rollback()
+        current_app.logger.warning(f"{str(e)}; dropping this worker's result")
+        return
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"LLM job {job.id} failed: {str(e)}")
+        _finish(job, worker_id, 'failed', str(e))
+        return
+
+    _finish(job, worker_id, 'done' if error is None else 'failed', error, ai_message.id)
+
+def _finish(job, worker_id, status, error, message_id=None):
+    """Record the outcome with an UPDATE conditional on ownership, then release the job's hold."""
+    job_id, user_id, payload = job.id, job.user_id, json.loads(job.payload)
+    _running.job = None # The completion UPDATE is itself conditional on ownership
+    finished = LLMJob.query.filter(*_owned_by(job_id, worker_id)).update({
+        LLMJob.status: status,
+        LLMJob.error: error,
+        LLMJob.message_id: message_id,
+        LLMJob.finished_at: datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    if not finished:
+        current_app.logger.warning(f"LLM job {job_id} is no longer owned by {worker_id}; outcome not recorded")
+        return
+    _settle_hold(user_id, payload)
+
+def _settle_hold(user_id, payload):
+    """Release the job's balance hold if charging the reply didn't already settle it (failed calls)."""
+    token_manager.settle(user_id, payload.get('hold_id'))
+
+def job_status(job):
+    """Serialize a job for the polling endpoint."""
+    return {
+        'id': job.id,
+        'status': job.status,
+        'error': job.error,
+        'message_id': job.message_id
+    }
@@ -0,0 +1,72 @@
+import threading
+
+import concurrency
+from config import Config
+from extensions import get_client
+from resilience import CircuitBreaker, CircuitOpenError, call_with_resilience # noqa: F401 - CircuitOpenError re-exported for callers
+
+# One breaker per model, so an incident on one model does not block the others
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(model):
+    """Get or create the circuit breaker guarding a model."""
+    with _breakers_lock:
+        breaker = _breakers.get(model)
+        if breaker is None:
+            breaker = _breakers[model] = CircuitBreaker(
+                model,
+                window_seconds=Config.LLM_BREAKER_WINDOW_SECONDS,
+                min_requests=Config.LLM_BREAKER_MIN_REQUESTS,
+                error_rate=Config.LLM_BREAKER_ERROR_RATE,
+                open_seconds=Config.LLM_BREAKER_OPEN_SECONDS
+            )
+        return breaker
+
+def breaker_states():
+    """Return the state of every model's breaker, for the metrics endpoint."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {model: breaker.state for model, breaker in breakers.items()}
+
+def create_chat_completion(request_params, timeout_key='default'):
+    """
+    The single entry point for chat completion calls.
+    Waits for a slot under the model's concurrency limit, applies the per-call
+    timeout, retries transient errors with jittered backoff and fails fast
+    while the model's circuit breaker is open. For streaming requests only
+    opening the stream is retried, and the slot is held until the stream is closed.
+    Args:
+        request_params (dict): Chat completions parameters (including stream).
+        timeout_key (str): Key into Config.OPENAI_TIMEOUTS (tool type or call site).
+    Returns:
+        The completion, or a stream of chunks if request_params['stream'] is set.
+    Raises:
+        CircuitOpenError: When the model's breaker is open, or (ConcurrencyLimitError)
+            when its concurrency limit is reached and the wait queue is full or timed out.
+    """
+    from http_transport import request_timeout # httpx is only loaded once the first LLM call is made
+    client = get_client()
+    timeout = request_timeout(timeout_key)
+    model = request_params.get("model", "unknown")
+    breaker = get_breaker(model)
+    # Fail fast before queueing: an open breaker must not hold callers (or wait-queue
+    # places meant for healthy traffic) for the slot wait, nor delay the router's fallback
+    breaker.check()
+    # The slot covers retries too, so backing off does not let more calls through
+    slot = concurrency.get_limiter(model).acquire()
+    try:
+        response = call_with_resilience(
+            lambda: client.chat.completions.create(**request_params, timeout=timeout),
+            breaker,
+            max_attempts=Config.LLM_RETRY_MAX_ATTEMPTS,
+            base_delay=Config.LLM_RETRY_BASE_DELAY,
+            max_delay=Config.LLM_RETRY_MAX_DELAY
+        )
+    except BaseException:
+        slot.release()
+        raise
+    if request_params.get("stream"):
+        return concurrency.ReleasingStream(response, slot)
+    slot.release()
+    return response
@@ -0,0 +1,307 @@
+"""
+End-to-end load test for the chat and tool endpoints.
+
+    python load_test.py --users 20 --duration 60                  # app + fake LLM in this process
+    python load_test.py --users 20 --duration 60 --stream         # use the SSE endpoints
+    python load_test.py --base-url http://127.0.0.1:8000 --users 50 --duration 120
+
+Synthetic students register, log in and run realistic sessions: a new chat in
+/quant, /verbal or /graph, several turns with occasional mode switches (so
+histories grow), and now and then a request to one of the /tools/* pages.
+
+By default the app and fake_openai_server.py run in this process on a temporary
+SQLite database. For deployment sizing run the app under its real server with
+OPENAI_FAKE=true, DB_TIMING_ENABLED=true and RATE_LIMIT_ENABLED=false and pass
+--base-url; the in-process servers share one Python interpreter with the load
+generator.
+
+Reports throughput, p50/p95/p99 latency, errors and DB time (from the
+Server-Timing header) per endpoint.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import httpx
+
+import metrics
+
+PASSWORD = "loadtest123"
+
+CHAT_INSTRUCTIONS = {
+    'quant': ['simple_explain', 'quick_solve', 'variant_question', 'concept_explanation', 'pattern_recognition'],
+    'verbal': ['simple_explain', 'quick_solve_cr_tpa', 'quick_solve_rc', 'mind_map', 'approach_diagnosis',
+               'logical_term_explanation'],
+    'graph': ['simple_explain', 'quick_solve', 'concept_explanation'],
+}
+TOOLS = {
+    'quant': ['math_classification', 'word_problem_converter'],
+    'verbal': ['cr_classification', 'distractor_mocker'],
+}
+QUESTIONS = {
+    'quant': [
+        "If x and y are positive integers and 3x + 2y = 24, how many ordered pairs (x, y) satisfy the equation?",
+        "一個數列的第n項為 a_n = 2n + 3，前20項的和是多少？",
+        "A store raises a price by 20% and then lowers it by 20%. What is the net percent change?",
+    ],
+    'verbal': [
+        "The city council argues that building a new stadium will increase tourism. Which of the following, if true, most weakens the argument?",
+        "請幫我分析這篇關於候鳥遷徙的文章的主旨與結構。",
+        "Scientists found that plants exposed to music grew faster. Which assumption does the conclusion rely on?",
+    ],
+    'graph': [
+        "The table shows quarterly sales for four regions. Which region had the largest percent increase from Q1 to Q4?",
+        "根據散佈圖，廣告支出與銷售額之間的相關係數最接近下列哪一個值？",
+    ],
+}
+FOLLOW_UPS = ["可以再解釋得更詳細一點嗎？", "Why is option C wrong?", "有沒有更快的方法？", "Can you give me a similar question?"]
+
+class Stats:
+    """Latency, DB time and error counts per endpoint."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = defaultdict(lambda: metrics.Histogram(window=1_000_000))
+        self.first_byte = defaultdict(lambda: metrics.Histogram(window=1_000_000))
+        self.db_time = defaultdict(lambda: metrics.Histogram(window=1_000_000))
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, response=None, error=False, first_byte=None):
+        db_seconds = None
+        if response is not None:
+            match = re.search(r"db;dur=([\d.]+)", response.headers.get("server-timing", ""))
+            if match:
+                db_seconds = float(match.group(1)) / 1000
+        with self._lock:
+            self.latency[endpoint].observe(seconds)
+            if first_byte is not None:
+                self.first_byte[endpoint].observe(first_byte)
+            if db_seconds is not None:
+                self.db_time[endpoint].observe(db_seconds)
+            if error:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed):
+        rows = {}
+        for endpoint in sorted(self.latency):
+            latency = self.latency[endpoint].snapshot()
+            db_time = self.db_time[endpoint].snapshot() if endpoint in self.db_time else None
+            first_byte = self.first_byte[endpoint].snapshot() if endpoint in self.first_byte else None
+            rows[endpoint] = {
+                "requests": latency["count"],
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": round(latency["count"] / elapsed, 3),
+                "latency": latency,
+                "first_byte": first_byte,
+                "db_time": db_time,
+            }
+        return rows
+
+def _normalise_endpoint(method, path):
+    """Group URLs by route, e.g. GET /tools/verbal_tool?chat_id=3 -> GET /tools/verbal_tool."""
+    return f"{method} {path.split('?')[0]}"
+
+class SyntheticStudent:
+    """One logged-in user running chat and tool sessions against the app."""
+    def __init__(self, index, base_url, stats, options, stop_at):
+        self.username = f"loadtest_{options.run_id}_{index}"
+        self.client = httpx.Client(base_url=base_url, timeout=options.timeout, follow_redirects=False)
+        self.stats = stats
+        self.options = options
+        self.stop_at = stop_at
+        self.rng = random.Random(f"{options.seed}-{index}")
+
+    def request(self, method, path, data=None, expect_redirect=False):
+        endpoint = _normalise_endpoint(method, path)
+        started = time.perf_counter()
+        try:
+            response = self.client.request(method, path, data=data)
+        except httpx.HTTPError as e:
+            self.stats.record(endpoint, time.perf_counter() - started, error=True)
+            print(f"{self.username}: {endpoint} failed: {e}")
+            return None
+        error = response.status_code >= 400 or (expect_redirect and response.status_code not in (301, 302, 303))
+        self.stats.record(endpoint, time.perf_counter() - started, response, error=error)
+        return response
+
+    def stream(self, path, data):
+        """POST to an SSE endpoint and read it to the end, timing the first delta as well."""
+        endpoint = _normalise_endpoint("POST", path)
+        started = time.perf_counter()
+        first_byte = None
+        error = False
+        response = None
+        try:
+            with self.client.stream("POST", path, data=data) as response:
+                if response.status_code != 200:
+                    response.read()
+                    error = True
+                else:
+                    for line in response.iter_lines():
+                        if line.startswith("event: delta") and first_byte is None:
+                            first_byte = time.perf_counter() - started
+                        elif line.startswith("event: error"):
+                            error = True
+        except httpx.HTTPError as e:
+            print(f"{self.username}: {endpoint} failed: {e}")
+            error = True
+        self.stats.record(endpoint, time.perf_counter() - started, response, error=error, first_byte=first_byte)
+
+    def sign_in(self):
+        self.request("POST", "/register", {"username": self.username, "email": f"{self.username}@example.com",
+                                           "password": PASSWORD})
+        response = self.request("POST", "/login", {"username": self.username, "password": PASSWORD},
+                                expect_redirect=True)
+        return response is not None and response.status_code in (302, 303)
+
+    def think(self):
+        if self.options.think_time:
+            time.sleep(self.rng.uniform(0, 2 * self.options.think_time))
+
+    def chat_session(self):
+        category = self.rng.choice(list(CHAT_INSTRUCTIONS))
+        instructions = CHAT_INSTRUCTIONS[category]
+        instruction = instructions[0]
+        self.request("GET", f"/new_chat/{category}")
+        self.request("GET", f"/{category}")
+        turns = self.rng.randint(self.options.min_turns, self.options.max_turns)
+        for turn in range(turns):
+            if time.monotonic() >= self.stop_at:
+                return
+            if turn and self.rng.random() < self.options.switch_rate:
+                instruction = self.rng.choice(instructions) # Mode switch mid-conversation
+            user_input = self.rng.choice(QUESTIONS[category]) if turn == 0 else self.rng.choice(FOLLOW_UPS)
+            form = {"user_input": user_input, "instruction": instruction}
+            if self.options.stream:
+                self.stream(f"/{category}/stream", form)
+            else:
+                self.request("POST", f"/{category}", form)
+            self.think()
+
+    def tool_session(self):
+        category = self.rng.choice(list(TOOLS))
+        path = f"/tools/{category}_tool"
+        self.request("GET", path) # Starts a new tool chat in the session
+        form = {"user_input": self.rng.choice(QUESTIONS[category]), "tool_type": self.rng.choice(TOOLS[category])}
+        if self.options.stream:
+            self.stream(f"{path}/stream", form)
+        else:
+            self.request("POST", path, form, expect_redirect=True)
+        self.think()
+
+    def run(self):
+        if not self.sign_in():
+            print(f"{self.username}: could not log in")
+            return
+        while time.monotonic() < self.stop_at:
+            if self.rng.random() < self.options.tool_ratio:
+                self.tool_session()
+            else:
+                self.chat_session()
+        self.client.close()
+
+def _serve_in_background(app, name):
+    """Serve a WSGI app on a free local port in a daemon thread; return its URL."""
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name=name, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def start_local_app(options):
+    """Start the fake LLM server and the app (on a temporary database) in this process."""
+    from fake_openai_server import FakeSettings, create_fake_app
+
+    fake_url = options.fake_url
+    if not fake_url:
+        settings = FakeSettings(ttft=options.ttft, tokens_per_second=options.tokens_per_second,
+                                completion_tokens=options.completion_tokens, error_rate=options.error_rate)
+        fake_url = _serve_in_background(create_fake_app(settings), "fake-openai") + "/v1"
+
+    # Must be set before config.py is imported
+    os.environ["OPENAI_FAKE"] = "true"
+    os.environ["OPENAI_FAKE_URL"] = fake_url
+    os.environ["DB_TIMING_ENABLED"] = "true"
+
+    from app import create_app
+    from config import Config
+
+    database = options.database or os.path.join(tempfile.mkdtemp(prefix="gmat-loadtest-"), "loadtest.db")
+
+    class LoadTestConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{database}"
+        DB_TIMING_ENABLED = True
+        RATE_LIMIT_ENABLED = False # Synthetic students submit faster than the per-user budget
+
+    print(f"Fake OpenAI at {fake_url}, database {database}")
+    return _serve_in_background(create_app(LoadTestConfig), "app")
+
+def print_report(report, elapsed, users):
+    total = sum(row["requests"] for row in report.values())
+    errors = sum(row["errors"] for row in report.values())
+    print(f"\n{users} users, {elapsed:.1f}s, {total} requests ({total / elapsed:.2f} req/s), {errors} errors\n")
+    header = f"{'endpoint':<34}{'reqs':>7}{'err':>6}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfb p50':>10}{'db p50':>9}{'db p95':>9}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, row in report.items():
+        latency, db_time, first_byte = row["latency"], row["db_time"], row["first_byte"]
+        print(f"{endpoint:<34}{row['requests']:>7}{row['errors']:>6}{row['throughput_rps']:>8.2f}"
+              f"{latency['p50']:>9.3f}{latency['p95']:>9.3f}{latency['p99']:>9.3f}"
+              f"{(first_byte['p50'] if first_byte else float('nan')):>10.3f}"
+              f"{(db_time['p50'] if db_time else float('nan')):>9.4f}"
+              f"{(db_time['p95'] if db_time else float('nan')):>9.4f}")
+    print("\nLatency columns are seconds.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the chat and tool endpoints with synthetic students.")
+    parser.add_argument('--base-url', help="Target a running app instead of starting one in this process")
+    parser.add_argument('--users', type=int, default=10, help="Concurrent synthetic students")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to run")
+    parser.add_argument('--ramp-up', type=float, default=5, help="Seconds over which users start")
+    parser.add_argument('--stream', action='store_true', help="Use the SSE endpoints")
+    parser.add_argument('--tool-ratio', type=float, default=0.25, help="Share of sessions that use a tool")
+    parser.add_argument('--min-turns', type=int, default=2)
+    parser.add_argument('--max-turns', type=int, default=6)
+    parser.add_argument('--switch-rate', type=float, default=0.3, help="Chance of a mode switch per follow-up turn")
+    parser.add_argument('--think-time', type=float, default=1.0, help="Mean seconds between a user's requests")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', default="gmat")
+    parser.add_argument('--json', help="Also write the report to this file")
+    local = parser.add_argument_group("in-process app")
+    local.add_argument('--database', help="SQLite file (default: a new temporary database)")
+    local.add_argument('--fake-url', help="Use an already running fake_openai_server.py, e.g. http://127.0.0.1:8765/v1")
+    local.add_argument('--ttft', default="lognormal:0.6,0.4")
+    local.add_argument('--tokens-per-second', type=float, default=80.0)
+    local.add_argument('--completion-tokens', default="uniform:80,400")
+    local.add_argument('--error-rate', type=float, default=0.0)
+    options = parser.parse_args()
+    options.run_id = f"{int(time.time())}"
+
+    base_url = options.base_url or start_local_app(options)
+    stats = Stats()
+    started = time.monotonic()
+    stop_at = started + options.duration
+    threads = []
+    for index in range(options.users):
+        student = SyntheticStudent(index, base_url, stats, options, stop_at)
+        thread = threading.Thread(target=student.run, name=student.username, daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(options.ramp_up / max(1, options.users))
+    for thread in threads:
+        # Let in-flight requests finish, but don't wait forever on a hung server
+        thread.join(timeout=max(0, stop_at - time.monotonic()) + options.timeout)
+    elapsed = time.monotonic() - started
+
+    report = stats.report(elapsed)
+    print_report(report, elapsed, options.users)
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as f:
+            json.dump({"users": options.users, "elapsed": elapsed, "stream": options.stream, "endpoints": report}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
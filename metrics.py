@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+
+class Counter:
+    """Monotonic, thread-safe counter."""
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def snapshot(self):
+        return self._value
+
+class Gauge:
+    """Thread-safe value that can go up and down (or be set)."""
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def snapshot(self):
+        return self._value
+
+class Histogram:
+    """
+    Running count/sum/max plus a window of recent samples for percentiles.
+    """
+    def __init__(self, window=1000):
+        self._samples = deque(maxlen=window)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total, maximum = self._count, self._sum, self._max
+
+        def percentile(p):
+            if not samples:
+                return 0.0
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 6)
+
+        return {
+            "count": count,
+            "mean": round(total / count, 6) if count else 0.0,
+            "max": round(maximum, 6),
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99)
+        }
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _get(name, metric_class):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class()
+        return metric
+
+def counter(name):
+    """Get or create the process-wide counter with this name."""
+    return _get(name, Counter)
+
+def gauge(name):
+    """Get or create the process-wide gauge with this name."""
+    return _get(name, Gauge)
+
+def histogram(name):
+    """Get or create the process-wide histogram with this name."""
+    return _get(name, Histogram)
+
+def snapshot():
+    """Return all metrics of this process, keyed by name."""
+    with _registry_lock:
+        metrics = dict(_registry)
+    return {name: metric.snapshot() for name, metric in sorted(metrics.items())}
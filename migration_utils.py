@@ -0,0 +1,50 @@
+"""
+Helpers for the Alembic revisions in migrations/versions.
+
+Databases deployed before migrations existed were built by db.create_all(),
+which creates missing tables at startup but never adds columns. A revision may
+therefore find its tables already there (and, on a fresh database, its columns
+too), so each step checks the live schema before changing it.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+def has_table(table):
+    return sa.inspect(op.get_bind()).has_table(table)
+
+def has_column(table, column):
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+def has_index(table, index):
+    return index in {i['name'] for i in sa.inspect(op.get_bind()).get_indexes(table)}
+
+def create_table(table, *columns, **kwargs):
+    """op.create_table unless the table exists."""
+    if not has_table(table):
+        op.create_table(table, *columns, **kwargs)
+
+def add_column(table, column):
+    """op.add_column unless the column exists."""
+    if not has_column(table, column.name):
+        op.add_column(table, column)
+
+def create_index(index, table, columns, **kwargs):
+    """op.create_index unless the index exists."""
+    if not has_index(table, index):
+        op.create_index(index, table, columns, **kwargs)
+
+def drop_table(table):
+    if has_table(table):
+        op.drop_table(table)
+
+def drop_columns(table, *columns):
+    """Drop columns (batch mode, so it works on SQLite)."""
+    existing = [column for column in columns if has_column(table, column)]
+    if existing:
+        with op.batch_alter_table(table) as batch_op:
+            for column in existing:
+                batch_op.drop_column(column)
+
+def drop_index(index, table):
+    if has_index(table, index):
+        op.drop_index(index, table_name=table)
@@ -0,0 +1,82 @@
+"""Baseline schema: users, chats, messages, balances and quotas
+
+Revision ID: 3f1c2a9d0b01
+Revises: 
+Create Date: 2026-10-18 09:00:00
+
+Databases created by db.create_all() before migrations existed already have
+these tables; upgrading them only records the revision.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d0b01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.create_table(
+        'user',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.String(length=100), nullable=False),
+        sa.Column('email', sa.String(length=100), nullable=False),
+        sa.Column('password', sa.String(length=200), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('email'),
+        sa.UniqueConstraint('username')
+    )
+    mu.create_table(
+        'chat',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('category', sa.String(length=50), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mu.create_table(
+        'message',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('role', sa.String(length=20), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+        sa.Column('completion_tokens', sa.Integer(), nullable=True),
+        sa.Column('cost', sa.Float(), nullable=True),
+        sa.Column('response_id', sa.String(length=100), nullable=True),
+        sa.ForeignKeyConstraint(['chat_id'], ['chat.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mu.create_table(
+        'user_token',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('balance', sa.Float(), nullable=False),
+        sa.Column('last_reset', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id')
+    )
+    mu.create_table(
+        'user_quota',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('total_tokens', sa.Integer(), nullable=True),
+        sa.Column('total_cost', sa.Float(), nullable=True),
+        sa.Column('last_updated', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id')
+    )
+
+
+def downgrade():
+    for table in ('user_quota', 'user_token', 'message', 'chat', 'user'):
+        mu.drop_table(table)
@@ -0,0 +1,49 @@
+"""LLM job queue (job_queue.py, worker.py)
+
+Revision ID: 7a4e91c3d2f2
+Revises: 3f1c2a9d0b01
+Create Date: 2026-10-18 09:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4e91c3d2f2'
+down_revision = '3f1c2a9d0b01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.create_table(
+        'llm_job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('worker_id', sa.String(length=100), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['chat_id'], ['chat.id']),
+        sa.ForeignKeyConstraint(['message_id'], ['message.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    # Added after the table first shipped, so create_all() left it out of existing queues
+    mu.add_column('llm_job', sa.Column('heartbeat_at', sa.DateTime(), nullable=True))
+    mu.create_index('ix_llm_job_status', 'llm_job', ['status'])
+    mu.create_index('ix_llm_job_created_at', 'llm_job', ['created_at'])
+
+
+def downgrade():
+    mu.drop_table('llm_job')
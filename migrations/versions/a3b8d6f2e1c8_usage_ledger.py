@@ -0,0 +1,59 @@
+"""Usage ledger and daily rollups
+
+Revision ID: a3b8d6f2e1c8
+Revises: f7c2e5a1d9b7
+Create Date: 2026-10-18 09:35:00
+
+Fill the new tables from the existing messages with backfill_usage.py after
+upgrading.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3b8d6f2e1c8'
+down_revision = 'f7c2e5a1d9b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.create_table(
+        'usage_ledger',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('instruction', sa.String(length=50), nullable=True),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+        sa.Column('completion_tokens', sa.Integer(), nullable=True),
+        sa.Column('cached_tokens', sa.Integer(), nullable=True),
+        sa.Column('cost', sa.Float(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['message_id'], ['message.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mu.create_index('ix_usage_ledger_user_id', 'usage_ledger', ['user_id'])
+    mu.create_index('ix_usage_ledger_created_at', 'usage_ledger', ['created_at'])
+    mu.create_table(
+        'usage_daily',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('requests', sa.Integer(), nullable=True),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+        sa.Column('completion_tokens', sa.Integer(), nullable=True),
+        sa.Column('cost', sa.Float(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'day')
+    )
+
+
+def downgrade():
+    mu.drop_table('usage_daily')
+    mu.drop_table('usage_ledger')
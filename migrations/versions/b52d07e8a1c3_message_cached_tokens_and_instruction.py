@@ -0,0 +1,29 @@
+"""Message cached_tokens and instruction
+
+Revision ID: b52d07e8a1c3
+Revises: 7a4e91c3d2f2
+Create Date: 2026-10-18 09:10:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'b52d07e8a1c3'
+down_revision = '7a4e91c3d2f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.add_column('message', sa.Column('cached_tokens', sa.Integer(), nullable=True))
+    mu.add_column('message', sa.Column('instruction', sa.String(length=50), nullable=True))
+    mu.create_index('ix_message_instruction', 'message', ['instruction'])
+
+
+def downgrade():
+    mu.drop_index('ix_message_instruction', 'message')
+    mu.drop_columns('message', 'instruction', 'cached_tokens')
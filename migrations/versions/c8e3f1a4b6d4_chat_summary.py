@@ -0,0 +1,27 @@
+"""Chat rolling summary
+
+Revision ID: c8e3f1a4b6d4
+Revises: b52d07e8a1c3
+Create Date: 2026-10-18 09:15:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e3f1a4b6d4'
+down_revision = 'b52d07e8a1c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.add_column('chat', sa.Column('summary', sa.Text(), nullable=True))
+    mu.add_column('chat', sa.Column('summary_upto_id', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    mu.drop_columns('chat', 'summary_upto_id', 'summary')
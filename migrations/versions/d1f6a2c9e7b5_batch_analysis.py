@@ -0,0 +1,59 @@
+"""Batch analysis tables
+
+Revision ID: d1f6a2c9e7b5
+Revises: c8e3f1a4b6d4
+Create Date: 2026-10-18 09:20:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f6a2c9e7b5'
+down_revision = 'c8e3f1a4b6d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.create_table(
+        'analysis_batch',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('batch_id', sa.String(length=100), nullable=False),
+        sa.Column('backend', sa.String(length=20), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('input_file_id', sa.String(length=100), nullable=True),
+        sa.Column('output_file_id', sa.String(length=100), nullable=True),
+        sa.Column('request_count', sa.Integer(), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('batch_id')
+    )
+    mu.create_table(
+        'user_analysis',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('batch_id', sa.Integer(), nullable=True),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('questions_count', sa.Integer(), nullable=True),
+        sa.Column('model', sa.String(length=50), nullable=True),
+        sa.Column('prompt_tokens', sa.Integer(), nullable=True),
+        sa.Column('completion_tokens', sa.Integer(), nullable=True),
+        sa.Column('cost', sa.Float(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['batch_id'], ['analysis_batch.id']),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mu.create_index('ix_user_analysis_user_id', 'user_analysis', ['user_id'])
+    mu.create_index('ix_user_analysis_created_at', 'user_analysis', ['created_at'])
+
+
+def downgrade():
+    mu.drop_table('user_analysis')
+    mu.drop_table('analysis_batch')
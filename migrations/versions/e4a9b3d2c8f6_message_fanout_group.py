@@ -0,0 +1,28 @@
+"""Message fanout_group
+
+Revision ID: e4a9b3d2c8f6
+Revises: d1f6a2c9e7b5
+Create Date: 2026-10-18 09:25:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9b3d2c8f6'
+down_revision = 'd1f6a2c9e7b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    mu.add_column('message', sa.Column('fanout_group', sa.String(length=32), nullable=True))
+    mu.create_index('ix_message_fanout_group', 'message', ['fanout_group'])
+
+
+def downgrade():
+    mu.drop_index('ix_message_fanout_group', 'message')
+    mu.drop_columns('message', 'fanout_group')
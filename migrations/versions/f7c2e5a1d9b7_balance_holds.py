@@ -0,0 +1,40 @@
+"""Balance holds
+
+Revision ID: f7c2e5a1d9b7
+Revises: e4a9b3d2c8f6
+Create Date: 2026-10-18 09:30:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+import migration_utils as mu
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7c2e5a1d9b7'
+down_revision = 'e4a9b3d2c8f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # server_default fills the column for the balances that already exist
+    mu.add_column('user_token', sa.Column('held', sa.Float(), nullable=False, server_default='0'))
+    mu.create_table(
+        'balance_hold',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Float(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    mu.create_index('ix_balance_hold_user_id', 'balance_hold', ['user_id'])
+    mu.create_index('ix_balance_hold_expires_at', 'balance_hold', ['expires_at'])
+
+
+def downgrade():
+    mu.drop_table('balance_hold')
+    mu.drop_columns('user_token', 'held')
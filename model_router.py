@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+
+from flask import current_app
+
+import concurrency
+import llm
+import metrics
+from config import Config
+from resilience import CircuitBreaker, CircuitOpenError, is_retryable
+from token_counter import estimate_request_tokens
+from utils import calculate_cost
+
+# Request parameters reasoning models reject
+_SAMPLING_PARAMS = ("temperature", "top_p", "presence_penalty", "frequency_penalty", "logprobs", "top_logprobs")
+
+# Exponentially weighted moving average of blocking-call latency per model
+_LATENCY_ALPHA = 0.2
+_latency_ewma = {}
+_latency_lock = threading.Lock()
+
+# Policies declared outside config.py (tool definitions in tool_registry.json)
+_registered_policies = {}
+
+def register_policy(key, policy):
+    """Register a routing policy; an entry for the same key in Config.MODEL_POLICIES takes precedence."""
+    _registered_policies[key] = policy
+
+def get_policy(key):
+    """
+    Routing policy for a tool type or chat instruction key ("chat:<instruction>").
+    Chat instructions without their own policy use 'chat'; anything else unknown uses 'default'.
+    Returns:
+        dict: model, max_tokens, fallback, latency_slo and optionally reasoning_effort.
+    """
+    policies = Config.MODEL_POLICIES
+    if key in policies:
+        return policies[key]
+    if key in _registered_policies:
+        return _registered_policies[key]
+    if key and key.startswith("chat:"):
+        return policies['chat']
+    return policies['default']
+
+def is_reasoning_model(model):
+    """True for o-series reasoning models, which take max_completion_tokens and no sampling params."""
+    return (model or "").startswith(Config.REASONING_MODEL_PREFIXES)
+
+def adapt_params(request_params, model, policy):
+    """
+    Return a copy of request_params targeted at model: the token limit uses the
+    parameter name the model accepts, and parameters it rejects are dropped.
+    """
+    params = dict(request_params, model=model)
+    max_tokens = policy.get('max_tokens') or params.get('max_completion_tokens') or params.get('max_tokens')
+    params.pop('max_tokens', None)
+    params.pop('max_completion_tokens', None)
+    if is_reasoning_model(model):
+        for name in _SAMPLING_PARAMS:
+            params.pop(name, None)
+        if policy.get('reasoning_effort') and model == policy['model']:
+            params['reasoning_effort'] = policy['reasoning_effort']
+        if max_tokens:
+            params['max_completion_tokens'] = max_tokens
+    else:
+        params.pop('reasoning_effort', None)
+        if max_tokens:
+            params['max_tokens'] = max_tokens
+    return params
+
+def record_latency(model, seconds):
+    """Fold one blocking-call latency into the model's moving average."""
+    with _latency_lock:
+        previous = _latency_ewma.get(model)
+        _latency_ewma[model] = seconds if previous is None else previous + _LATENCY_ALPHA * (seconds - previous)
+    metrics.histogram(f"llm.latency_seconds.{model}").observe(seconds)
+
+def latency_snapshot():
+    """Current moving-average latency per model, in seconds."""
+    with _latency_lock:
+        return {model: round(value, 3) for model, value in _latency_ewma.items()}
+
+def _primary_unhealthy(policy):
+    """The primary is skipped while its breaker is open or its recent latency breaks the SLO."""
+    if llm.get_breaker(policy['model']).state == CircuitBreaker.OPEN:
+        return True
+    with _latency_lock:
+        latency = _latency_ewma.get(policy['model'])
+    if latency is None or not policy.get('latency_slo') or latency <= policy['latency_slo']:
+        return False
+    # Keep sending a share of traffic to the primary so its average can recover
+    return random.random() >= Config.MODEL_ROUTER_PROBE_RATIO
+
+def route(request_params, key):
+    """
+    Pick the model for a request from its policy and adapt the parameters to it.
+    Args:
+        request_params (dict): Request without (or with a placeholder) model and token limit.
+        key (str): Tool type, or "chat:<instruction>" for chat turns.
+    Returns:
+        dict: Request parameters ready to send.
+    """
+    policy = get_policy(key)
+    model = policy['model']
+    if policy.get('fallback') and _primary_unhealthy(policy):
+        model = policy['fallback']
+        metrics.counter(f"llm.router.{key}.fallback_routed").inc()
+    return adapt_params(request_params, model, policy)
+
+def estimate_worst_case_cost(request_params, key):
+    """
+    Pre-flight worst-case cost of a routed request (prompt tokens counted locally
+    plus its reply token bound). complete() may re-send the request to the
+    policy's fallback model and the reply is billed at that model's prices, so
+    the estimate is the higher of the routed and fallback models' costs.
+    Args:
+        request_params (dict): Parameters returned by route().
+        key (str): The routing key passed to route().
+    Returns:
+        float: Estimated cost.
+    """
+    policy = get_policy(key)
+    candidates = [request_params]
+    fallback = policy.get('fallback')
+    if fallback and fallback != request_params.get('model'):
+        candidates.append(adapt_params(request_params, fallback, policy))
+    costs = []
+    for params in candidates:
+        prompt_tokens, completion_tokens = estimate_request_tokens(params)
+        costs.append(calculate_cost(prompt_tokens, completion_tokens, model=params["model"])[2])
+    return max(costs)
+
+def check_admission(key):
+    """
+    Pre-flight admission control, run before anything is saved for a request:
+    reject it now if neither its primary nor its fallback model could take it.
+    Raises:
+        concurrency.ConcurrencyLimitError: When every candidate model's wait queue is full.
+    """
+    policy = get_policy(key)
+    limiters = [concurrency.get_limiter(model) for model in (policy['model'], policy.get('fallback')) if model]
+    if not any(limiter.admits() for limiter in limiters):
+        metrics.counter(f"llm.router.{key}.not_admitted").inc()
+        raise concurrency.ConcurrencyLimitError(policy['model'], min(limiter.retry_after() for limiter in limiters))
+
+def complete(request_params, key, timeout_key=None):
+    """
+    Send a routed request through llm.create_chat_completion. If the chosen
+    model fails with an upstream error (after retries) or its breaker is open,
+    the request is sent once more to the policy's fallback model.
+    Args:
+        request_params (dict): Parameters returned by route().
+        key (str): The routing key passed to route().
+        timeout_key (str, optional): Key into Config.OPENAI_TIMEOUTS; defaults to key.
+    Returns:
+        The completion, or a stream of chunks for streaming requests.
+    """
+    from openai import OpenAIError # Not imported at module level, to keep app startup light
+    timeout_key = timeout_key or key
+    policy = get_policy(key)
+    fallback = policy.get('fallback')
+    started = time.perf_counter()
+    try:
+        response = llm.create_chat_completion(request_params, timeout_key)
+    except (CircuitOpenError, OpenAIError) as e:
+        if not fallback or request_params.get('model') == fallback or not _should_fall_back(e):
+            raise
+        current_app.logger.warning(f"Model {request_params.get('model')} failed for {key} ({e}); falling back to {fallback}")
+        metrics.counter(f"llm.router.{key}.fallback_on_error").inc()
+        request_params = adapt_params(request_params, fallback, policy)
+        started = time.perf_counter()
+        response = llm.create_chat_completion(request_params, timeout_key)
+    if not request_params.get('stream'):
+        record_latency(request_params['model'], time.perf_counter() - started)
+    return response
+
+def _should_fall_back(error):
+    """Fall back on upstream trouble, not on errors caused by the request itself."""
+    return isinstance(error, CircuitOpenError) or is_retryable(error)
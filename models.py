@@ -21,6 +21,9 @@ class Chat(db.Model):
     category = db.Column(db.String(50), nullable=False) # Increased length for tool categories
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     messages = db.relationship('Message', backref='chat', lazy=True, cascade="all, delete-orphan") # Added cascade delete
+    # Rolling summary of older turns that no longer fit the history token budget (see chat_history.py)
+    summary = db.Column(db.Text, nullable=True)
+    summary_upto_id = db.Column(db.Integer, nullable=True) # ID of the newest message folded into summary
 
 # Message model from original app.py
 class Message(db.Model):
@@ -33,20 +36,108 @@ class Message(db.Model):
     completion_tokens = db.Column(db.Integer, default=0)
     cost = db.Column(db.Float, default=0.0)
     response_id = db.Column(db.String(100), nullable=True)
+    cached_tokens = db.Column(db.Integer, default=0) # Prompt tokens served from OpenAI's prompt cache
+    instruction = db.Column(db.String(50), nullable=True, index=True) # Chat instruction or tool type that produced the reply
+    fanout_group = db.Column(db.String(32), nullable=True, index=True) # Shared by the replies of one multi-mode turn (chat_api.complete_fanout)
 
 # UserToken model from token_manager.py
 class UserToken(db.Model):
     __tablename__ = 'user_token'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True) # Ensure one token record per user
-    balance = db.Column(db.Float, default=5.0, nullable=False)  # Initial balance 5
+    balance = db.Column(db.Float, default=5.0, nullable=False)  # Initial balance 5 (Config.WEEKLY_BALANCE)
     last_reset = db.Column(db.DateTime, default=datetime.utcnow)
+    held = db.Column(db.Float, default=0.0, nullable=False) # Sum of the user's active BalanceHold amounts
+
+# Estimated cost reserved for an LLM call in flight (see token_manager.reserve)
+class BalanceHold(db.Model):
+    __tablename__ = 'balance_hold'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True) # Reaped after this if never settled
 
 # UserQuota model from original models.py
+# All-time usage totals, maintained incrementally with each UsageLedger entry (see usage_ledger.py)
 class UserQuota(db.Model):
     __tablename__ = 'user_quota'
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, unique=True) # Ensure one quota record per user
     total_tokens = db.Column(db.Integer, default=0)
     total_cost = db.Column(db.Float, default=0.0)
-    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    last_updated = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Append-only record of the tokens and cost of each assistant reply (see usage_ledger.py)
+class UsageLedger(db.Model):
+    __tablename__ = 'usage_ledger'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    kind = db.Column(db.String(20), nullable=False) # chat, tool
+    instruction = db.Column(db.String(50), nullable=True)
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    cached_tokens = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    message = db.relationship('Message')
+
+# Per-user, per-day usage totals, maintained incrementally with each UsageLedger entry
+class UsageDaily(db.Model):
+    __tablename__ = 'usage_daily'
+    __table_args__ = (db.UniqueConstraint('user_id', 'day'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False) # UTC date
+    requests = db.Column(db.Integer, default=0)
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+
+# Background LLM job executed by worker.py (see job_queue.py)
+class LLMJob(db.Model):
+    __tablename__ = 'llm_job'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False) # chat, chat_fanout, tool
+    payload = db.Column(db.Text, nullable=False) # JSON arguments for the job
+    status = db.Column(db.String(20), default='queued', nullable=False, index=True) # queued, running, done, failed
+    error = db.Column(db.Text, nullable=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True) # Assistant message produced by the job
+    worker_id = db.Column(db.String(100), nullable=True)
+    attempts = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True) # Refreshed by the owning worker while the job runs
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+# OpenAI Batch API job for cohort question analysis (see batch_analysis.py)
+class AnalysisBatch(db.Model):
+    __tablename__ = 'analysis_batch'
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(100), unique=True, nullable=False) # OpenAI (or local stand-in) batch ID
+    backend = db.Column(db.String(20), default='openai', nullable=False) # openai, local
+    status = db.Column(db.String(20), default='validating', nullable=False) # Batch API status, plus 'ingested'
+    input_file_id = db.Column(db.String(100), nullable=True)
+    output_file_id = db.Column(db.String(100), nullable=True)
+    request_count = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+    analyses = db.relationship('UserAnalysis', backref='batch', lazy=True)
+
+# Persisted result of analysing one student's questions
+class UserAnalysis(db.Model):
+    __tablename__ = 'user_analysis'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey('analysis_batch.id'), nullable=True) # None for synchronous analyses
+    content = db.Column(db.Text, nullable=False)
+    questions_count = db.Column(db.Integer, default=0)
+    model = db.Column(db.String(50), nullable=True)
+    prompt_tokens = db.Column(db.Integer, default=0)
+    completion_tokens = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,138 @@
+"""
+Per-user token-bucket rate limiting for the chat and tool POST endpoints.
+
+Each (scope, user) pair has a bucket of Config.RATE_LIMITS[scope]['capacity']
+tokens refilled at 'per_minute' tokens per minute; every POST takes one.
+Over-limit requests are rejected before the view runs, so nothing is written
+to the database. Buckets live in this process ('memory') or in a local SQLite
+file shared by all app processes on the host ('sqlite').
+"""
+import os
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, flash, jsonify, redirect, request
+from flask_login import current_user
+
+import metrics
+
+def take_token(tokens, updated, now, capacity, per_second):
+    """
+    Refill a bucket up to now and try to take one token.
+    Args:
+        tokens (float): Tokens left at the last update (None for a new bucket).
+        updated (float): Time of the last update.
+    Returns:
+        tuple: (allowed, tokens left, seconds until a token is available)
+    """
+    if tokens is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, tokens + (now - updated) * per_second)
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / per_second
+
+class MemoryBackend:
+    """
+    Buckets in a dict; each app process limits on its own.
+    A bucket that has refilled to capacity behaves exactly like a new one, so
+    such buckets are evicted by a sweep every SWEEP_INTERVAL seconds; the dict
+    only holds users who posted within the last refill time.
+    """
+    SWEEP_INTERVAL = 60
+
+    def __init__(self):
+        self._buckets = {} # key -> (tokens, updated, time the bucket is full again)
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def take(self, key, capacity, per_second):
+        now = time.time()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (None, now, now))
+            allowed, tokens, retry_after = take_token(tokens, updated, now, capacity, per_second)
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / per_second)
+            if now - self._last_sweep >= self.SWEEP_INTERVAL:
+                self._sweep(now)
+        return allowed, retry_after
+
+    def _sweep(self, now):
+        """Drop buckets that are full again. Call with the lock held."""
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[2] > now}
+        self._last_sweep = now
+
+class SQLiteBackend:
+    """Buckets in a local SQLite file so all processes on the host share them."""
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return conn
+
+    def take(self, key, capacity, per_second):
+        conn = self._connect()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (None, now)
+            allowed, tokens, retry_after = take_token(tokens, updated, now, capacity, per_second)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, retry_after
+
+def init_app(app):
+    """Create the bucket backend selected by RATE_LIMIT_BACKEND."""
+    if app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+        backend = SQLiteBackend(app.config['RATE_LIMIT_SQLITE_PATH'])
+    else:
+        backend = MemoryBackend()
+    app.extensions['rate_limit'] = backend
+
+def rate_limited(scope, json_response=False):
+    """
+    Limit POSTs to the decorated view per logged-in user (apply below @login_required).
+    Args:
+        scope (str): Key into Config.RATE_LIMITS; views sharing a scope share a bucket.
+        json_response (bool): Answer over-limit requests with 429 JSON (fetch/SSE
+            endpoints) instead of a flash message and a redirect back to the page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            if request.method != 'POST' or not current_app.config['RATE_LIMIT_ENABLED']:
+                return view(*args, **kwargs)
+            budget = current_app.config['RATE_LIMITS'][scope]
+            allowed, retry_after = current_app.extensions['rate_limit'].take(
+                f"{scope}:{current_user.id}", budget['capacity'], budget['per_minute'] / 60.0)
+            if allowed:
+                return view(*args, **kwargs)
+
+            metrics.counter(f"rate_limit.{scope}.rejected").inc()
+            retry_after = max(1, int(retry_after + 0.999))
+            message = f"請求過於頻繁，請於 {retry_after} 秒後再試。"
+            if json_response:
+                response = jsonify({'status': 'error', 'message': message, 'retry_after': retry_after})
+                response.status_code = 429
+                response.headers['Retry-After'] = str(retry_after)
+                return response
+            flash(message, "warning")
+            return redirect(request.url)
+        return decorated_function
+    return decorator
@@ -0,0 +1,167 @@
+import random
+import threading
+import time
+from collections import deque
+
+import metrics
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while a circuit breaker is open."""
+    def __init__(self, name, retry_after):
+        self.name = name
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"AI 服務目前繁忙或暫時無法使用，請於 {self.retry_after} 秒後再試。")
+
+class CircuitBreaker:
+    """
+    Error-rate circuit breaker over a rolling time window.
+
+    closed:    calls pass; outcomes are recorded.
+    open:      calls fail fast with CircuitOpenError for open_seconds once the
+               window has at least min_requests calls and the error rate
+               reaches error_rate.
+    half_open: after open_seconds a single trial call is let through; its
+               outcome closes or re-opens the breaker.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+
+    def __init__(self, name, window_seconds=60, min_requests=10, error_rate=0.5, open_seconds=30):
+        self.name = name
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self._outcomes = deque() # (timestamp, succeeded)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now):
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._set_state(self.HALF_OPEN)
+        return self._state
+
+    def _set_state(self, state):
+        self._state = state
+        metrics.gauge(f"llm.breaker.{self.name}.open").set(1 if state == self.OPEN else 0)
+        if state == self.OPEN:
+            metrics.counter(f"llm.breaker.{self.name}.opened").inc()
+
+    def _reject_if_open(self, now):
+        state = self._current_state(now)
+        if state == self.OPEN:
+            metrics.counter(f"llm.breaker.{self.name}.rejected").inc()
+            raise CircuitOpenError(self.name, self.open_seconds - (now - self._opened_at))
+        if state == self.HALF_OPEN and self._trial_in_flight:
+            metrics.counter(f"llm.breaker.{self.name}.rejected").inc()
+            raise CircuitOpenError(self.name, 1)
+        return state
+
+    def check(self):
+        """
+        Raise CircuitOpenError if a call would fail fast, without claiming the
+        half-open trial (before_call does that when the call is made).
+        """
+        with self._lock:
+            self._reject_if_open(time.monotonic())
+
+    def before_call(self):
+        """Raise CircuitOpenError if the call must fail fast."""
+        with self._lock:
+            if self._reject_if_open(time.monotonic()) == self.HALF_OPEN:
+                self._trial_in_flight = True
+
+    def record(self, succeeded):
+        """Record the outcome of a call that passed before_call."""
+        now = time.monotonic()
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._trial_in_flight = False
+                self._outcomes.clear()
+                if succeeded:
+                    self._set_state(self.CLOSED)
+                else:
+                    self._opened_at = now
+                    self._set_state(self.OPEN)
+                return
+
+            self._outcomes.append((now, succeeded))
+            while self._outcomes and now - self._outcomes[0][0] > self.window_seconds:
+                self._outcomes.popleft()
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if (self._state == self.CLOSED and len(self._outcomes) >= self.min_requests
+                    and failures / len(self._outcomes) >= self.error_rate):
+                self._opened_at = now
+                self._set_state(self.OPEN)
+
+def is_retryable(exc):
+    """True for transient upstream errors: timeouts, connection errors, 408/409/429 and 5xx."""
+    import openai # Already loaded by the client that raised exc; kept out of module import time
+    if isinstance(exc, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError,
+                        openai.InternalServerError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+def _retry_after_seconds(exc):
+    """Read a Retry-After header (seconds) from an API error, if present."""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+def backoff_delay(attempt, base_delay, max_delay, retry_after=None):
+    """
+    Full-jitter exponential backoff for the given (0-based) retry attempt,
+    never shorter than a server-provided Retry-After.
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+def call_with_resilience(fn, breaker, max_attempts=3, base_delay=0.5, max_delay=8.0):
+    """
+    Call fn() through a circuit breaker, retrying transient errors with
+    jittered exponential backoff.
+    Args:
+        fn: Zero-argument callable performing the upstream request.
+        breaker (CircuitBreaker): Breaker guarding the upstream.
+        max_attempts (int): Total attempts including the first.
+    Returns:
+        Whatever fn returns.
+    Raises:
+        CircuitOpenError: If the breaker is open.
+        Exception: The last error once retries are exhausted, or any non-retryable error.
+    """
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            retryable = is_retryable(e)
+            # Only upstream trouble counts against the breaker, not our own bad requests
+            breaker.record(succeeded=not retryable)
+            if not retryable:
+                raise
+            attempt += 1
+            if attempt >= max_attempts:
+                metrics.counter("llm.retries_exhausted").inc()
+                raise
+            metrics.counter("llm.retries").inc()
+            time.sleep(backoff_delay(attempt - 1, base_delay, max_delay, _retry_after_seconds(e)))
+            continue
+        breaker.record(succeeded=True)
+        return result
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+def normalise_text(text):
+    """Normalise text for cache keys: NFKC, trimmed, with whitespace runs collapsed."""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+def make_cache_key(tool_type, model, system_prompt, user_input):
+    """
+    Build a content-addressed cache key for a tool request.
+    Returns:
+        str: SHA-256 hex digest of the normalised request parts.
+    """
+    parts = [tool_type or "", model or "", normalise_text(system_prompt), normalise_text(user_input)]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire after a TTL.
+    Per process: each gunicorn worker keeps its own cache.
+    """
+    def __init__(self, max_entries=1000, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or expired entry."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key) # Mark as most recently used
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Store value under key, evicting the least recently used entries if full."""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
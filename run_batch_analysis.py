@@ -0,0 +1,43 @@
+"""
+Weekly cohort analysis through the OpenAI Batch API.
+
+    python run_batch_analysis.py submit --days 7   # build JSONL and submit a batch
+    python run_batch_analysis.py poll              # poll unfinished batches and ingest results
+
+Set ANALYSIS_BATCH_BACKEND=local to run requests synchronously without the Batch API.
+"""
+import argparse
+from datetime import datetime, timedelta
+
+from app import create_app
+from models import AnalysisBatch
+import batch_analysis
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse student questions with the Batch API.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    submit_parser = subparsers.add_parser('submit', help="Submit a new analysis batch")
+    submit_parser.add_argument('--days', type=int, default=None, help="Only include questions from the last N days")
+    subparsers.add_parser('poll', help="Poll unfinished batches and ingest completed results")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        if args.command == 'submit':
+            since = datetime.utcnow() - timedelta(days=args.days) if args.days else None
+            analysis_batch = batch_analysis.submit_batch(since=since)
+            if analysis_batch:
+                print(f"Submitted batch {analysis_batch.batch_id} with {analysis_batch.request_count} requests")
+            else:
+                print("No questions to analyse.")
+            return
+
+        pending = AnalysisBatch.query.filter(AnalysisBatch.status != 'ingested').all()
+        for analysis_batch in pending:
+            if analysis_batch.status in batch_analysis.FINAL_STATUSES and analysis_batch.status != 'completed':
+                continue
+            batch_analysis.poll_batch(analysis_batch)
+            print(f"Batch {analysis_batch.batch_id}: {analysis_batch.status}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import threading
+
+import metrics
+
+class FlightAbandoned(Exception):
+    """The leading caller gave up (e.g. its client disconnected) before producing a result."""
+
+class Flight:
+    """One in-flight call that any number of callers can wait on."""
+    def __init__(self):
+        self.participants = 1 # The leader plus every caller that joined before it finished
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    def wait(self):
+        """Block until the leader finishes; return its value or raise its error."""
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key so that only the first one
+    (the leader) does the work and the others wait for and share its result.
+    Per process: each gunicorn worker coalesces its own requests.
+    """
+    def __init__(self, name="singleflight"):
+        self.name = name
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def begin(self, key):
+        """
+        Join the in-flight call for key, or start one.
+        Returns:
+            tuple: (Flight, bool: True if the caller is the leader and must call finish)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.participants += 1
+                metrics.counter(f"{self.name}.coalesced").inc()
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def finish(self, key, flight, value=None, error=None):
+        """Publish the leader's result (or error) and wake every waiter."""
+        with self._lock:
+            # No caller can join once the flight is removed, so participants is final
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.value = value
+            flight.error = error
+        flight._done.set()
+
+    def do(self, key, fn):
+        """
+        Call fn() once for all concurrent callers with the same key.
+        Returns:
+            tuple: (fn's result, int: number of callers served, bool: True if shared from another caller)
+        """
+        flight, leader = self.begin(key)
+        if not leader:
+            return flight.wait(), flight.participants, True
+        try:
+            value = fn()
+        except BaseException as e:
+            self.finish(key, flight, error=e if isinstance(e, Exception) else FlightAbandoned())
+            raise
+        self.finish(key, flight, value=value)
+        return value, flight.participants, False
+
+    def in_flight(self):
+        """Number of keys currently being computed."""
+        with self._lock:
+            return len(self._flights)
@@ -0,0 +1,67 @@
+from functools import lru_cache
+
+from utils import estimate_tokens
+
+# tiktoken is optional: without it, counts fall back to utils.estimate_tokens
+try:
+    import tiktoken
+except ImportError: # pragma: no cover - depends on the environment
+    tiktoken = None
+
+# Fixed overhead OpenAI adds per message (role/separators) and per reply priming
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+@lru_cache(maxsize=16)
+def _get_encoder(model):
+    """Return a cached tiktoken encoder for the model, or None if unavailable."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Newer models (o3-mini, gpt-4o-mini, ...) share the o200k vocabulary
+        return tiktoken.get_encoding("o200k_base")
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text, model="o3-mini"):
+    """
+    Count tokens in a piece of text. Memoised per (text, model), so history
+    messages are only encoded once across the turns of a chat.
+    """
+    if not text:
+        return 0
+    encoder = _get_encoder(model)
+    if encoder is None:
+        return estimate_tokens(text)
+    return len(encoder.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages, model="o3-mini"):
+    """
+    Count the prompt tokens of a chat completions message list.
+    Args:
+        messages (list): Messages in chat completions format.
+        model (str): Model whose tokenizer should be used.
+    Returns:
+        int: Estimated prompt tokens.
+    """
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_text_tokens(message.get("content") or "", model)
+    return total
+
+def estimate_request_tokens(request_params, default_max_tokens=0):
+    """
+    Estimate prompt and worst-case completion tokens for a request.
+    Args:
+        request_params (dict): Chat completions request parameters.
+        default_max_tokens (int): Completion bound used if the request sets none.
+    Returns:
+        tuple: (int prompt_tokens, int max_completion_tokens)
+    """
+    model = request_params.get("model", "o3-mini")
+    prompt_tokens = count_message_tokens(request_params.get("messages", []), model)
+    completion_tokens = (request_params.get("max_completion_tokens")
+                         or request_params.get("max_tokens")
+                         or default_max_tokens)
+    return prompt_tokens, completion_tokens
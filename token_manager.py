@@ -1,9 +1,12 @@
 from datetime import datetime, timedelta
-from flask import current_app # To access logger if needed
+from flask import current_app, g, has_request_context # current_app to access logger if needed
+from flask_login import current_user
+from sqlalchemy import case, or_, select, update
+from sqlalchemy.exc import IntegrityError
 
 # Import db from extensions and UserToken model from models
 from extensions import db
-from models import UserToken, User # Import User to handle relationship if needed
+from models import UserToken, BalanceHold
 
 _app = None
 
@@ -19,142 +22,442 @@ def init_app(app):
     # No need to define UserTokenModel here, it's imported from models.py
     # Ensure tables are created within the app context if needed elsewhere
     # Typically handled by Flask-Migrate or initial db.create_all()
-    pass
+
+    # Templates get the signed-in user's balance as balance_context (loaded only if used)
+    app.context_processor(_inject_balance_context)
+
+def _inject_balance_context():
+    return {'balance_context': get_balance_context()}
+
+class BalanceContext:
+    """
+    The signed-in user's balance for one request (flask.g.balance_context).
+    user_token is read at most once, when the balance is first needed; the
+    token_manager calls the request makes afterwards (reserve, deduct_balance,
+    settle) update it in place from the results of their atomic UPDATEs
+    instead of reading it again.
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._balance = None
+        self._held = None
+
+    def _load(self):
+        if self._balance is not None and self._held is not None:
+            return
+        token = db.session.query(UserToken.balance, UserToken.last_reset, UserToken.held).filter(
+            UserToken.user_id == self.user_id).first()
+        if token is None:
+            balance, held = current_app.config['WEEKLY_BALANCE'], 0.0
+        else:
+            balance, held = effective_balance(token), token.held or 0.0
+        # Values already set by this request's own writes are newer than the row read here
+        if self._balance is None:
+            self._balance = balance
+        if self._held is None:
+            self._held = held
+
+    @property
+    def balance(self):
+        self._load()
+        return self._balance
+
+    @property
+    def available(self):
+        """Balance minus the amounts held for requests in flight."""
+        self._load()
+        return self._balance - self._held
+
+    @property
+    def next_reset(self):
+        return get_next_reset_time()
+
+    @property
+    def days_until_reset(self):
+        return (self.next_reset - datetime.utcnow()).days
+
+    def _set(self, balance=None, held=None):
+        if balance is not None:
+            self._balance = balance
+        if held is not None:
+            self._held = held
+
+def _balance_context(user_id):
+    """The request's BalanceContext if user_id is the signed-in user, else None (other users, no request)."""
+    if not has_request_context():
+        return None
+    context = g.get('balance_context')
+    if context is None:
+        if not current_user.is_authenticated:
+            return None
+        context = g.balance_context = BalanceContext(current_user.id)
+    return context if context.user_id == user_id else None
+
+def get_balance_context():
+    """
+    The signed-in user's BalanceContext for this request.
+    Returns:
+        BalanceContext or None: None outside a request or for anonymous users.
+    """
+    if not has_request_context() or not current_user.is_authenticated:
+        return None
+    return _balance_context(current_user.id)
+
+def _ensure_token(user_id):
+    """
+    Create the user's UserToken row if it doesn't exist, as one insert-or-ignore
+    statement starting at the weekly balance. Safe when several requests of a
+    new user race. Does not commit.
+    """
+    balance = current_app.config['WEEKLY_BALANCE']
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        db.session.execute(insert(UserToken).values(user_id=user_id, balance=balance)
+                           .on_conflict_do_nothing(index_elements=['user_id']))
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(UserToken(user_id=user_id, balance=balance))
+    except IntegrityError:
+        pass # Created concurrently by another request
+
+def _update_returning():
+    """True if the database returns rows from UPDATE (PostgreSQL, SQLite 3.35+)."""
+    dialect = db.engine.dialect
+    return getattr(dialect, 'update_returning', getattr(dialect, 'full_returning', False))
+
+def _reset_due(boundary):
+    """SQL condition: the row's last reset is older than the reset boundary."""
+    return or_(UserToken.last_reset.is_(None), UserToken.last_reset < boundary)
+
+def _update_and_read(statement, user_id, *columns):
+    """
+    Run an UPDATE of one user's row and read columns of the updated row, with
+    RETURNING where supported.
+    Returns:
+        Row or None: The columns, or None if the UPDATE matched no row.
+    """
+    if _update_returning():
+        return db.session.execute(statement.returning(*columns)).first()
+    # Fallback: the UPDATE holds the row (SQLite: database) write lock until commit, so reading back is safe
+    if db.session.execute(statement).rowcount == 0:
+        return None
+    return db.session.execute(select(*columns).where(UserToken.user_id == user_id)).first()
+
+def _current_balance(now):
+    """
+    SQL for the balance with a due weekly reset applied, and for the matching
+    last_reset. Writing both lets any UPDATE materialise the reset.
+    """
+    due = _reset_due(get_last_reset_time(now))
+    return (case((due, current_app.config['WEEKLY_BALANCE']), else_=UserToken.balance),
+            case((due, now), else_=UserToken.last_reset))
+
+def _apply_deduction(user_id, cost, release=0.0):
+    """
+    Subtract cost from the balance (floored at 0) and release amount from the
+    held total in one conditional UPDATE. A weekly reset that is due is written
+    by the same UPDATE: the cost is then taken from the weekly balance instead.
+    Returns:
+        Row or None: The new (balance, held), or None if the user has no UserToken row.
+    """
+    current, last_reset = _current_balance(datetime.utcnow())
+    values = {
+        'balance': case((current > cost, current - cost), else_=0.0),
+        'last_reset': last_reset
+    }
+    if release:
+        values['held'] = case((UserToken.held > release, UserToken.held - release), else_=0.0)
+    statement = (update(UserToken)
+                 .where(UserToken.user_id == user_id)
+                 .values(**values)
+                 .execution_options(synchronize_session=False)) # Loaded tokens are expired by the commit
+    return _update_and_read(statement, user_id, UserToken.balance, UserToken.held)
 
 def check_balance(user_id, cost=0):
     """
     Check if user balance is sufficient for a cost.
-    Creates a UserToken record if one doesn't exist.
-    Also checks for weekly reset.
+    Read-only: a due weekly reset is applied to the result, not written
+    (see effective_balance). Users without a UserToken record have the
+    weekly balance. For the signed-in user the request's BalanceContext
+    answers, so user_token is read at most once per request.
     Args:
         user_id: The user's ID.
         cost: The cost of the operation (default: 0).
     Returns:
         tuple: (bool: True if balance is sufficient, float: current balance)
     """
+    context = _balance_context(user_id)
+    if context is not None:
+        return context.available >= cost, context.available
     token = UserToken.query.filter_by(user_id=user_id).first()
-    
     if not token:
-        token = UserToken(user_id=user_id) # Default balance is set in the model
-        db.session.add(token)
-        # Commit immediately or rely on commit after operation?
-        # Committing here ensures token exists before reset check
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error creating UserToken for {user_id}: {str(e)}")
-            # Decide how to handle this error, maybe return insufficient balance
-            return False, 0.0 
-    
-    # Check if balance needs resetting
-    check_weekly_reset(token)
-    
-    # Check if balance is sufficient
-    return token.balance >= cost, token.balance
+        available = current_app.config['WEEKLY_BALANCE']
+    else:
+        # Amounts held for requests in flight are not available
+        available = effective_balance(token) - (token.held or 0.0)
+    return available >= cost, available
 
 def deduct_balance(user_id, cost):
     """
     Deduct cost from user's balance.
-    Creates a UserToken record if one doesn't exist.
-    Also checks for weekly reset before deduction.
+    A single conditional UPDATE (with RETURNING where supported), so concurrent
+    requests of one user never lose each other's deductions. Creates the
+    UserToken record on the first charge, and writes a weekly reset that is
+    due before deducting.
     Args:
         user_id: The user's ID.
         cost: The cost to deduct.
     Returns:
         float: The new balance after deduction.
     """
-    token = UserToken.query.filter_by(user_id=user_id).first()
-    
-    if not token:
-        token = UserToken(user_id=user_id)
-        db.session.add(token)
-        # Commit needed before reset check and deduction
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error creating UserToken for {user_id} during deduction: {str(e)}")
-            return 0.0 # Return 0 balance on error
-            
-    # Check for reset before deduction
-    check_weekly_reset(token)
-    
     # Ensure cost is non-negative
     cost = max(0, cost)
     
-    # Deduct cost
-    token.balance -= cost
-    
-    # Prevent negative balance
-    token.balance = max(0, token.balance)
-    
     try:
+        row = _apply_deduction(user_id, cost)
+        if row is None:
+            # First charge for this user: create the row, then deduct
+            _ensure_token(user_id)
+            row = _apply_deduction(user_id, cost)
         db.session.commit()
-        print(f"User {user_id} deducted {cost:.6f}, current balance: {token.balance:.6f}") # Use logger in production
+        balance = row.balance
+        context = _balance_context(user_id)
+        if context is not None:
+            context._set(balance=row.balance, held=row.held)
+        print(f"User {user_id} deducted {cost:.6f}, current balance: {balance:.6f}") # Use logger in production
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Error committing balance deduction for {user_id}: {str(e)}")
-        # Return the balance before the failed commit? Or 0?
-        # Returning the potentially incorrect balance might be misleading
         return 0.0 # Return 0 on commit error
         
-    return token.balance
+    return balance
+
+def _delete_holds(query):
+    """
+    Delete the holds selected by query. Does not commit.
+    Returns:
+        list: (user_id, amount) of the holds deleted by this call.
+    """
+    deleted = []
+    for hold in query.all():
+        # Delete first: only the request that deletes a hold releases its amount
+        if BalanceHold.query.filter(BalanceHold.id == hold.id).delete(synchronize_session=False):
+            deleted.append((hold.user_id, hold.amount))
+    return deleted
 
-def check_weekly_reset(token):
+def _reap_holds(query):
+    """
+    Release and delete the holds selected by query, one UPDATE per user. Does not commit.
+    Returns:
+        int: Number of holds released.
+    """
+    deleted = _delete_holds(query)
+    released = {}
+    for user_id, amount in deleted:
+        released[user_id] = released.get(user_id, 0.0) + amount
+    for user_id, amount in released.items():
+        UserToken.query.filter(UserToken.user_id == user_id).update({
+            UserToken.held: case((UserToken.held > amount, UserToken.held - amount), else_=0.0)
+        }, synchronize_session=False)
+    return len(deleted)
+
+def _hold(user_id, amount, now):
+    """
+    Add amount to the held total if the available balance covers it, in one
+    conditional UPDATE that also writes a due weekly reset.
+    Returns:
+        Row or None: The new (balance, held), or None if the UPDATE matched no row.
     """
-    Check if the user's balance needs to be reset (every Sunday UTC).
+    current, last_reset = _current_balance(now)
+    statement = (update(UserToken)
+                 .where(UserToken.user_id == user_id, current - UserToken.held >= amount)
+                 .values(balance=current, last_reset=last_reset, held=UserToken.held + amount)
+                 .execution_options(synchronize_session=False))
+    return _update_and_read(statement, user_id, UserToken.balance, UserToken.held)
+
+def reserve(user_id, amount, ttl_seconds=None):
+    """
+    Pre-authorise a request: hold its estimated worst-case cost so parallel
+    requests can't together spend more than the balance. The check, the hold
+    and any due weekly reset are one conditional UPDATE; the row is only read
+    (and created for a new user) when that UPDATE matches nothing. The
+    user's expired holds are reaped first.
+    Args:
+        user_id: The user's ID.
+        amount (float): Estimated maximum cost of the request.
+        ttl_seconds (int, optional): Lifetime of the hold (default BALANCE_HOLD_TTL_SECONDS).
+    Returns:
+        tuple: (int hold ID or None if the available balance is insufficient,
+                float available balance before the hold)
+    """
+    amount = max(0.0, amount)
+    now = datetime.utcnow()
+    ttl_seconds = ttl_seconds or current_app.config['BALANCE_HOLD_TTL_SECONDS']
+    hold_id = None
+    try:
+        _reap_holds(BalanceHold.query.filter(BalanceHold.user_id == user_id, BalanceHold.expires_at < now))
+        row = _hold(user_id, amount, now)
+        if row is None:
+            # Either insufficient or a new user without a row
+            token = db.session.execute(select(UserToken.balance, UserToken.last_reset, UserToken.held)
+                                       .where(UserToken.user_id == user_id)).first()
+            if token is None:
+                _ensure_token(user_id)
+                row = _hold(user_id, amount, now)
+        if row is None:
+            balance = effective_balance(token, now) if token else current_app.config['WEEKLY_BALANCE']
+            held = (token.held or 0.0) if token else 0.0
+            available = balance - held
+        else:
+            balance, held = row.balance, row.held
+            available = balance - held + amount
+            hold = BalanceHold(user_id=user_id, amount=amount, created_at=now,
+                               expires_at=now + timedelta(seconds=ttl_seconds))
+            db.session.add(hold)
+            db.session.flush() # Assigns the ID without a read after commit
+            hold_id = hold.id
+        db.session.commit() # Also keeps the reaping when the hold was refused
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error reserving {amount:.6f} for user {user_id}: {str(e)}")
+        return None, 0.0
+
+    context = _balance_context(user_id)
+    if context is not None:
+        context._set(balance=balance, held=held)
+    return hold_id, available
+
+def settle(user_id, hold_id, cost=0.0):
+    """
+    Finish a reserved request: charge its actual cost and release its hold in
+    one UPDATE. Safe to call again, or after the hold was reaped; the hold is
+    only released once, and a later call without a cost touches no balance.
+    Args:
+        user_id: The user's ID.
+        hold_id (int): ID returned by reserve (None is ignored).
+        cost (float): Actual cost to deduct.
+    Returns:
+        float or None: The new balance if cost was deducted, else None.
+    """
+    cost = max(0.0, cost)
+    row = None
+    try:
+        released = 0.0
+        if hold_id is not None:
+            released = sum(amount for _, amount in _delete_holds(BalanceHold.query.filter(BalanceHold.id == hold_id)))
+        if released or cost > 0:
+            row = _apply_deduction(user_id, cost, release=released)
+            if row is None and cost > 0:
+                _ensure_token(user_id)
+                row = _apply_deduction(user_id, cost)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error settling hold {hold_id} for user {user_id}: {str(e)}")
+        return None
+
+    if row is None:
+        return None
+    context = _balance_context(user_id)
+    if context is not None:
+        context._set(balance=row.balance, held=row.held)
+    return row.balance if cost > 0 else None
+
+def charge(user_id, cost, hold_id=None):
+    """
+    Charge a completed reply. With the request's hold_id the charge also
+    settles the hold, in the same UPDATE; without it this is deduct_balance.
+    Returns:
+        float: The new balance.
+    """
+    if hold_id is None:
+        return deduct_balance(user_id, cost)
+    balance = settle(user_id, hold_id, cost)
+    return balance if balance is not None else get_balance(user_id)
+
+def reap_expired_holds():
+    """
+    Release every expired hold (requests that crashed or were abandoned before settling).
+    Returns:
+        int: Number of holds released.
+    """
+    reaped = _reap_holds(BalanceHold.query.filter(BalanceHold.expires_at < datetime.utcnow()))
+    db.session.commit()
+    return reaped
+
+def get_last_reset_time(now=None):
+    """
+    The most recent weekly reset time (Sunday 00:00 UTC) at or before now.
+    Returns:
+        datetime: Balances last reset before this are due for a reset.
+    """
+    now = now or datetime.utcnow()
+    last_sunday = now.date() - timedelta(days=(now.weekday() + 1) % 7) # Monday is 0, Sunday is 6
+    return datetime.combine(last_sunday, datetime.min.time())
+
+def effective_balance(token, now=None):
+    """
+    The user's balance with a due weekly reset applied, computed without writing.
+    The reset itself is written by the next deduction or hold (or reset_balances).
     Args:
         token: The UserToken object.
+    Returns:
+        float: The balance the user can spend (before holds).
+    """
+    last_reset = token.last_reset
+    if last_reset is None or last_reset < get_last_reset_time(now):
+        return current_app.config['WEEKLY_BALANCE']
+    return token.balance
+
+def _write_due_resets(query, now):
+    """Reset the balances selected by query whose weekly reset is due, in one UPDATE. Does not commit."""
+    return query.filter(_reset_due(get_last_reset_time(now))).update({
+        UserToken.balance: current_app.config['WEEKLY_BALANCE'],
+        UserToken.last_reset: now
+    }, synchronize_session=False)
+
+def reset_balances(due_only=True):
+    """
+    Reset balances to the weekly balance with one set-based UPDATE.
+    Args:
+        due_only (bool): Only reset users whose weekly reset is due (safe to run on a
+            schedule, any number of times); False resets every user.
+    Returns:
+        int: Number of users reset.
     """
     now = datetime.utcnow()
-    # Check if it's a different week OR a different year, and if today is Sunday (6)
-    needs_reset = False
-    if token.last_reset.year < now.year:
-        needs_reset = True
-    elif token.last_reset.isocalendar()[1] < now.isocalendar()[1]:
-         needs_reset = True
-
-    if needs_reset and now.weekday() == 6: # Sunday is 6
-        old_balance = token.balance
-        token.balance = 5.0  # Reset to 5
-        token.last_reset = now
-        try:
-            db.session.commit() # Commit the reset
-            print(f"User {token.user_id} balance reset to 5.0 from {old_balance:.6f}") # Use logger
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error committing weekly reset for user {token.user_id}: {str(e)}")
-            # Revert changes if commit fails?
-            token.balance = old_balance
-            token.last_reset = token.last_reset # Keep old reset time
+    if due_only:
+        count = _write_due_resets(UserToken.query, now)
+    else:
+        count = UserToken.query.update({
+            UserToken.balance: current_app.config['WEEKLY_BALANCE'],
+            UserToken.last_reset: now
+        }, synchronize_session=False)
+    db.session.commit()
+    return count
 
 def get_balance(user_id):
     """
     Get the current balance for a user.
-    Creates a UserToken record if one doesn't exist.
-    Also checks for weekly reset.
+    Read-only, like check_balance: a due weekly reset is applied to the result,
+    and the signed-in user's balance comes from the request's BalanceContext.
     Args:
         user_id: The user's ID.
     Returns:
         float: The current balance.
     """
+    context = _balance_context(user_id)
+    if context is not None:
+        return context.balance
     token = UserToken.query.filter_by(user_id=user_id).first()
-    
     if not token:
-        token = UserToken(user_id=user_id)
-        db.session.add(token)
-        try:
-            db.session.commit()
-        except Exception as e:
-             db.session.rollback()
-             current_app.logger.error(f"Error creating UserToken for {user_id} in get_balance: {str(e)}")
-             return 0.0
-             
-    # Check for reset
-    check_weekly_reset(token)
-    
-    return token.balance
+        return current_app.config['WEEKLY_BALANCE']
+    return effective_balance(token)
 
 def get_next_reset_time():
     """
@@ -162,17 +465,4 @@ def get_next_reset_time():
     Returns:
         datetime: The datetime of the next reset.
     """
-    now = datetime.utcnow()
-    days_until_sunday = (6 - now.weekday() + 7) % 7 # Days until next Sunday
-    
-    # If today is Sunday, the next reset is next Sunday unless it's exactly 00:00:00
-    if days_until_sunday == 0 and (now.hour > 0 or now.minute > 0 or now.second > 0 or now.microsecond > 0):
-        days_until_sunday = 7
-        
-    # Calculate the date of the next Sunday
-    next_sunday_date = (now + timedelta(days=days_until_sunday)).date()
-    
-    # Combine with 00:00:00 time
-    next_reset_time = datetime.combine(next_sunday_date, datetime.min.time())
-    
-    return next_reset_time
\ No newline at end of file
+    return get_last_reset_time() + timedelta(days=7)
@@ -0,0 +1,93 @@
+"""
+Registry of the tools served under /tools, loaded once at startup from
+tool_registry.json (Config.TOOL_REGISTRY_PATH). Adding a tool only needs a
+new JSON entry:
+
+    id              tool_type sent by the form
+    category        quant, verbal or core (the /tools/<category>_tool page)
+    name, description, icon
+                    card shown on the tool page (icon is a Font Awesome class)
+    system_prompt   system message sent before the user's input
+    temperature, top_p
+                    optional sampling parameters (dropped for reasoning models)
+    model, max_tokens, fallback, latency_slo, reasoning_effort
+                    routing policy (see model_router.py)
+    streaming       whether replies are streamed to the page
+    cacheable       whether identical inputs are answered from the response cache
+"""
+import json
+
+from config import Config
+import model_router
+
+REQUIRED_FIELDS = ("id", "category", "name", "system_prompt", "model")
+POLICY_FIELDS = ("model", "max_tokens", "fallback", "latency_slo", "reasoning_effort")
+SAMPLING_FIELDS = ("temperature", "top_p")
+
+class Tool:
+    """One tool definition with its request template built once."""
+    def __init__(self, definition):
+        missing = [field for field in REQUIRED_FIELDS if not definition.get(field)]
+        if missing:
+            raise ValueError(f"Tool definition {definition.get('id', '?')} is missing {', '.join(missing)}")
+        self.id = definition["id"]
+        self.category = definition["category"]
+        self.name = definition["name"]
+        self.description = definition.get("description", "")
+        self.icon = definition.get("icon", "fa-tools")
+        self.streaming = definition.get("streaming", True)
+        self.cacheable = definition.get("cacheable", False)
+        self.policy = {field: definition[field] for field in POLICY_FIELDS if field in definition}
+        # Request template: the system message and sampling parameters never change per request
+        self._system_message = {"role": "system", "content": definition["system_prompt"]}
+        self._params = {field: definition[field] for field in SAMPLING_FIELDS if field in definition}
+
+    def build_request(self, user_input):
+        """Build the routed chat completions request for a user input."""
+        request_data = dict(self._params, messages=[self._system_message, {"role": "user", "content": user_input}])
+        return model_router.route(request_data, self.id)
+
+    def as_option(self):
+        """The tool as shown on its page (see the theme cards in the tool templates)."""
+        return {"id": self.id, "name": self.name, "description": self.description, "icon": self.icon}
+
+_tools = {}
+_categories = {}
+
+def load_registry(path=None):
+    """
+    (Re)load the tool definitions and register their routing policies.
+    Raises:
+        ValueError: On an invalid or duplicate definition.
+    """
+    with open(path or Config.TOOL_REGISTRY_PATH, encoding="utf-8") as f:
+        definitions = json.load(f)["tools"]
+
+    tools, categories = {}, {}
+    for definition in definitions:
+        tool = Tool(definition)
+        if tool.id in tools:
+            raise ValueError(f"Duplicate tool id {tool.id}")
+        tools[tool.id] = tool
+        categories.setdefault(tool.category, []).append(tool.as_option())
+
+    for tool in tools.values():
+        model_router.register_policy(tool.id, tool.policy)
+    _tools.clear()
+    _tools.update(tools)
+    _categories.clear()
+    _categories.update(categories)
+
+def get_tool(tool_id):
+    """Return the Tool for a tool_type, or None if it is not registered."""
+    return _tools.get(tool_id)
+
+def tools_for_category(category):
+    """Card options for the tools of a category, in definition order."""
+    return _categories.get(category, [])
+
+def is_cacheable(tool_id):
+    tool = _tools.get(tool_id)
+    return tool is not None and tool.cacheable
+
+load_registry()
@@ -1,202 +1,460 @@
-import os
-from datetime import datetime # Needed if update_user_quota is kept
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
 
 # Import client from extensions and config for prices
-from extensions import client, db # Import db if update_user_quota is kept
+from extensions import db
 from config import Config
 import token_manager # Use token_manager for balance deductions
-# from models import UserQuota # Import UserQuota if update_user_quota is kept
+from models import Message
+from response_cache import ResponseCache, make_cache_key
+from singleflight import SingleFlight, FlightAbandoned
+from llm import CircuitOpenError
+import model_router
+import tool_registry
+import usage_ledger
+import utils
+
+EMPTY_CONTENT = "Error: Could not parse response content."
+
+# In-process cache for deterministic tools (see Config.CACHEABLE_TOOLS)
+tool_response_cache = ResponseCache(Config.TOOL_CACHE_MAX_ENTRIES, Config.TOOL_CACHE_TTL_SECONDS)
+# Identical cacheable requests already in flight share one upstream call
+tool_singleflight = SingleFlight("tools.singleflight")
 
 # Use prices from Config
-def calculate_cost(input_tokens, cached_tokens, output_tokens, model="gpt-4o"):
+def calculate_cost(input_tokens, cached_tokens, output_tokens, model=None):
     """
     Calculate API request cost based on tokens and model pricing from config.
     Args:
         input_tokens (int): Input token count.
         cached_tokens (int): Cached input token count.
         output_tokens (int): Output token count.
-        model (str): Model name (currently only gpt-4o supported).
+        model (str): Model name, priced from Config.MODEL_PRICING.
     Returns:
         float: Calculated cost in USD.
     """
-    if model == "gpt-4o":
-        non_cached_input = input_tokens - cached_tokens
-        input_cost = non_cached_input * Config.GPT4O_INPUT_PRICE_PER_TOKEN
-        cached_cost = cached_tokens * Config.GPT4O_CACHED_INPUT_PRICE_PER_TOKEN
-        output_cost = output_tokens * Config.GPT4O_OUTPUT_PRICE_PER_TOKEN
-        return input_cost + cached_cost + output_cost
-    else:
-        # Extend for other models if needed
-        return 0.0
+    return utils.calculate_cost(input_tokens, output_tokens, cached_tokens, model)[2]
 
-# Function to handle common API call logic
-def _make_api_call(request_data, user_id):
-    """Internal function to make OpenAI API call, calculate cost, and deduct balance."""
+# Doubled escapes the model sometimes emits for LaTeX delimiters: \\( \\) \\[ \\]
+_LATEX_ESCAPE_PATTERN = re.compile(r'\\\\([()\[\]])')
+
+def fix_latex_escapes(content):
+    """Collapse doubled backslashes in front of LaTeX delimiters."""
+    return _LATEX_ESCAPE_PATTERN.sub(r'\\\1', content)
+
+class LatexEscapeFixer:
+    """
+    Apply fix_latex_escapes to streamed text.
+    A trailing run of backslashes is held back until the next chunk arrives,
+    so an escape split across chunk boundaries is fixed exactly as it would
+    be in the complete content.
+    """
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, text):
+        text = self._pending + text
+        stripped = text.rstrip('\\')
+        self._pending = text[len(stripped):]
+        return fix_latex_escapes(stripped)
+
+    def flush(self):
+        text, self._pending = self._pending, ""
+        return fix_latex_escapes(text)
+
+def _extract_usage(usage):
+    """Safely read (input, cached, output) token counts from an OpenAI usage object."""
+    if not usage:
+        return 0, 0, 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = details.cached_tokens if details and getattr(details, 'cached_tokens', None) else 0
+    return usage.prompt_tokens, cached_tokens, usage.completion_tokens
+
+def _build_result(content, usage, response_id, model=None):
+    """Calculate cost and build the success result dict (without charging anyone)."""
+    input_tokens, cached_tokens, output_tokens = _extract_usage(usage)
+    cost = 0.0
+    if usage:
+        cost = calculate_cost(input_tokens, cached_tokens, output_tokens, model)
+    
+    return {
+        "status": "success",
+        "content": content,
+        "tokens": {
+            "input": input_tokens,
+            "cached": cached_tokens,
+            "output": output_tokens,
+            "total": input_tokens + output_tokens # Total is sum of input & output
+        },
+        "cost": cost,
+        "response_id": response_id
+    }
+
+def _charge(result, user_id, hold_id=None):
+    """Deduct a successful result's cost from the user's balance, settling the request's hold in the same UPDATE."""
+    if result["status"] == "success" and result["cost"] > 0:
+        # Deduct balance using token_manager
+        token_manager.charge(user_id, result["cost"], hold_id)
+    return result
+
+def _cache_key(request_data, tool_type):
+    """Cache key for a cacheable tool request, or None if the tool is not cacheable."""
+    if tool_type not in Config.CACHEABLE_TOOLS and not tool_registry.is_cacheable(tool_type):
+        return None
+    messages = request_data["messages"]
+    system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
+    user_input = "\n".join(m["content"] for m in messages if m["role"] == "user")
+    return make_cache_key(tool_type, request_data.get("model"), system_prompt, user_input)
+
+def _cached_result(cached):
+    """
+    Build the result for a cache hit: no tokens were used, and the user pays
+    TOOL_CACHE_HIT_COST_RATIO of what the original call cost.
+    """
+    return {
+        "status": "success",
+        "content": cached["content"],
+        "tokens": {"input": 0, "cached": 0, "output": 0, "total": 0},
+        "cost": cached["cost"] * Config.TOOL_CACHE_HIT_COST_RATIO,
+        "response_id": None,
+        "cache_hit": True
+    }
+
+def _coalesced_result(result, participants, shared):
+    """
+    Bill one caller's share of a coalesced upstream call according to
+    Config.COALESCE_BILLING_POLICY:
+        'full':   every caller pays the full cost, as if it had made the call itself
+        'split':  the cost is divided evenly between all callers served
+        'leader': the caller that made the upstream call pays, the others pay nothing
+    """
+    if participants <= 1 or result["status"] != "success":
+        return result
+    policy = Config.COALESCE_BILLING_POLICY
+    cost = result["cost"]
+    if policy == 'split':
+        cost = cost / participants
+    elif policy == 'leader' and shared:
+        cost = 0.0
+    return dict(result, cost=cost, coalesced=True)
+
+def _error_result(error):
+    """Error result for a failed call; fail-fast errors say when to retry."""
+    result = {"status": "error", "message": str(error)}
+    if isinstance(error, CircuitOpenError):
+        result["retry_after"] = error.retry_after
+    return result
+
+def _call_upstream(request_data, tool_type=None, cache_key=None):
+    """Make the (non-streaming) OpenAI call and build its result, caching successful replies."""
     try:
-        response = client.chat.completions.create(**request_data) # Adjusted call
+        response = model_router.complete(request_data, tool_type or 'default')
         
         # Extract content and response ID (handle potential variations in response structure)
-        content = "Error: Could not parse response content."
+        content = EMPTY_CONTENT
         if response.choices and response.choices[0].message and response.choices[0].message.content:
              content = response.choices[0].message.content
         # Handle LaTeX formatting if necessary (moved inside call)
-        content = content.replace('\\\\(', '\\(').replace('\\\\)', '\\)')
-        content = content.replace('\\\\[', '\\[').replace('\\\\]', '\\]')
+        content = fix_latex_escapes(content)
              
         response_id = getattr(response, 'id', None)
-        
-        # Get token usage and calculate cost
-        input_tokens = cached_tokens = output_tokens = 0
-        cost = 0.0
-        if hasattr(response, 'usage'):
-            input_tokens = response.usage.prompt_tokens
-            # Safely access cached tokens
-            cached_tokens = response.usage.prompt_tokens_details.cached_tokens if hasattr(response.usage, 'prompt_tokens_details') and response.usage.prompt_tokens_details else 0
-            output_tokens = response.usage.completion_tokens
-            cost = calculate_cost(input_tokens, cached_tokens, output_tokens)
-            
-            # Deduct balance using token_manager
-            token_manager.deduct_balance(user_id, cost)
-            # update_user_quota(user_id, input_tokens + output_tokens, cost) # Alternative/Additional tracking
-        
-        return {
-            "status": "success",
-            "content": content,
-            "tokens": {
-                "input": input_tokens,
-                "cached": cached_tokens,
-                "output": output_tokens,
-                "total": input_tokens + output_tokens # Total is sum of input & output
-            },
-            "cost": cost,
-            "response_id": response_id
-        }
+        # Price by the model that actually answered (the router may have fallen back)
+        model = getattr(response, 'model', None) or request_data.get("model")
+        result = _build_result(content, getattr(response, 'usage', None), response_id, model)
     except Exception as e:
-        # Log error properly
-        print(f"API call failed: {str(e)}") # Replace with logger
-        return {
-            "status": "error",
-            "message": str(e)
-        }
+        current_app.logger.error(f"API call failed: {str(e)}")
+        return _error_result(e)
 
-def handle_math_classification(user_input, user_id, previous_response_id=None):
-    """Handle math classification tool API request."""
-    request_data = {
-        "model": "o3-mini", # Use o3-mini as in the original app
-        "messages": [
-            {
-                "role": "system",
-                "content": "GMAT的數學核心觀念有：\nValue, Order, Factors, Algebra, Equalities, Inequalities, Rates, Ratios, Percents, Statistics, Sets, Counting, Probability, Estimation, and Series\n這幾類。\n\n用戶將會給你一或多道數學題目，請分析用戶所提供的每一道題目在設計時，是希望測驗考生的上面哪一個數學核心觀念（請不要給出上面未列出的分類）。\n\nMust do Double check on each question: 每道題目請做兩次獨立的核心觀念判斷，並且檢查你的兩次判斷是否一致。如果不一致，請做第三次最終判斷。\n\n並且最後將每個核心觀念出現的題目數量統計成表格。"
-            },
-            {
-                "role": "user",
-                "content": user_input
-            }
-        ],
-        "temperature": 0.2,
-        "max_tokens": 2048, # Renamed from max_output_tokens for chat completions
-        "top_p": 1,
-        # "store": True # Not a standard chat completion parameter
-    }
-    if previous_response_id:
-        request_data["response_id"] = previous_response_id # This might not be standard
-        
-    return _make_api_call(request_data, user_id)
+    if cache_key and content != EMPTY_CONTENT:
+        tool_response_cache.set(cache_key, {"content": result["content"], "cost": result["cost"]})
+    return result
 
-def handle_word_problem_converter(user_input, user_id, previous_response_id=None):
-    """Handle word problem converter tool API request."""
-    request_data = {
-        "model": "o3-mini",
-        "messages": [
-             {
-                "role": "system",
-                "content": "Role: You are an expert in transforming GMAT quantitative questions into engaging, real-world scenarios.\n\nTask: Follow these steps to assist the user:\n1. The user will provide a GMAT math multiple-choice question in the form of text or an image.\n2. Convert the question into a word problem with a real-world scenario and story (30-50 words), written in English. Do not change any numerical values in the question.\n3. If the question provided is already a word problem (has a real-world scenario and story), simply translate it to English without altering anything else."
-            },
-            {
-                "role": "user",
-                "content": user_input
-            }
-        ],
-        "temperature": 1.0,
-        "max_tokens": 2048,
-        "top_p": 1,
-    }
-    if previous_response_id:
-        request_data["response_id"] = previous_response_id
-        
-    return _make_api_call(request_data, user_id)
+def _fetch_result(request_data, tool_type=None):
+    """Get a tool result from the cache, an identical in-flight call or OpenAI, without charging."""
+    cache_key = _cache_key(request_data, tool_type)
+    if not cache_key:
+        return _call_upstream(request_data, tool_type)
+
+    cached = tool_response_cache.get(cache_key)
+    if cached:
+        return _cached_result(cached)
+
+    try:
+        result, participants, shared = tool_singleflight.do(
+            cache_key, lambda: _call_upstream(request_data, tool_type, cache_key))
+    except FlightAbandoned:
+        # The streaming request we joined was cancelled; make our own call
+        result, participants, shared = _call_upstream(request_data, tool_type, cache_key), 1, False
+    return _coalesced_result(result, participants, shared)
+
+# Function to handle common API call logic
+def _make_api_call(request_data, user_id, tool_type=None, hold_id=None):
+    """Internal function to make OpenAI API call, calculate cost, and deduct balance."""
+    return _charge(_fetch_result(request_data, tool_type), user_id, hold_id)
 
-def handle_cr_classification(user_input, user_id, previous_response_id=None):
-    """Handle CR classification tool API request."""
+def _make_streaming_api_call(request_data, user_id, tool_type=None, hold_id=None):
+    """
+    Streaming counterpart of _make_api_call.
+    Yields:
+        tuple: ("delta", str) for each LaTeX-fixed fragment, then ("done", dict)
+               with the same shape as _make_api_call's result. Errors are
+               reported as a final ("done", {"status": "error", ...}).
+    """
+    cache_key = _cache_key(request_data, tool_type)
+    if cache_key:
+        cached = tool_response_cache.get(cache_key)
+        if cached:
+            yield "delta", cached["content"]
+            yield "done", _charge(_cached_result(cached), user_id, hold_id)
+            return
+
+    flight = None
+    if cache_key:
+        flight, leader = tool_singleflight.begin(cache_key)
+        if not leader:
+            # An identical request is already streaming; wait for its complete reply
+            try:
+                result = flight.wait()
+            except FlightAbandoned:
+                result = None
+            if result is not None:
+                if result["status"] == "success":
+                    yield "delta", result["content"]
+                yield "done", _charge(_coalesced_result(result, flight.participants, True), user_id, hold_id)
+                return
+            flight = None # Leader was cancelled; stream on our own
+
+    request_data = dict(request_data, stream=True, stream_options={"include_usage": True})
+    parts = []
+    usage = None
+    response_id = None
+    model = request_data.get("model")
+    fixer = LatexEscapeFixer()
+    stream = None
+    result = None
+    try:
+        stream = model_router.complete(request_data, tool_type or 'default')
+        for chunk in stream:
+            response_id = response_id or getattr(chunk, 'id', None)
+            model = getattr(chunk, 'model', None) or model
+            # The final chunk carries usage and no choices
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            text = fixer.feed(chunk.choices[0].delta.content or "")
+            if text:
+                parts.append(text)
+                yield "delta", text
+        tail = fixer.flush()
+        if tail:
+            parts.append(tail)
+            yield "delta", tail
+        result = _build_result("".join(parts) or EMPTY_CONTENT, usage, response_id, model)
+    except Exception as e:
+        current_app.logger.error(f"Streaming API call failed: {str(e)}")
+        result = _error_result(e)
+    finally:
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+        if flight is not None:
+            # Publish to the waiters; result is None if our client went away mid-stream
+            tool_singleflight.finish(cache_key, flight, value=result,
+                                     error=None if result is not None else FlightAbandoned())
+
+    if result["status"] == "success" and cache_key and parts:
+        tool_response_cache.set(cache_key, {"content": result["content"], "cost": result["cost"]})
+    participants = flight.participants if flight is not None else 1
+    yield "done", _charge(_coalesced_result(result, participants, False), user_id, hold_id)
+
+MATH_CONCEPTS = ("Value", "Order", "Factors", "Algebra", "Equalities", "Inequalities", "Rates", "Ratios",
+                 "Percents", "Statistics", "Sets", "Counting", "Probability", "Estimation", "Series")
+UNCLASSIFIED = "未能分類"
+CLASSIFICATION_FAILED = "分類失敗"
+
+# A question starts on a line beginning with "1." / "2)" / "Q3:" / "Question 4" / "第5題"
+_QUESTION_START_PATTERN = re.compile(
+    r'^[ \t]*(?:(?:Q(?:uestion)?[ \t]*)?\d{1,3}[ \t]*[.)、:：]|Q(?:uestion)?[ \t]*\d{1,3}\b|第[ \t]*\d{1,3}[ \t]*題)',
+    re.IGNORECASE | re.MULTILINE
+)
+
+def split_questions(user_input):
+    """
+    Split pasted input into individual numbered questions.
+    Text before the first number (e.g. shared instructions) is kept with the first question.
+    Returns:
+        list: Question texts; a single item if the input is not a numbered list.
+    """
+    starts = [match.start() for match in _QUESTION_START_PATTERN.finditer(user_input or "")]
+    if len(starts) < 2:
+        return [user_input]
+    starts[0] = 0
+    bounds = zip(starts, starts[1:] + [len(user_input)])
+    return [user_input[start:end].strip() for start, end in bounds if user_input[start:end].strip()]
+
+def build_math_question_request(question):
+    """Build the request classifying a single question of a fanned-out math classification."""
     request_data = {
-        "model": "o3-mini",
         "messages": [
             {
                 "role": "system",
-                "content": "You are an expert GMAT Critical Reasoning (CR) tutor.\nYour task is to classify the type of GMAT CR question provided by the user.\n\nThe possible CR question types are:\n1.  **Assumption:** Identify an unstated premise the argument relies on.\n2.  **Strengthen:** Find a statement that makes the argument's conclusion more likely.\n3.  **Weaken:** Find a statement that makes the argument's conclusion less likely.\n4.  **Evaluate:** Identify a question whose answer would help determine the argument's validity.\n5.  **Inference:** Determine what must be true based on the given statements.\n6.  **Explain/Resolve Discrepancy:** Find a statement that reconciles seemingly contradictory information.\n7.  **Flaw:** Identify the logical error in the argument's reasoning.\n8.  **Boldface:** Analyze the role played by the bolded portions of the argument.\n9.  **Method of Reasoning:** Describe how the argument proceeds logically.\n10. **Main Point/Conclusion:** Identify the primary claim the argument tries to establish.\n\nPlease respond ONLY with the name of the question type from the list above."
+                "content": "GMAT的數學核心觀念有：\n" + ", ".join(MATH_CONCEPTS) + "\n這幾類。\n\n用戶會給你一道數學題目，請判斷這道題目在設計時，是希望測驗考生的上面哪一個數學核心觀念（請不要給出上面未列出的分類）。\n\n請先獨立判斷兩次並確認一致，不一致時再做第三次最終判斷。只輸出最終的核心觀念名稱，不要輸出其他內容。"
             },
             {
                 "role": "user",
-                "content": user_input
+                "content": question
             }
         ],
         "temperature": 0.2,
-        "max_tokens": 50, # Shorter response needed
         "top_p": 1,
     }
-    if previous_response_id:
-         request_data["response_id"] = previous_response_id
-         
-    return _make_api_call(request_data, user_id)
+    return model_router.route(request_data, "math_classification_question")
 
-def handle_distractor_mocker(user_input, user_id, previous_response_id=None):
-    """Handle distractor mocker tool API request."""
-    request_data = {
-        "model": "o3-mini",
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are a GMAT test creation expert specializing in crafting plausible incorrect answer choices (distractors) for Verbal questions (CR, RC, SC).\n\nTask: The user will provide a GMAT Verbal question (including the passage/stimulus if applicable) AND its correct answer.\n1. Analyze the question, passage (if any), and the correct answer.\n2. Identify common reasoning errors or traps relevant to the question type.\n3. Create ONE realistic and tempting incorrect answer choice (distractor) based on these potential errors.\n4. Provide a brief (1-2 sentence) explanation of WHY this distractor is incorrect and what specific trap it targets."
-            },
-            {
-                "role": "user",
-                "content": user_input
-            }
-        ],
-        "temperature": 0.8, # Allow for more creative distractors
-        "max_tokens": 500,
-        "top_p": 1,
+def parse_math_concept(content):
+    """Return the concept named earliest in a reply, or UNCLASSIFIED."""
+    positions = []
+    for concept in MATH_CONCEPTS:
+        match = re.search(r'\b' + concept + r'\b', content or "", re.IGNORECASE)
+        if match:
+            positions.append((match.start(), concept))
+    return min(positions)[1] if positions else UNCLASSIFIED
+
+def _classify_math_questions(questions):
+    """
+    Classify questions concurrently (at most MATH_FANOUT_MAX_WORKERS at once).
+    Yields:
+        tuple: (question number, result dict) in input order, as soon as each is available.
+    """
+    workers = max(1, min(len(questions), Config.MATH_FANOUT_MAX_WORKERS))
+    app = current_app._get_current_object()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="math-fanout") as pool:
+        futures = [pool.submit(utils.call_in_app_context, app, _fetch_result, build_math_question_request(question),
+                               "math_classification_question")
+                   for question in questions]
+        for number, future in enumerate(futures, start=1):
+            yield number, future.result()
+
+def _math_fanout_row(number, result):
+    """
+    Table row of one classified question.
+    Returns:
+        tuple: (str concept, or None if the call failed; str markdown row)
+    """
+    if result["status"] != "success":
+        # Keep the row a single table cell: no pipes or line breaks from the error text
+        error = re.sub(r'\s+', ' ', result.get("message", "")).replace("|", "\\|").strip()
+        return None, f"| {number} | {CLASSIFICATION_FAILED}：{error} |\n"
+    concept = parse_math_concept(result["content"])
+    return concept, f"| {number} | {concept} |\n"
+
+def _math_fanout_summary(concepts):
+    """
+    Markdown table counting questions per concept, in the canonical concept order.
+    Questions whose call failed (None) are left out of the counts and noted below the table.
+    """
+    counts = {concept: concepts.count(concept) for concept in MATH_CONCEPTS + (UNCLASSIFIED,) if concept in concepts}
+    rows = "".join(f"| {concept} | {count} |\n" for concept, count in counts.items())
+    summary = f"\n**核心觀念統計**\n\n| 核心觀念 | 題目數量 |\n|---|---|\n{rows}"
+    failed = concepts.count(None)
+    if failed:
+        summary += f"\n另有 {failed} 題{CLASSIFICATION_FAILED}，未計入統計，請稍後重試。\n"
+    return summary
+
+def _merge_math_results(results, content):
+    """Combine per-question results into one tool result, summing tokens and cost."""
+    successes = [result for result in results if result["status"] == "success"]
+    if not successes:
+        return results[0]
+    tokens = {name: sum(result["tokens"][name] for result in successes) for name in ("input", "cached", "output", "total")}
+    return {
+        "status": "success",
+        "content": content,
+        "tokens": tokens,
+        "cost": sum(result["cost"] for result in successes),
+        "response_id": None
     }
-    if previous_response_id:
-        request_data["response_id"] = previous_response_id
-        
-    return _make_api_call(request_data, user_id)
-
-# This function duplicates token_manager logic. 
-# It might be useful for separate tracking but complicates balance management.
-# Consider removing it or integrating it carefully with token_manager.
-# def update_user_quota(user_id, tokens_used, cost_incurred):
-#     """Update the UserQuota record for a user."""
-#     if not user_id:
-#         return # Cannot update without user ID
-        
-#     quota = UserQuota.query.filter_by(user_id=user_id).first()
-#     now = datetime.utcnow()
+
+MATH_FANOUT_HEADER = "| 題號 | 核心觀念 |\n|---|---|\n"
+
+def _use_math_fanout(questions):
+    return Config.MATH_FANOUT_ENABLED and len(questions) >= 2
+
+def _math_fanout_stream(questions, user_id, hold_id=None):
+    """Fan out a multi-question math classification, yielding table rows as questions finish."""
+    yield "delta", MATH_FANOUT_HEADER
+    parts = [MATH_FANOUT_HEADER]
+    results, concepts = [], []
+    for number, result in _classify_math_questions(questions):
+        concept, row = _math_fanout_row(number, result)
+        results.append(result)
+        concepts.append(concept)
+        parts.append(row)
+        yield "delta", row
+    summary = _math_fanout_summary(concepts)
+    parts.append(summary)
+    yield "delta", summary
+    yield "done", _charge(_merge_math_results(results, "".join(parts)), user_id, hold_id)
+
+def handle_math_classification(user_input, user_id, hold_id=None):
+    """
+    Handle math classification tool API request.
+    Several numbered questions are classified one per request in parallel and
+    the counts table is built here, instead of one long completion.
+    """
+    questions = split_questions(user_input)
+    if _use_math_fanout(questions):
+        result = None
+        for event, data in _math_fanout_stream(questions, user_id, hold_id):
+            if event == "done":
+                result = data
+        return result
+    return _make_api_call(tool_registry.get_tool("math_classification").build_request(user_input), user_id,
+                          "math_classification", hold_id)
+
+# Save the AI reply of a tool request (used by the tools blueprint and the job worker)
+def save_tool_message(chat_id, result, tool_type=None, user_id=None):
+    """
+    Save the AI message for a tool result (even if an error occurred, to show feedback),
+    together with its usage ledger entry.
+    Args:
+        user_id (int, optional): The user charged for the result; looked up from the chat if None.
+    """
+    ai_content = ""
+    response_id = None
+    prompt_tokens = 0
+    completion_tokens = 0
+    cached_tokens = 0
+    cost = 0.0
+
+    if result['status'] == 'success':
+        ai_content = result['content']
+        response_id = result.get('response_id')
+        prompt_tokens = result.get('tokens', {}).get('input', 0)
+        completion_tokens = result.get('tokens', {}).get('output', 0)
+        cached_tokens = result.get('tokens', {}).get('cached', 0)
+        cost = result.get('cost', 0.0)
+    else:
+        ai_content = f"處理請求時發生錯誤: {result['message']}"
     
-#     if not quota:
-#         quota = UserQuota(user_id=user_id, total_tokens=tokens_used, total_cost=cost_incurred, last_updated=now)
-#         db.session.add(quota)
-#     else:
-#         quota.total_tokens += tokens_used
-#         quota.total_cost += cost_incurred
-#         quota.last_updated = now
-        
-#     try:
-#         db.session.commit()
-#     except Exception as e:
-#         db.session.rollback()
-#         # Log error
-#         print(f"Error updating UserQuota for {user_id}: {str(e)}")
+    ai_message = Message(
+        role='assistant',
+        content=ai_content,
+        timestamp=datetime.utcnow(),
+        chat_id=chat_id,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cost=cost,
+        response_id=response_id,
+        cached_tokens=cached_tokens,
+        instruction=tool_type
+    )
+    db.session.add(ai_message)
+    usage_ledger.record(user_id, ai_message, 'tool') # Saved with the message
+    db.session.commit()
+    return ai_message
 
 # Simplified handlers just calling process_tool_request
 # def handle_verbal_tool(tool_type, user_input):
@@ -206,32 +464,72 @@ def handle_distractor_mocker(user_input, user_id, previous_response_id=None):
 #     return process_tool_request(tool_type, user_input)
 
 # Unified function to process any tool request
-def process_tool_request(tool_type, user_input, user_id, previous_response_id=None):
+def process_tool_request(tool_type, user_input, user_id, hold_id=None):
     """
     Processes a request for a specific tool.
     Args:
-        tool_type (str): The identifier for the tool (e.g., 'math_classification').
+        tool_type (str): The identifier for the tool (e.g., 'math_classification'), see tool_registry.json.
         user_input (str): The input text from the user.
         user_id (int): The ID of the user making the request (for balance deduction).
-        previous_response_id (str, optional): ID of the previous response for caching.
+        hold_id (int, optional): The request's balance hold, settled by the same UPDATE as the charge.
     Returns:
         dict: A dictionary containing the status and result of the API call.
     """
-    handlers = {
-        "math_classification": handle_math_classification,
-        "word_problem_converter": handle_word_problem_converter,
-        "cr_classification": handle_cr_classification,
-        "distractor_mocker": handle_distractor_mocker,
-        # Add other tool handlers here
-    }
-    
-    handler = handlers.get(tool_type)
-    
-    if handler:
-        # Pass user_id to the specific handler
-        return handler(user_input, user_id, previous_response_id)
-    else:
+    tool = tool_registry.get_tool(tool_type)
+    if not tool:
         return {
             "status": "error",
             "message": f"未知的工具類型: {tool_type}"
-        }
\ No newline at end of file
+        }
+    if tool_type == "math_classification":
+        return handle_math_classification(user_input, user_id, hold_id)
+    return _make_api_call(tool.build_request(user_input), user_id, tool_type, hold_id)
+
+def process_tool_request_stream(tool_type, user_input, user_id, hold_id=None):
+    """
+    Streaming variant of process_tool_request.
+    Args:
+        Same as process_tool_request.
+    Yields:
+        tuple: ("delta", str) for each content fragment, then ("done", dict)
+               where dict has the same shape as process_tool_request's result.
+    """
+    tool = tool_registry.get_tool(tool_type)
+    if not tool:
+        yield "done", {
+            "status": "error",
+            "message": f"未知的工具類型: {tool_type}"
+        }
+        return
+    if tool_type == "math_classification":
+        questions = split_questions(user_input)
+        if _use_math_fanout(questions):
+            yield from _math_fanout_stream(questions, user_id, hold_id)
+            return
+    if not tool.streaming:
+        # Short answers (e.g. a single classification) are sent in one piece
+        result = _make_api_call(tool.build_request(user_input), user_id, tool_type, hold_id)
+        if result.get("status") == "success":
+            yield "delta", result["content"]
+        yield "done", result
+        return
+    yield from _make_streaming_api_call(tool.build_request(user_input), user_id, tool_type, hold_id)
+
+def estimate_tool_cost(tool_type, user_input):
+    """
+    Pre-flight estimate of a tool request's worst-case cost (prompt tokens
+    counted locally plus the request's max_tokens), priced at the higher of the
+    routed and fallback models (model_router.estimate_worst_case_cost).
+    Returns:
+        float: Estimated cost, 0.0 for unknown tools.
+    """
+    tool = tool_registry.get_tool(tool_type)
+    if not tool:
+        return 0.0
+    requests = [(tool.build_request(user_input), tool_type)]
+    if tool_type == "math_classification":
+        questions = split_questions(user_input)
+        if _use_math_fanout(questions):
+            requests = [(build_math_question_request(question), "math_classification_question")
+                        for question in questions]
+    return sum(model_router.estimate_worst_case_cost(request_data, key) for request_data, key in requests)
@@ -1,12 +1,16 @@
-from app import app, db
-from token_manager import UserToken
+import argparse
+
+from app import create_app
+import token_manager
+
+parser = argparse.ArgumentParser(description="重設用戶餘額（一條 UPDATE 語句）")
+parser.add_argument('--due-only', action='store_true', help="只重設本週尚未重設的用戶（可排程執行）")
+args = parser.parse_args()
+
+app = create_app()
 
 # 在應用上下文中執行
 with app.app_context():
-    # 更新所有用戶的餘額
-    tokens = UserToken.query.all()
-    for token in tokens:
-        token.balance = 5.0  # 設置為5元
-    
-    db.session.commit()
-    print(f"已更新 {len(tokens)} 個用戶的餘額為 5.0 元")
\ No newline at end of file
+    # 更新用戶的餘額
+    count = token_manager.reset_balances(due_only=args.due_only)
+    print(f"已更新 {count} 個用戶的餘額為 {app.config['WEEKLY_BALANCE']} 元")
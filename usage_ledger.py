@@ -0,0 +1,175 @@
+"""
+Append-only usage ledger with incrementally maintained rollups.
+
+Every assistant reply that used tokens gets a UsageLedger row, written in the
+same transaction as the message. The same transaction adds the reply to the
+user's all-time totals (UserQuota) and to their UsageDaily row for the UTC
+day, so usage stats are a lookup by key instead of a scan of the user's
+messages. Rollups can be rebuilt from the messages with backfill_usage.py.
+"""
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import Chat, Message, UsageDaily, UsageLedger, UserQuota
+
+def _insert_ignore(model, index_elements, **values):
+    """
+    Insert a row unless one with the same unique key exists (see
+    token_manager._ensure_token). Does not commit.
+    """
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        db.session.execute(insert(model).values(**values).on_conflict_do_nothing(index_elements=index_elements))
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**values))
+    except IntegrityError:
+        pass # Created concurrently by another request
+
+def _increment(query, changes):
+    """Add to counters with one UPDATE, so concurrent replies never lose each other's usage."""
+    return query.update(changes, synchronize_session=False)
+
+def _add_to_rollups(user_id, day, prompt_tokens, completion_tokens, cost, now):
+    """Add usage to the user's all-time and daily totals, creating the rows on first use. Does not commit."""
+    quota = UserQuota.query.filter(UserQuota.user_id == user_id)
+    quota_changes = {
+        UserQuota.total_tokens: UserQuota.total_tokens + prompt_tokens + completion_tokens,
+        UserQuota.total_cost: UserQuota.total_cost + cost,
+        UserQuota.last_updated: now
+    }
+    if not _increment(quota, quota_changes):
+        _insert_ignore(UserQuota, ['user_id'], user_id=user_id, total_tokens=0, total_cost=0.0, last_updated=now)
+        _increment(quota, quota_changes)
+
+    daily = UsageDaily.query.filter(UsageDaily.user_id == user_id, UsageDaily.day == day)
+    daily_changes = {
+        UsageDaily.requests: UsageDaily.requests + 1,
+        UsageDaily.prompt_tokens: UsageDaily.prompt_tokens + prompt_tokens,
+        UsageDaily.completion_tokens: UsageDaily.completion_tokens + completion_tokens,
+        UsageDaily.cost: UsageDaily.cost + cost
+    }
+    if not _increment(daily, daily_changes):
+        _insert_ignore(UsageDaily, ['user_id', 'day'], user_id=user_id, day=day,
+                       requests=0, prompt_tokens=0, completion_tokens=0, cost=0.0)
+        _increment(daily, daily_changes)
+
+def record(user_id, message, kind):
+    """
+    Add a ledger entry for an assistant message and fold it into the rollups.
+    Call after adding the message to the session and before committing it, so
+    the message, its ledger entry and the rollups are saved together. Replies
+    that used no tokens (error messages) are not recorded.
+    Args:
+        user_id (int): The user who was charged; looked up from the chat if None.
+        message (Message): The assistant message.
+        kind (str): 'chat' or 'tool'.
+    """
+    prompt_tokens = message.prompt_tokens or 0
+    completion_tokens = message.completion_tokens or 0
+    cost = message.cost or 0.0
+    if not (prompt_tokens or completion_tokens or cost):
+        return
+    if user_id is None:
+        user_id = db.session.query(Chat.user_id).filter(Chat.id == message.chat_id).scalar()
+
+    now = datetime.utcnow()
+    db.session.add(UsageLedger(
+        user_id=user_id,
+        message=message,
+        kind=kind,
+        instruction=message.instruction,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        cached_tokens=message.cached_tokens or 0,
+        cost=cost,
+        created_at=now
+    ))
+    _add_to_rollups(user_id, now.date(), prompt_tokens, completion_tokens, cost, now)
+
+def get_totals(user_id):
+    """
+    All-time usage of a user.
+    Returns:
+        tuple: (int total tokens, float total cost)
+    """
+    row = db.session.query(UserQuota.total_tokens, UserQuota.total_cost).filter(UserQuota.user_id == user_id).first()
+    return (row.total_tokens or 0, row.total_cost or 0.0) if row else (0, 0.0)
+
+def get_daily(user_id, day=None):
+    """
+    Usage of a user on one UTC day (default today).
+    Returns:
+        dict: requests, prompt_tokens, completion_tokens, cost
+    """
+    day = day or datetime.utcnow().date()
+    row = UsageDaily.query.filter_by(user_id=user_id, day=day).first()
+    if not row:
+        return {'requests': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0.0}
+    return {
+        'requests': row.requests,
+        'prompt_tokens': row.prompt_tokens,
+        'completion_tokens': row.completion_tokens,
+        'cost': row.cost
+    }
+
+def backfill():
+    """
+    Rebuild the ledger and rollups from the assistant messages saved so far
+    (e.g. after deploying the ledger on an existing database). Replaces any
+    existing ledger entries and rollups.
+    Returns:
+        int: Number of ledger entries written.
+    """
+    UsageLedger.query.delete(synchronize_session=False)
+    UsageDaily.query.delete(synchronize_session=False)
+    UserQuota.query.delete(synchronize_session=False)
+
+    rows = db.session.query(Message, Chat.user_id, Chat.category).join(Chat).filter(
+        Message.role == 'assistant'
+    ).order_by(Message.id).yield_per(1000)
+    now = datetime.utcnow()
+    totals = {}
+    daily = {}
+    entries = 0
+    for message, user_id, category in rows:
+        prompt_tokens = message.prompt_tokens or 0
+        completion_tokens = message.completion_tokens or 0
+        cost = message.cost or 0.0
+        if not (prompt_tokens or completion_tokens or cost):
+            continue
+        created_at = message.timestamp or now
+        db.session.add(UsageLedger(
+            user_id=user_id,
+            message_id=message.id,
+            kind='tool' if category.endswith('_tool') else 'chat',
+            instruction=message.instruction,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=message.cached_tokens or 0,
+            cost=cost,
+            created_at=created_at
+        ))
+        entries += 1
+        tokens, total_cost = totals.get(user_id, (0, 0.0))
+        totals[user_id] = (tokens + prompt_tokens + completion_tokens, total_cost + cost)
+        day_totals = daily.setdefault((user_id, created_at.date()), [0, 0, 0, 0.0])
+        day_totals[0] += 1
+        day_totals[1] += prompt_tokens
+        day_totals[2] += completion_tokens
+        day_totals[3] += cost
+
+    for user_id, (tokens, total_cost) in totals.items():
+        db.session.add(UserQuota(user_id=user_id, total_tokens=tokens, total_cost=total_cost, last_updated=now))
+    for (user_id, day), (requests, prompt_tokens, completion_tokens, cost) in daily.items():
+        db.session.add(UsageDaily(user_id=user_id, day=day, requests=requests, prompt_tokens=prompt_tokens,
+                                  completion_tokens=completion_tokens, cost=cost))
+    db.session.commit()
+    return entries
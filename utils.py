@@ -1,15 +1,56 @@
 from config import Config
 
-def calculate_cost(prompt_tokens, completion_tokens, cached_input_tokens=0):
-    """Calculate cost based on tokens and pricing from config."""
+def get_model_pricing(model=None):
+    """
+    Look up (input, cached input, output) prices per 1M tokens for a model.
+    Dated snapshots match their base model; unknown models use DEFAULT_PRICING_MODEL.
+    """
+    pricing = Config.MODEL_PRICING
+    if model in pricing:
+        return pricing[model]
+    # Longest name first, so gpt-4o-mini-2024-07-18 is not priced as gpt-4o
+    for name in sorted(pricing, key=len, reverse=True):
+        if model and model.startswith(name + "-"):
+            return pricing[name]
+    return pricing[Config.DEFAULT_PRICING_MODEL]
+
+def calculate_cost(prompt_tokens, completion_tokens, cached_input_tokens=0, model=None):
+    """Calculate cost based on tokens and the model's pricing from config."""
+    input_price, cached_input_price, output_price = get_model_pricing(model)
     non_cached_input_tokens = prompt_tokens - cached_input_tokens
-    cached_input_cost = (cached_input_tokens / 1_000_000) * Config.CACHED_INPUT_PRICE
-    non_cached_input_cost = (non_cached_input_tokens / 1_000_000) * Config.INPUT_PRICE
+    cached_input_cost = (cached_input_tokens / 1_000_000) * cached_input_price
+    non_cached_input_cost = (non_cached_input_tokens / 1_000_000) * input_price
     input_cost = cached_input_cost + non_cached_input_cost
-    output_cost = (completion_tokens / 1_000_000) * Config.OUTPUT_PRICE
+    output_cost = (completion_tokens / 1_000_000) * output_price
     total_cost = input_cost + output_cost
     return input_cost, output_cost, total_cost
 
+def insufficient_balance_message(balance, estimated_cost):
+    """User-facing message for a request whose pre-flight cost estimate exceeds the balance."""
+    if balance <= 0:
+        return f"您的API餘額不足 ({balance:.4f} 元)，請等待下週日重置。"
+    return (f"本次請求預估最高費用 {estimated_cost:.4f} 元，超過您的API餘額 ({balance:.4f} 元)。"
+            f"請開始新的對話或縮短問題，或等待下週日重置。")
+
+def call_in_app_context(app, fn, *args):
+    """Call fn(*args) inside app's application context (for thread pool workers, which have none)."""
+    with app.app_context():
+        return fn(*args)
+
+# Stable system prompt sent first on every chat turn. It never changes with the
+# instruction, so the system prompt plus earlier turns form a reusable prompt-cache prefix.
+BASE_SYSTEM_PROMPT = "你是一位專業的GMAT解題助手。請根據對話中最新的一則指示回答學生最新的問題。"
+
+def estimate_tokens(text):
+    """
+    Rough token estimate without a tokenizer: CJK characters count as about
+    one token each, other text as about four characters per token.
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u2e80' <= ch <= '\u9fff' or '\uf900' <= ch <= '\ufaff')
+    return cjk + (len(text) - cjk + 3) // 4
+
 def init_conversation(instruction="simple_explain"):
     """Initialize conversation with system prompts."""
     system_prompts = {
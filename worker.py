@@ -0,0 +1,46 @@
+"""
+Background worker for the LLM job queue.
+
+Run one or more of these next to the web server when LLM_JOB_QUEUE_ENABLED
+is set, e.g. `python worker.py` or `python worker.py --once`.
+"""
+import argparse
+import time
+
+from app import create_app
+from extensions import db
+import job_queue
+import token_manager
+
+def main():
+    parser = argparse.ArgumentParser(description="Process queued LLM jobs.")
+    parser.add_argument('--once', action='store_true', help="Drain the queue once and exit")
+    parser.add_argument('--worker-id', default=job_queue.default_worker_id(), help="Identifier recorded on claimed jobs")
+    args = parser.parse_args()
+
+    app = create_app()
+    poll_interval = app.config['LLM_JOB_POLL_INTERVAL']
+    print(f"LLM worker {args.worker_id} started")
+
+    with app.app_context():
+        last_stale_check = 0.0
+        while True:
+            # Recover jobs orphaned by crashed workers, and balance holds nobody settled, every minute
+            if time.monotonic() - last_stale_check > 60:
+                job_queue.requeue_stale_jobs()
+                token_manager.reap_expired_holds()
+                last_stale_check = time.monotonic()
+
+            job = job_queue.claim_next(args.worker_id)
+            if job is None:
+                if args.once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            print(f"Running {job.kind} job {job.id} for user {job.user_id}")
+            job_queue.run_job(job, args.worker_id)
+            db.session.remove() # Start each job with a fresh session
+
+if __name__ == "__main__":
+    main()